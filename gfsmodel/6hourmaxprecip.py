@@ -2,19 +2,22 @@ import importlib
 import os
 import cartopy
 from filelock import FileLock
-import requests
 from datetime import datetime, timedelta
-import xarray as xr
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap, BoundaryNorm
-import numpy as np
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
-import time
-import gc
-from PIL import Image
+import gfs_arrays
+import gfs_decode
+import gfs_frame
+import gfs_grid
+import gfs_ingest
+import gfs_labels
+import gfs_png
+import gfs_raster
+import gfs_render
 
 # Ensure a stable cartopy data directory and create it
 cartopy.config['data_dir'] = '/opt/render/project/src/cartopy_data'
@@ -30,9 +33,11 @@ with lock:
 
 BASE_DIR = '/var/data'
 
-# --- Clean up old files in grib_files, pngs, and 6hour_precip_total directories ---
+# Filled fields as gfs_raster images (False: matplotlib contourf)
+RASTER = True
+
+# --- Clean up old files in pngs and 6hour_precip_total directories ---
 for folder in [
-    os.path.join(BASE_DIR, "GFS", "static", "6hour_precip_total", "grib_files"),
     os.path.join(BASE_DIR, "GFS", "static", "pngs"),
     os.path.join(BASE_DIR, "GFS", "static", "6hour_precip_total")
 ]:
@@ -45,17 +50,11 @@ for folder in [
 # Directories
 output_dir = os.path.join(BASE_DIR, "GFS")
 precip_total_dir = os.path.join(output_dir, "static", "6hour_precip_total")
-grib_dir = os.path.join(precip_total_dir, "grib_files")
 png_dir = precip_total_dir
-os.makedirs(grib_dir, exist_ok=True)
 os.makedirs(png_dir, exist_ok=True)
 
-# GFS NOMADS URL and variable
-base_url = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl"
-variable_apcp = "APCP"
-current_utc_time = datetime.utcnow() - timedelta(hours=6)
-date_str = current_utc_time.strftime("%Y%m%d")
-hour_str = str(current_utc_time.hour // 6 * 6).zfill(2)
+# Newest GFS cycle on NOMADS (GFS_CYCLE=YYYYMMDDHH pins one)
+date_str, hour_str = gfs_ingest.current_cycle()
 
 # Precipitation colormap and levels (inches, similar to NBM)
 precip_breaks = [
@@ -70,64 +69,30 @@ precip_colors = [
 ]
 precip_cmap = ListedColormap(precip_colors)
 precip_norm = BoundaryNorm(precip_breaks, len(precip_colors))
+png_palette = gfs_png.palette(gfs_png.Fill(precip_colors))
 
 def download_file(hour_str, step):
-    if step == 0:
-        file_name = f"gfs.t{hour_str}z.pgrb2.0p25.f000"
-    else:
-        file_name = f"gfs.t{hour_str}z.pgrb2.0p25.f{step:03d}"
-    file_path = os.path.join(grib_dir, file_name)
-    url_apcp = (
-        f"{base_url}"
-        f"?dir=%2Fgfs.{date_str}%2F{hour_str}%2Fatmos"
-        f"&file={file_name}"
-        f"&var_{variable_apcp}=on"
-        f"&lev_surface=on"
-    )
-    response = requests.get(url_apcp, stream=True)
-    if response.status_code == 200:
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-        # Check file size
-        if os.path.getsize(file_path) < 10240:  # less than 10KB
-            print(f"Downloaded {file_name} but file is too small (likely empty or error page).")
-            os.remove(file_path)
-            return None
-        print(f"Downloaded {file_name}")
-        return file_path
-    else:
-        print(f"Failed to download {file_name} (Status Code: {response.status_code})")
-        return None
+    return gfs_ingest.fetch(date_str, hour_str, step, "apcp", "apcp")
 
-def generate_clean_png(file_path, step):
-    ds = xr.open_dataset(file_path, engine="cfgrib")
+def precip_inches(apcp_mm):
     # APCP is in kg/m^2, which is equivalent to mm. Convert mm to inches.
-    apcp_mm = ds['tp'].values
-    apcp_in = apcp_mm / 25.4
+    apcp_in = gfs_arrays.scale(apcp_mm, 1 / 25.4)
 
     # --- Remove random data beams: mask invalid/extreme values ---
-    apcp_in = np.where(
-        (np.isnan(apcp_in)) | (apcp_in < 0) | (apcp_in > 50),
-        np.nan,
-        apcp_in
-    )
+    return gfs_arrays.mask_outside(apcp_in, 0, 50)
+
+def load_step(file_path, step):
+    # Decode and convert once; every region renders from the same arrays
+    return gfs_decode.load_bundle(step, {"apcp_in": (file_path, "APCP", None, precip_inches)})
+
+def generate_clean_png(bundle):
+    step = bundle.step
+    apcp_in = bundle.fields["apcp_in"]
 
-    fig = plt.figure(figsize=(10, 7), dpi=600, facecolor='white')
-    ax = plt.axes(projection=ccrs.PlateCarree(), facecolor='white')
     # Set desired map extent
     extent_left, extent_right, extent_bottom, extent_top = -126, -69, 24, 50
-    ax.set_extent([extent_left, extent_right, extent_bottom, extent_top], crs=ccrs.PlateCarree())
-
-    # --- Add map features ---
-    ax.add_feature(cfeature.LAND, facecolor='lightgray')
-    ax.add_feature(cfeature.OCEAN, facecolor='white')
-    ax.add_feature(cfeature.COASTLINE, linewidth=0.7)
-    ax.add_feature(cfeature.BORDERS, linewidth=0.5)
-    ax.add_feature(cfeature.STATES, linewidth=0.3)
-    ax.add_feature(cfeature.RIVERS, linewidth=0.4, edgecolor='blue')
-    ax.add_feature(cfeature.LAKES, facecolor='lightblue', edgecolor='blue', linewidth=0.3)
+    frame = gfs_frame.frame("precip6_usa", [extent_left, extent_right, extent_bottom, extent_top])
+    fig, ax = frame.begin()
 
     # --- Title block ---
     run_hour_map = {
@@ -149,53 +114,24 @@ def generate_clean_png(file_path, step):
     plt.title(title_str, fontsize=12, fontweight='bold', y=1.03)
 
     # --- Plot precipitation ---
-    if 'latitude' in ds and 'longitude' in ds:
-        lats = ds['latitude'].values
-        lons = ds['longitude'].values
-        lons_plot = np.where(lons > 180, lons - 360, lons)
-        if lats.ndim == 1 and lons.ndim == 1:
-            Lon2d, Lat2d = np.meshgrid(lons_plot, lats)
-            data2d = apcp_in.squeeze()
-        else:
-            Lon2d, Lat2d = lons_plot, lats
-            data2d = apcp_in.squeeze()
-        # Mask out data outside the plotting extent
-        mask_extent = (
-            (Lat2d >= extent_bottom) & (Lat2d <= extent_top) &
-            (Lon2d >= extent_left) & (Lon2d <= extent_right)
-        )
-        data2d = np.where(mask_extent, data2d, np.nan)
+    if bundle.lats is not None and bundle.lons is not None:
+        lats = bundle.lats
+        lons = bundle.lons
+        region = gfs_grid.geometry(lats, lons).region([extent_left, extent_right, extent_bottom, extent_top])
+        data2d = region.crop(apcp_in.squeeze())
         # Plot with extent matching the map
-        mesh = ax.contourf(
-            Lon2d, Lat2d, data2d,
+        mesh = gfs_raster.contourf(
+            ax, region, data2d,
             levels=precip_breaks,
             cmap=precip_cmap,
             norm=precip_norm,
             extend='max',
-            transform=ccrs.PlateCarree()
+            raster=RASTER
         )
 
         # --- Add 2-degree grid with precipitation numbers ---
-        for lat in range(int(extent_bottom), int(extent_top) + 1, 2):
-            for lon in range(int(extent_left), int(extent_right) + 1, 2):
-                # Find nearest grid point
-                iy = np.abs(lats - lat).argmin() if lats.ndim == 1 else np.abs(lats[:,0] - lat).argmin()
-                ix = np.abs(lons_plot - lon).argmin() if lons_plot.ndim == 1 else np.abs(lons_plot[0,:] - lon).argmin()
-                precip_val = data2d[iy, ix]
-                if not np.isnan(precip_val):
-                    # Show "0" if exactly zero, ".xx" if < 1, otherwise show with leading digit
-                    if precip_val == 0:
-                        label = "0"
-                    elif precip_val < 1:
-                        label = f".{int(round(precip_val * 100)):02d}"
-                    else:
-                        label = f"{precip_val:.2f}"
-                    ax.text(
-                        lon, lat, label,
-                        color='black', fontsize=4, fontweight='bold',
-                        ha='center', va='center', transform=ccrs.PlateCarree(),
-                        zorder=10
-                    )
+        label_grid = gfs_labels.label_grid(region.lats, region.lons, [extent_left, extent_right, extent_bottom, extent_top], 2)
+        gfs_labels.draw(ax, label_grid, data2d, gfs_labels.hundredths, fontsize=4, transform=ccrs.PlateCarree())
     else:
         leaflet_extent = [extent_left, extent_right, extent_bottom, extent_top]
         mesh = ax.imshow(
@@ -210,37 +146,38 @@ def generate_clean_png(file_path, step):
         )
         # No grid overlay for imshow fallback
 
-    # --- Add colorbar below plot ---
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0.08)  # Increase bottom margin for colorbar
-    # Select fewer ticks for readability
-    tick_indices = list(range(0, len(precip_breaks), 2))  # Show every other tick
-    ticks_to_show = [precip_breaks[i] for i in tick_indices]
-    cbar = plt.colorbar(
-        mesh, ax=ax, orientation='horizontal',
-        pad=0.08, aspect=35, shrink=0.85, fraction=0.08,
-        anchor=(0.5, 0.0), location='bottom',
-        ticks=ticks_to_show, boundaries=precip_breaks
-    )
-    cbar.set_label("Precipitation (inches)", fontsize=12)
-    cbar.ax.tick_params(labelsize=10)
-    cbar.ax.set_facecolor('white')
-    cbar.outline.set_edgecolor('black')
-    # Rotate tick labels for readability
-    for label in cbar.ax.get_xticklabels():
-        label.set_rotation(45)
-        label.set_ha('right')
-
-    # Add ADKWX.com to bottom right
-    fig.text(
-        0.99, 0.01, "",
-        fontsize=10, color="black", ha="right", va="bottom",
-        alpha=0.7, fontweight="bold"
-    )
+    if frame.first:
+        # --- Add colorbar below plot ---
+        plt.subplots_adjust(left=0, right=1, top=1, bottom=0.08)  # Increase bottom margin for colorbar
+        # Select fewer ticks for readability
+        tick_indices = list(range(0, len(precip_breaks), 2))  # Show every other tick
+        ticks_to_show = [precip_breaks[i] for i in tick_indices]
+        cbar = plt.colorbar(
+            mesh, ax=ax, orientation='horizontal',
+            pad=0.08, aspect=35, shrink=0.85, fraction=0.08,
+            anchor=(0.5, 0.0), location='bottom',
+            ticks=ticks_to_show, boundaries=precip_breaks
+        )
+        cbar.set_label("Precipitation (inches)", fontsize=12)
+        cbar.ax.tick_params(labelsize=10)
+        cbar.ax.set_facecolor('white')
+        cbar.outline.set_edgecolor('black')
+        # Rotate tick labels for readability
+        for label in cbar.ax.get_xticklabels():
+            label.set_rotation(45)
+            label.set_ha('right')
+
+        # Add ADKWX.com to bottom right
+        fig.text(
+            0.99, 0.01, "",
+            fontsize=10, color="black", ha="right", va="bottom",
+            alpha=0.7, fontweight="bold"
+        )
+
+        ax.set_axis_off()
 
-    ax.set_axis_off()
     png_path = os.path.join(png_dir, f"precip6_{step:03d}.png")
-    plt.savefig(png_path, bbox_inches='tight', pad_inches=0, transparent=True, dpi=600, facecolor='white')
-    plt.close(fig)
+    frame.save(png_path, pad_inches=0, palette=png_palette, transparent=True, dpi=600, facecolor='white')
     print(f"Generated clean PNG: {png_path}")
     return png_path
 
@@ -248,20 +185,7 @@ def generate_clean_png(file_path, step):
 northeast_precip_dir = os.path.join(BASE_DIR, "GFS", "static", "northeast_precip_pngs")
 os.makedirs(northeast_precip_dir, exist_ok=True)
 
-def generate_northeast_precip_png(file_path, step):
-    ds = xr.open_dataset(file_path, engine="cfgrib")
-    apcp_mm = ds['tp'].values
-    apcp_in = apcp_mm / 25.4
-    apcp_in = np.where(
-        (np.isnan(apcp_in)) | (apcp_in < 0) | (apcp_in > 50),
-        np.nan,
-        apcp_in
-    )
-    fig = plt.figure(figsize=(10, 7), dpi=600, facecolor='white')
-    ax = plt.axes(projection=ccrs.PlateCarree(), facecolor='white')
-    extent = [-82, -66, 38, 48]  # Northeast US
-    ax.set_extent(extent, crs=ccrs.PlateCarree())
-
+def add_northeast_overlays(ax):
     # Always try to plot counties in the Northeast
     import cartopy.io.shapereader as shapereader
     county_shp = "https://www2.census.gov/geo/tiger/GENZ2018/shp/cb_2018_us_county_20m.zip"
@@ -279,14 +203,12 @@ def generate_northeast_precip_png(file_path, step):
     except Exception as e:
         print(f"Could not load primary roads shapefile: {e}")
 
-    # Basemap features
-    ax.add_feature(cfeature.LAND, facecolor='lightgray')
-    ax.add_feature(cfeature.OCEAN, facecolor='white')
-    ax.add_feature(cfeature.COASTLINE, linewidth=0.7)
-    ax.add_feature(cfeature.BORDERS, linewidth=0.5)
-    ax.add_feature(cfeature.STATES, linewidth=0.3)
-    ax.add_feature(cfeature.RIVERS, linewidth=0.4, edgecolor='blue')
-    ax.add_feature(cfeature.LAKES, facecolor='lightblue', edgecolor='blue', linewidth=0.3)
+def generate_northeast_precip_png(bundle):
+    step = bundle.step
+    apcp_in = bundle.fields["apcp_in"]
+    extent = [-82, -66, 38, 48]  # Northeast US
+    frame = gfs_frame.frame("precip6_northeast", extent, overlay=add_northeast_overlays)
+    fig, ax = frame.begin()
 
     # Title block (same logic as USA)
     run_hour_map = {
@@ -308,48 +230,22 @@ def generate_northeast_precip_png(file_path, step):
     plt.title(title_str, fontsize=12, fontweight='bold', y=1.03)
 
     # Plot precipitation
-    if 'latitude' in ds and 'longitude' in ds:
-        lats = ds['latitude'].values
-        lons = ds['longitude'].values
-        lons_plot = np.where(lons > 180, lons - 360, lons)
-        if lats.ndim == 1 and lons.ndim == 1:
-            Lon2d, Lat2d = np.meshgrid(lons_plot, lats)
-            data2d = apcp_in.squeeze()
-        else:
-            Lon2d, Lat2d = lons_plot, lats
-            data2d = apcp_in.squeeze()
-        mask_extent = (
-            (Lat2d >= extent[2]) & (Lat2d <= extent[3]) &
-            (Lon2d >= extent[0]) & (Lon2d <= extent[1])
-        )
-        data2d = np.where(mask_extent, data2d, np.nan)
-        mesh = ax.contourf(
-            Lon2d, Lat2d, data2d,
+    if bundle.lats is not None and bundle.lons is not None:
+        lats = bundle.lats
+        lons = bundle.lons
+        region = gfs_grid.geometry(lats, lons).region(extent)
+        data2d = region.crop(apcp_in.squeeze())
+        mesh = gfs_raster.contourf(
+            ax, region, data2d,
             levels=precip_breaks,
             cmap=precip_cmap,
             norm=precip_norm,
             extend='max',
-            transform=ccrs.PlateCarree()
+            raster=RASTER
         )
         # Add 0.5-degree grid with precip numbers
-        for lat in np.arange(extent[2], extent[3] + 0.01, 0.5):
-            for lon in np.arange(extent[0], extent[1] + 0.01, 0.5):
-                iy = np.abs(lats - lat).argmin() if lats.ndim == 1 else np.abs(lats[:,0] - lat).argmin()
-                ix = np.abs(lons_plot - lon).argmin() if lons_plot.ndim == 1 else np.abs(lons_plot[0,:] - lon).argmin()
-                precip_val = data2d[iy, ix]
-                if not np.isnan(precip_val):
-                    if precip_val == 0:
-                        label = "0"
-                    elif precip_val < 1:
-                        label = f".{int(round(precip_val * 100)):02d}"
-                    else:
-                        label = f"{precip_val:.2f}"
-                    ax.text(
-                        lon, lat, label,
-                        color='black', fontsize=6, fontweight='bold',
-                        ha='center', va='center', transform=ccrs.PlateCarree(),
-                        zorder=10
-                    )
+        label_grid = gfs_labels.label_grid(region.lats, region.lons, extent, 0.5)
+        gfs_labels.draw(ax, label_grid, data2d, gfs_labels.hundredths, fontsize=6, transform=ccrs.PlateCarree())
     else:
         leaflet_extent = extent
         mesh = ax.imshow(
@@ -363,35 +259,36 @@ def generate_northeast_precip_png(file_path, step):
             transform=ccrs.PlateCarree()
         )
 
-    # Colorbar
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0.01)
-    tick_indices = list(range(0, len(precip_breaks), 2))
-    ticks_to_show = [precip_breaks[i] for i in tick_indices]
-    cbar = plt.colorbar(
-        mesh, ax=ax, orientation='horizontal',
-        pad=0.01, aspect=25, shrink=0.65, fraction=0.035,
-        anchor=(0.5, 0.0), location='bottom',
-        ticks=ticks_to_show, boundaries=precip_breaks
-    )
-    cbar.set_label("Precipitation (inches)", fontsize=8)
-    cbar.ax.tick_params(labelsize=7)
-    cbar.ax.set_facecolor('white')
-    cbar.outline.set_edgecolor('black')
-    for label in cbar.ax.get_xticklabels():
-        label.set_rotation(45)
-        label.set_ha('right')
-
-    # Add ADKWX.com to bottom right
-    fig.text(
-        0.99, 0.01, "",
-        fontsize=10, color="black", ha="right", va="bottom",
-        alpha=0.7, fontweight="bold"
-    )
+    if frame.first:
+        # Colorbar
+        plt.subplots_adjust(left=0, right=1, top=1, bottom=0.01)
+        tick_indices = list(range(0, len(precip_breaks), 2))
+        ticks_to_show = [precip_breaks[i] for i in tick_indices]
+        cbar = plt.colorbar(
+            mesh, ax=ax, orientation='horizontal',
+            pad=0.01, aspect=25, shrink=0.65, fraction=0.035,
+            anchor=(0.5, 0.0), location='bottom',
+            ticks=ticks_to_show, boundaries=precip_breaks
+        )
+        cbar.set_label("Precipitation (inches)", fontsize=8)
+        cbar.ax.tick_params(labelsize=7)
+        cbar.ax.set_facecolor('white')
+        cbar.outline.set_edgecolor('black')
+        for label in cbar.ax.get_xticklabels():
+            label.set_rotation(45)
+            label.set_ha('right')
+
+        # Add ADKWX.com to bottom right
+        fig.text(
+            0.99, 0.01, "",
+            fontsize=10, color="black", ha="right", va="bottom",
+            alpha=0.7, fontweight="bold"
+        )
+
+        ax.set_axis_off()
 
-    ax.set_axis_off()
     png_path = os.path.join(northeast_precip_dir, f"northeast_precip_{step:03d}.png")
-    plt.savefig(png_path, bbox_inches='tight', pad_inches=0, transparent=True, dpi=600, facecolor='white')
-    plt.close(fig)
+    frame.save(png_path, pad_inches=0, palette=png_palette, transparent=True, dpi=600, facecolor='white')
     print(f"Generated Northeast Precip PNG: {png_path}")
     return png_path
 
@@ -399,41 +296,14 @@ def generate_northeast_precip_png(file_path, step):
 forecast_steps = list(range(6, 385, 6))
 if 264 not in forecast_steps:
     forecast_steps.append(264)
-for step in forecast_steps:
-    grib_file = download_file(hour_str, step)
-    if grib_file:
-        generate_clean_png(grib_file, step)
-        generate_northeast_precip_png(grib_file, step)
-        gc.collect()
-        time.sleep(1)
+with gfs_render.Renderer(frames=2) as render:
+    for step, grib_file in gfs_ingest.prefetch(forecast_steps, lambda s: download_file(hour_str, s)):
+        if grib_file:
+            bundle = load_step(grib_file, step)
+            render.submit(generate_clean_png, bundle)
+            render.submit(generate_northeast_precip_png, bundle)
 
 print("All GRIB file download and PNG creation tasks complete!")
 
-# --- Delete all GRIB files in grib_dir after PNGs are made ---
-for f in os.listdir(grib_dir):
-    file_path = os.path.join(grib_dir, f)
-    if os.path.isfile(file_path):
-        os.remove(file_path)
-print("All GRIB files deleted from grib_dir.")
-
-# --- Optimize all PNGs in the output directory ---
-def optimize_png(filepath):
-    try:
-        with Image.open(filepath) as img:
-            img = img.convert('P', palette=Image.ADAPTIVE, colors=256)
-            img.save(filepath, optimize=True)
-            print(f"Optimized PNG: {filepath}")
-    except Exception as e:
-        print(f"Failed to optimize {filepath}: {e}")
-
-for f in os.listdir(png_dir):
-    if f.lower().endswith('.png'):
-        optimize_png(os.path.join(png_dir, f))
-for f in os.listdir(northeast_precip_dir):
-    if f.lower().endswith('.png'):
-        optimize_png(os.path.join(northeast_precip_dir, f))
-
-print("All PNGs optimized.")
-
-print("All PNGs optimized.")
-
+# --- Prune old cycles from the shared GRIB cache ---
+gfs_ingest.prune_cycles(date_str, hour_str)
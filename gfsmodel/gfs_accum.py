@@ -0,0 +1,125 @@
+from collections import namedtuple
+import numpy as np
+import gfs_arrays
+import gfs_cube
+
+# Accumulation engine for bucketed GFS fields (APCP).
+#
+# Run totals since f000 are built once per cycle from the cycle cube:
+# total(step) = total(bucket start) + bucket, which covers the 6-hour buckets as well as
+# overlapping 0-3/0-6 style ones.  Any window (6h, 12h, 24h, 72h, run total) is then one
+# subtraction of two run totals, with no extra I/O.  A missing bucket leaves a gap (no
+# precipitation) in the run totals after it instead of ending them (total precipitation
+# goes on); a window is None unless all of its buckets are there, or with complete=False
+# the sum of the buckets it has:
+#
+#   accum = gfs_accum.run_totals(gfs_ingest.cube(date_str, hour_str, "apcp", "apcp"), steps)
+#   last_24h_mm = gfs_accum.window(accum, step - 24, step)
+
+# totals maps forecast hour -> float32 run total (lat, lon); cube is the APCP cube
+Accumulation = namedtuple("Accumulation", "totals lats lons cube")
+
+# Buckets above this (mm) are random data beams, not precipitation
+MAX_BUCKET_MM = 50 * 25.4
+
+
+def clean_bucket(bucket, out=None):
+    # Missing points and bad values add nothing to the totals
+    out = gfs_arrays.scale(bucket, 1, out=out)
+    return gfs_arrays.mask_outside(out, 0, MAX_BUCKET_MM, fill=0)
+
+
+def new(cube):
+    return Accumulation({0: np.zeros(cube.values.shape[1:], dtype=np.float32)}, cube.lats, cube.lons, cube)
+
+
+def extend(accum, cube, step):
+    """Add forecast hour step to accum; False if its bucket is missing.
+
+    If the bucket start has no run total (an earlier bucket is missing), the chain restarts
+    from the last run total before it plus whatever buckets are there, and the gap is logged.
+    """
+    if step in accum.totals:
+        return True
+    bucket = gfs_cube.step_values(cube, step)
+    if bucket is None:
+        return False
+    start = int(cube.starts[gfs_cube.STEP_SLOTS[step]])
+    if start == step:
+        return False
+    if start not in accum.totals and not extend(accum, cube, start):
+        last = max(hour for hour in accum.totals if hour < start)
+        print(f"Warning: APCP missing between forecast hours {last} and {start}; "
+              f"run totals from f{step:03d} on leave it out")
+        start = last
+    total = clean_bucket(bucket)
+    total += accum.totals[start]
+    accum.totals[step] = total
+    return True
+
+
+def run_totals(cube, steps):
+    accum = new(cube)
+    for step in sorted(steps):
+        extend(accum, cube, step)
+    return accum
+
+
+def window(accum, start, end, out=None, complete=True):
+    """Total over forecast hours (start, end] (into out when given), or None.
+
+    By default None unless every bucket of the window was fetched.  complete=False (run
+    totals that carry on past gaps) gives the buckets there are, or None if there are none.
+    """
+    if accum is None:
+        return None
+    if complete:
+        chain = _chain(accum.cube, start, end)
+        if chain is None:
+            return None
+        if start not in accum.totals or end not in accum.totals:
+            total = np.zeros_like(accum.totals[0]) if out is None else out
+            total[...] = 0
+            for step in chain:
+                total += clean_bucket(gfs_cube.step_values(accum.cube, step))
+            return total
+    elif start not in accum.totals or end not in accum.totals:
+        return _bucket_sum(accum, start, end, out=out)
+    return np.subtract(accum.totals[end], accum.totals[start], out=out)
+
+
+def _chain(cube, start, end):
+    # Steps whose buckets tile (start, end] exactly, walking back from end; None on a gap
+    chain = []
+    hour = end
+    while hour > start:
+        if gfs_cube.step_values(cube, hour) is None:
+            return None
+        bucket_start = int(cube.starts[gfs_cube.STEP_SLOTS[hour]])
+        if bucket_start < start or bucket_start == hour:
+            return None
+        chain.append(hour)
+        hour = bucket_start
+    return chain
+
+
+def _bucket_sum(accum, start, end, out=None):
+    # Walk back from end over the buckets that fit in (start, end]
+    total = np.zeros_like(accum.totals[0]) if out is None else out
+    total[...] = 0
+    hour, found, gap = end, False, False
+    for step in reversed(gfs_cube.STEPS):
+        bucket = gfs_cube.step_values(accum.cube, step)
+        if step > hour or step <= start or bucket is None:
+            continue
+        bucket_start = int(accum.cube.starts[gfs_cube.STEP_SLOTS[step]])
+        if bucket_start < start or bucket_start == step:
+            continue
+        total += clean_bucket(bucket)
+        gap = gap or step != hour
+        hour, found = bucket_start, True
+    if not found:
+        return None
+    if gap or hour > start:
+        print(f"Warning: APCP incomplete for forecast hours {start}-{end}; summing the buckets there are")
+    return total
@@ -0,0 +1,57 @@
+import threading
+import numpy as np
+
+# Float32 field math for the products: unit conversion, QC masking and accumulation done
+# in place with out= buffers, plus per-thread work arrays reused across forecast steps.
+#
+# Decoded fields are read-only float32 memmaps, so the first operation on one writes into
+# a fresh (or work) array and everything after that modifies it in place:
+#
+#   apcp_in = gfs_arrays.scale(apcp_mm, 1 / 25.4)
+#   gfs_arrays.mask_outside(apcp_in, 0, 50)
+
+_local = threading.local()
+
+
+def work(name, shape, dtype=np.float32):
+    """This thread's reusable array for name and shape; its contents are left over."""
+    buffers = _local.__dict__.setdefault("buffers", {})
+    key = (name, tuple(shape), np.dtype(dtype))
+    if key not in buffers:
+        buffers[key] = np.empty(shape, dtype=dtype)
+    return buffers[key]
+
+
+def scale(values, factor, offset=0.0, out=None):
+    """values * factor + offset as float32 (into out when given)."""
+    out = np.multiply(values, np.float32(factor), out=out, dtype=np.float32, casting="unsafe")
+    if offset:
+        out += np.float32(offset)
+    return out
+
+
+def mask_outside(a, low, high, fill=np.nan):
+    """Set NaNs and values outside [low, high] to fill, in place; returns a."""
+    keep = work("mask_keep", a.shape, bool)
+    upper = work("mask_upper", a.shape, bool)
+    with np.errstate(invalid="ignore"):
+        np.greater_equal(a, low, out=keep)
+        np.less_equal(a, high, out=upper)
+    keep &= upper
+    np.logical_not(keep, out=keep)
+    np.copyto(a, fill, where=keep)
+    return a
+
+
+def fill_nan(a, value=0.0):
+    """Replace NaNs with value in place; returns a."""
+    nan = work("nan", a.shape, bool)
+    np.isnan(a, out=nan)
+    np.copyto(a, value, where=nan)
+    return a
+
+
+def positive_increment(current, previous, out=None):
+    """current - previous where it is positive, 0 elsewhere (NaN on either side counts as 0)."""
+    out = np.subtract(current, previous, out=out, dtype=np.float32, casting="unsafe")
+    return np.fmax(out, np.float32(0), out=out)
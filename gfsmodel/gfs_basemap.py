@@ -0,0 +1,121 @@
+import hashlib
+import os
+import numpy as np
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+from filelock import FileLock
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+import gfs_ingest
+
+# Pre-rendered basemaps (land, ocean, coastlines, borders, states, rivers, lakes).
+#
+# Cartopy clips and projects the Natural Earth geometry again for every frame it draws.
+# Instead, each (extent, projection, figure size, dpi, style) basemap is drawn once into
+# PNGs under BASEMAP_DIR, kept for the life of the deployment, and every frame shows them
+# as images.  Features keep their cartopy stacking: land and ocean (zorder -1) go in one
+# image under the data, the lines and lakes (FeatureArtist's 1.5) in a transparent one
+# over filled contours and under contour lines and text.
+#
+#   ax.set_extent(extent, crs=ccrs.PlateCarree())
+#   gfs_basemap.draw(ax, extent)
+#   gfs_basemap.draw(ax, extent, gfs_basemap.style(omit=("RIVERS", "LAKES")))
+
+BASEMAP_DIR = os.environ.get("GFS_BASEMAP_DIR", os.path.join(gfs_ingest.BASE_DIR, "GFS", "basemaps"))
+
+# Bump to re-render every cached basemap (e.g. after changing how they are drawn)
+VERSION = 1
+
+# The map features every product draws, bottom to top, as (cartopy.feature name, kwargs)
+STANDARD = (
+    ("LAND", {"facecolor": "lightgray"}),
+    ("OCEAN", {"facecolor": "white"}),
+    ("COASTLINE", {"linewidth": 0.7}),
+    ("BORDERS", {"linewidth": 0.5}),
+    ("STATES", {"linewidth": 0.3}),
+    ("RIVERS", {"linewidth": 0.4, "edgecolor": "blue"}),
+    ("LAKES", {"facecolor": "lightblue", "edgecolor": "blue", "linewidth": 0.3}),
+)
+
+# FeatureArtist's zorder for features that do not set one
+FEATURE_ZORDER = 1.5
+
+_rasters = {}
+
+
+def style(omit=(), **overrides):
+    """STANDARD without the omitted features, with some features' kwargs replaced."""
+    return tuple((name, overrides.get(name, kwargs)) for name, kwargs in STANDARD if name not in omit)
+
+
+def _path(key):
+    extent, _, figsize, dpi, _ = key
+    digest = hashlib.sha1(repr((VERSION, key)).encode()).hexdigest()[:12]
+    name = "_".join(f"{v:g}" for v in extent)
+    return os.path.join(BASEMAP_DIR, f"{name}_{figsize[0]:g}x{figsize[1]:g}_{dpi:g}dpi_{digest}.png")
+
+
+def _render(extent, projection, figsize, dpi, features, path):
+    # The basemap alone, filling a figure as wide as the product's and as tall as the map
+    fig = Figure(dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1], projection=projection)
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+    x0, x1, y0, y1 = ax.get_extent()
+    fig.set_size_inches(figsize[0], figsize[0] * (y1 - y0) / (x1 - x0))
+    for name, kwargs in features:
+        ax.add_feature(getattr(cfeature, name), **kwargs)
+    ax.set_axis_off()
+    fig.patch.set_alpha(0)
+    ax.patch.set_alpha(0)
+    fig.canvas.draw()
+    os.makedirs(BASEMAP_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.part"
+    Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).save(tmp_path, format="PNG")
+    os.replace(tmp_path, path)
+    print(f"Rendered basemap {path}")
+
+
+def raster(extent, projection, figsize, dpi, features=STANDARD):
+    """RGBA array of the basemap, rendered on first use and cached on disk and in memory."""
+    key = (tuple(float(v) for v in extent), projection.proj4_init,
+           tuple(float(v) for v in figsize), float(dpi), repr(features))
+    if key not in _rasters:
+        path = _path(key)
+        # One process renders a missing basemap; the others wait and read it
+        with FileLock(path + ".lock"):
+            if not os.path.exists(path):
+                _render(extent, projection, figsize, dpi, features, path)
+        with Image.open(path) as img:
+            _rasters[key] = np.asarray(img.convert("RGBA"))
+    return _rasters[key]
+
+
+def release():
+    """Drop the in-memory basemap rasters (the disk cache stays)."""
+    _rasters.clear()
+
+
+def layers(features):
+    """features grouped by the zorder cartopy would draw them at, lowest first."""
+    groups = {}
+    for name, kwargs in features:
+        zorder = kwargs.get("zorder", getattr(cfeature, name).kwargs.get("zorder", FEATURE_ZORDER))
+        groups.setdefault(zorder, []).append((name, kwargs))
+    return [(zorder, tuple(groups[zorder])) for zorder in sorted(groups)]
+
+
+def draw(ax, extent, features=STANDARD):
+    """Show the cached basemap of extent on GeoAxes ax; returns its images."""
+    fig = ax.figure
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+    map_extent = ax.get_extent()
+    images = []
+    for zorder, layer in layers(features):
+        img = raster(extent, ax.projection, fig.get_size_inches(), fig.dpi, layer)
+        images.append(ax.imshow(img, extent=map_extent, transform=ax.projection, origin="upper",
+                                zorder=zorder, interpolation="antialiased"))
+    # imshow may move the limits; keep the map exactly on extent
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+    return images
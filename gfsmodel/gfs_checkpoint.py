@@ -0,0 +1,34 @@
+import os
+import numpy as np
+
+# Resumable accumulation state for products that sum over the run (total precip, snow
+# depth, total snowfall).  After each rendered forecast hour a product saves its running
+# total (one float32 array) together with that hour in <name>.npz; a restarted run of the
+# same cycle loads it and carries on from the next hour instead of starting at f000.
+
+
+def _path(checkpoint_dir, name):
+    return os.path.join(checkpoint_dir, name + ".npz")
+
+
+def save(checkpoint_dir, name, step, values):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = _path(checkpoint_dir, name)
+    # One file replaced atomically, so the step and the array always match
+    tmp_path = f"{path}.{os.getpid()}.part"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, step=step, values=np.asarray(values, dtype=np.float32))
+    os.replace(tmp_path, path)
+
+
+def load(checkpoint_dir, name):
+    """(last completed step, running total) of checkpoint name, or (None, None)."""
+    path = _path(checkpoint_dir, name)
+    if not os.path.exists(path):
+        return None, None
+    try:
+        with np.load(path) as data:
+            return int(data["step"]), data["values"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Ignoring unreadable checkpoint {path}: {e}")
+        return None, None
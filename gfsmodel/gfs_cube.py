@@ -0,0 +1,87 @@
+import json
+import os
+from collections import namedtuple
+import numpy as np
+from filelock import FileLock
+
+# Per-cycle data cubes: each field products sum over the run (gfs_ingest.CUBE_VARS) is
+# appended, one forecast hour at a time, to a (step, lat, lon) float32 array for its
+# cycle.  Each step is one contiguous slab of a memory-mapped .npy, so hours are written
+# as they arrive (from any process) and readers open the cube lazily and slice time
+# ranges without decoding anything.
+#
+#   <name>.npy        values; a slab is only meaningful once its start hour is set
+#   <name>.start.npy  accumulation start hour of each step (the step itself for instant
+#                     fields), -1 = not written yet
+#   <name>.json       grid, units and step type
+
+# Forecast hours of a GFS run at the spacing the products use
+STEPS = list(range(0, 385, 3))
+STEP_SLOTS = {step: i for i, step in enumerate(STEPS)}
+
+Cube = namedtuple("Cube", "steps starts values lats lons units step_type")
+
+
+def _create(base, field):
+    with FileLock(base + ".lock"):
+        if os.path.exists(base + ".json"):
+            return
+        shape = (len(STEPS),) + field.values.shape
+        # Unwritten slabs stay sparse on disk; starts tells readers which steps exist
+        values = np.lib.format.open_memmap(base + ".npy", mode="w+", dtype=np.float32, shape=shape)
+        del values
+        starts = np.lib.format.open_memmap(base + ".start.npy", mode="w+", dtype=np.int16, shape=(len(STEPS),))
+        starts[:] = -1
+        starts.flush()
+        del starts
+        # The header marks the cube ready (append, open_cube), so it appears whole
+        tmp_path = base + ".json.part"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "var": field.var, "level": field.level, "units": field.units,
+                "step_type": field.step_type,
+                "lats": [field.lats[0], field.lats[-1], len(field.lats)],
+                "lons": [field.lons[0], field.lons[-1], len(field.lons)],
+            }, f)
+        os.replace(tmp_path, base + ".json")
+
+
+def append(cube_dir, name, step, field):
+    """Write field as forecast hour step of cube name; steps already written are kept."""
+    if step not in STEP_SLOTS:
+        return
+    os.makedirs(cube_dir, exist_ok=True)
+    base = os.path.join(cube_dir, name)
+    if not os.path.exists(base + ".json"):
+        _create(base, field)
+    i = STEP_SLOTS[step]
+    starts = np.load(base + ".start.npy", mmap_mode="r+")
+    if starts[i] >= 0:
+        return
+    values = np.load(base + ".npy", mmap_mode="r+")
+    values[i] = field.values
+    values.flush()
+    # Publish the step only after its data is on disk
+    starts[i] = field.start_step
+    starts.flush()
+
+
+def open_cube(cube_dir, name):
+    """Open cube name lazily (memory-mapped, read-only), or None if nothing was written yet."""
+    base = os.path.join(cube_dir, name)
+    if not os.path.exists(base + ".json"):
+        return None
+    with open(base + ".json") as f:
+        header = json.load(f)
+    return Cube(STEPS,
+                np.load(base + ".start.npy", mmap_mode="r"),
+                np.load(base + ".npy", mmap_mode="r"),
+                np.linspace(*header["lats"]), np.linspace(*header["lons"]),
+                header["units"], header["step_type"])
+
+
+def step_values(cube, step):
+    """The (lat, lon) slab of forecast hour step, or None if it has not been written."""
+    if cube is None or step not in STEP_SLOTS or cube.starts[STEP_SLOTS[step]] < 0:
+        return None
+    return cube.values[STEP_SLOTS[step]]
@@ -0,0 +1,257 @@
+import json
+import os
+import struct
+from collections import namedtuple
+from datetime import datetime
+import numpy as np
+import eccodes
+
+# In-memory GRIB2 decoding for the gfsmodel products.
+#
+# Messages are framed straight from bytes (a cached file or HTTP response chunks as they
+# arrive), identified from section 4 without decoding, and only the wanted ones are
+# handed to eccodes.  No cfgrib .idx sidecar files, no xarray datasets.
+#
+# Decoded fields are stored once as float32 .npy files next to the GRIB file they came
+# from (the shared ingest cache), so every later reader, in any product, memory-maps them
+# instead of decoding again.
+#
+# load_bundle decodes a whole forecast hour once for every region a product renders.
+
+# One decoded GRIB2 message.  values is (lat, lon) with NaN for masked points; lats and
+# lons are 1-D like cfgrib's latitude/longitude coordinates (lats north to south for GFS,
+# lons in 0..360).  start_step/end_step are forecast hours (equal for instant fields).
+Field = namedtuple("Field", "var level step_type start_step end_step values lats lons units valid_time")
+
+# GRIB2 (discipline, category, number) -> NOMADS variable name
+GRIB_PARAMS = {
+    (0, 0, 0): "TMP",
+    (0, 1, 1): "RH",
+    (0, 1, 7): "PRATE",
+    (0, 1, 8): "APCP",
+    (0, 1, 11): "SNOD",
+    (0, 1, 13): "WEASD",
+    (0, 1, 192): "CRAIN",
+    (0, 1, 193): "CFRZR",
+    (0, 1, 194): "CICEP",
+    (0, 1, 195): "CSNOW",
+    (0, 2, 2): "UGRD",
+    (0, 2, 3): "VGRD",
+    (0, 2, 9): "DZDT",
+    (0, 2, 10): "ABSV",
+    (0, 2, 22): "GUST",
+    (0, 3, 5): "HGT",
+    (0, 3, 192): "MSLET",
+    (0, 6, 1): "TCDC",
+    (0, 6, 201): "SUNSD",
+    (0, 7, 192): "LFTX",
+}
+
+
+def _level_name(surface_type, scale, value):
+    if scale & 0x80:
+        scale = -(scale & 0x7f)
+    value = value * 10 ** (-scale) if scale != 255 else value
+    if surface_type == 1:
+        return "surface"
+    if surface_type == 101:
+        return "mean_sea_level"
+    if surface_type == 100:
+        return f"{int(round(value / 100))}_mb"
+    if surface_type == 103:
+        return f"{int(round(value))}_m_above_ground"
+    if surface_type == 10:
+        return "entire_atmosphere"
+    return f"level{surface_type}_{value:g}"
+
+
+def identify(msg):
+    # (NOMADS variable, NOMADS level) of one GRIB2 message, read from section 4
+    discipline = msg[6]
+    off = 16
+    while off + 5 <= len(msg) and msg[off:off + 4] != b"7777":
+        sec_len = struct.unpack(">I", msg[off:off + 4])[0]
+        if msg[off + 4] == 4:
+            category = msg[off + 9]
+            number = msg[off + 10]
+            surface_type = msg[off + 22]
+            scale = msg[off + 23]
+            value = struct.unpack(">I", msg[off + 24:off + 28])[0]
+            return GRIB_PARAMS.get((discipline, category, number)), _level_name(surface_type, scale, value)
+        off += sec_len
+    return None, None
+
+
+def iter_messages(chunks):
+    """Yield complete GRIB2 messages from an iterable of byte chunks as soon as each one is whole."""
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while True:
+            start = buf.find(b"GRIB")
+            if start < 0:
+                # Keep a possible partial "GRIB" marker at the end
+                del buf[:max(0, len(buf) - 3)]
+                break
+            if start + 16 > len(buf):
+                del buf[:start]
+                break
+            if buf[start + 7] != 2:
+                del buf[:start + 4]
+                continue
+            total = struct.unpack(">Q", bytes(buf[start + 8:start + 16]))[0]
+            if start + total > len(buf):
+                del buf[:start]
+                break
+            yield bytes(buf[start:start + total])
+            del buf[:start + total]
+
+
+def _axis(first, last, count, negative):
+    if count == 1:
+        return np.array([first])
+    if negative and last > first:
+        last -= 360.0
+    elif not negative and last < first:
+        last += 360.0
+    return np.linspace(first, last, count)
+
+
+def decode_message(msg, var=None, level=None):
+    """Decode one GRIB2 message on a regular lat/lon grid into a Field."""
+    if var is None:
+        var, level = identify(msg)
+    gid = eccodes.codes_new_from_message(msg)
+    try:
+        ni = eccodes.codes_get(gid, "Ni")
+        nj = eccodes.codes_get(gid, "Nj")
+        values = eccodes.codes_get_values(gid).reshape(nj, ni)
+        if eccodes.codes_get(gid, "bitmapPresent"):
+            values[values == eccodes.codes_get(gid, "missingValue")] = np.nan
+        lats = _axis(eccodes.codes_get(gid, "latitudeOfFirstGridPointInDegrees"),
+                     eccodes.codes_get(gid, "latitudeOfLastGridPointInDegrees"), nj,
+                     not eccodes.codes_get(gid, "jScansPositively"))
+        lons = _axis(eccodes.codes_get(gid, "longitudeOfFirstGridPointInDegrees"),
+                     eccodes.codes_get(gid, "longitudeOfLastGridPointInDegrees"), ni,
+                     eccodes.codes_get(gid, "iScansNegatively"))
+        return Field(var, level,
+                     eccodes.codes_get(gid, "stepType"),
+                     eccodes.codes_get(gid, "startStep"),
+                     eccodes.codes_get(gid, "endStep"),
+                     values, lats, lons,
+                     eccodes.codes_get(gid, "units"),
+                     datetime.strptime(f"{eccodes.codes_get(gid, 'validityDate')}"
+                                       f"{eccodes.codes_get(gid, 'validityTime'):04d}", "%Y%m%d%H%M"))
+    finally:
+        eccodes.codes_release(gid)
+
+
+def decode_stream(chunks, var=None, level=None, step_type=None):
+    """Decode the wanted messages of a GRIB2 byte stream while it is still arriving."""
+    for msg in iter_messages(chunks):
+        msg_var, msg_level = identify(msg)
+        if (var is None or msg_var == var) and (level is None or msg_level == level):
+            field = decode_message(msg, msg_var, msg_level)
+            if step_type is None or field.step_type == step_type:
+                yield field
+
+
+def _read_chunks(paths, chunk_size=1024 * 1024):
+    for path in [paths] if isinstance(paths, str) else paths:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+# --- Decoded-field store ---
+
+def _store_index(path):
+    return path + ".fields.json"
+
+
+def _store_array(path, i):
+    return f"{path}.{i}.npy"
+
+
+def _write_store(path):
+    # Decode every message of path once; arrays first, the header last marks it complete
+    headers = []
+    for i, field in enumerate(decode_stream(_read_chunks(path))):
+        tmp_path = f"{_store_array(path, i)}.{os.getpid()}.part"
+        with open(tmp_path, "wb") as f:
+            np.save(f, field.values.astype(np.float32))
+        os.replace(tmp_path, _store_array(path, i))
+        headers.append({
+            "var": field.var, "level": field.level, "step_type": field.step_type,
+            "start_step": field.start_step, "end_step": field.end_step, "units": field.units,
+            "valid_time": field.valid_time.isoformat(),
+            "lats": [field.lats[0], field.lats[-1], len(field.lats)],
+            "lons": [field.lons[0], field.lons[-1], len(field.lons)],
+        })
+    tmp_path = f"{_store_index(path)}.{os.getpid()}.part"
+    with open(tmp_path, "w") as f:
+        json.dump(headers, f)
+    os.replace(tmp_path, _store_index(path))
+    return headers
+
+
+def _stored_headers(path):
+    index = _store_index(path)
+    if os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(path):
+        with open(index) as f:
+            return json.load(f)
+    return _write_store(path)
+
+
+def read(paths, var=None, level=None, step_type=None):
+    """The matching fields of one GRIB2 file (or a list of files), memory-mapped from the store."""
+    fields = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        try:
+            headers = _stored_headers(path)
+        except OSError as e:
+            print(f"Could not use the decoded-field store for {path}: {e}")
+            fields.extend(decode_stream(_read_chunks(path), var, level, step_type))
+            continue
+        for i, h in enumerate(headers):
+            if ((var is None or h["var"] == var) and (level is None or h["level"] == level)
+                    and (step_type is None or h["step_type"] == step_type)):
+                fields.append(Field(h["var"], h["level"], h["step_type"], h["start_step"],
+                                    h["end_step"], np.load(_store_array(path, i), mmap_mode="r"),
+                                    np.linspace(*h["lats"]), np.linspace(*h["lons"]),
+                                    h["units"], datetime.fromisoformat(h["valid_time"])))
+    return fields
+
+
+def load(paths, var, level=None, step_type=None):
+    """The field var from paths, or None.  Accumulations prefer the shortest window (the bucket)."""
+    fields = read(paths, var, level, step_type)
+    if not fields:
+        return None
+    return min(fields, key=lambda f: f.end_step - f.start_step)
+
+
+# --- Per-step bundles ---
+
+# Everything a product draws for one forecast hour, decoded and normalised once and then
+# handed to every region renderer.  fields maps the product's names to arrays (None for
+# optional inputs that are missing); lats/lons come from the first source.
+Bundle = namedtuple("Bundle", "step lats lons fields")
+
+
+def load_bundle(step, sources):
+    """sources: {name: (paths, var, step_type, convert)}; convert normalises units/masks."""
+    fields = {}
+    lats = lons = None
+    for name, (paths, var, step_type, convert) in sources.items():
+        field = load(paths, var, step_type=step_type) if paths else None
+        if field is None:
+            fields[name] = None
+            continue
+        if lats is None:
+            lats, lons = field.lats, field.lons
+        fields[name] = convert(field.values) if convert else field.values
+    return Bundle(step, lats, lons, fields)
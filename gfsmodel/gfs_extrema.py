@@ -0,0 +1,106 @@
+from collections import namedtuple
+import numpy as np
+import scipy.ndimage as ndimage
+from scipy.spatial import cKDTree
+from matplotlib import patheffects as path_effects
+
+# High/low centre detection for any 2-D field and region (MSLP H/L on the maps).
+#
+# The field is cropped to the region once, local extrema come from one maximum_filter
+# pass (lows are found as maxima of the negated field), candidates are ranked by
+# prominence and thinned by greedy non-maximum suppression over a KD-tree, so the cost
+# depends on the region size only, not on how many candidates a field happens to have.
+#
+#   highs = gfs_extrema.find_centers(mslp2d, Lon2d, Lat2d, extent, "H", threshold=1020)
+#   gfs_extrema.draw_centers(ax, highs, transform=ccrs.PlateCarree())
+
+# One detected centre.  kind is "H" or "L", y/x index the full grid, prominence is the
+# depth of the centre below (above) the opposite extreme of its search window.
+Center = namedtuple("Center", "kind y x lon lat value prominence")
+
+CENTER_COLORS = {"H": "blue", "L": "red"}
+
+
+def _region(lons2d, lats2d, extent):
+    # Row/column slices bounding the grid points inside extent, and the inside mask
+    inside = ((lons2d >= extent[0]) & (lons2d <= extent[1]) &
+              (lats2d >= extent[2]) & (lats2d <= extent[3]))
+    rows = np.flatnonzero(inside.any(axis=1))
+    cols = np.flatnonzero(inside.any(axis=0))
+    if not len(rows) or not len(cols):
+        return None
+    rows, cols = slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+    return rows, cols, inside[rows, cols]
+
+
+def find_centers(data2d, lons2d, lats2d, extent, kind, threshold=None, size=25,
+                 min_distance=60, max_count=4, margin=0.0, always_extreme=False):
+    """Up to max_count highs (kind "H", value >= threshold) or lows ("L", <= threshold).
+
+    Centres are at least min_distance grid points apart, strongest (most prominent)
+    first.  always_extreme also adds the region's absolute maximum (minimum) unless a
+    kept centre is already within min_distance of it.
+    """
+    region = _region(lons2d, lats2d, extent)
+    if region is None:
+        return []
+    rows, cols, inside = region
+    lons, lats = lons2d[rows, cols], lats2d[rows, cols]
+    sign = 1.0 if kind == "H" else -1.0
+    # Lows are maxima of the negated field; missing points can never win
+    field = sign * np.asarray(data2d[rows, cols], dtype=np.float64)
+    field = np.where(inside & ~np.isnan(field), field, -np.inf)
+    # Centres must lie margin degrees inside the extent so their labels stay on the map
+    allowed = np.isfinite(field) & ((lons >= extent[0] + margin) & (lons <= extent[1] - margin) &
+                                    (lats >= extent[2] + margin) & (lats <= extent[3] - margin))
+    peaks = allowed & (field == ndimage.maximum_filter(field, size=size, mode="constant", cval=-np.inf))
+    if threshold is not None:
+        peaks &= field >= sign * threshold
+    floor = ndimage.minimum_filter(np.where(np.isfinite(field), field, np.inf), size=size,
+                                   mode="nearest")
+    py, px = np.nonzero(peaks)
+    prominence = field[py, px] - floor[py, px]
+    order = np.argsort(-prominence, kind="stable")
+    py, px, prominence = py[order], px[order], prominence[order]
+
+    keep = []
+    if len(py):
+        tree = cKDTree(np.column_stack([py, px]))
+        radius = np.nextafter(min_distance, 0)
+        suppressed = np.zeros(len(py), dtype=bool)
+        for i in range(len(py)):
+            if len(keep) >= max_count:
+                break
+            if suppressed[i]:
+                continue
+            keep.append(i)
+            suppressed[tree.query_ball_point((py[i], px[i]), radius)] = True
+
+    centers = [Center(kind, rows.start + py[i], cols.start + px[i], lons[py[i], px[i]],
+                      lats[py[i], px[i]], sign * field[py[i], px[i]], prominence[i]) for i in keep]
+
+    if always_extreme and allowed.any():
+        ey, ex = np.unravel_index(np.argmax(np.where(allowed, field, -np.inf)), field.shape)
+        if not any(np.hypot(ey - (c.y - rows.start), ex - (c.x - cols.start)) < min_distance
+                   for c in centers):
+            centers.append(Center(kind, rows.start + ey, cols.start + ex, lons[ey, ex],
+                                  lats[ey, ex], sign * field[ey, ex], field[ey, ex] - floor[ey, ex]))
+    return centers
+
+
+def draw_centers(ax, centers, transform, zorder=3):
+    """The "H"/"L" letter with its value underneath for every centre."""
+    for c in centers:
+        color = CENTER_COLORS[c.kind]
+        ax.text(
+            c.lon, c.lat, c.kind,
+            color=color, fontsize=16, fontweight='bold',
+            ha='center', va='center', transform=transform,
+            zorder=zorder, path_effects=[path_effects.Stroke(linewidth=1, foreground='white'), path_effects.Normal()]
+        )
+        ax.text(
+            c.lon, c.lat - 0.7, f"{c.value:.0f}",
+            color=color, fontsize=5, fontweight='bold',
+            ha='center', va='top', transform=transform,
+            zorder=zorder, path_effects=[path_effects.Stroke(linewidth=0.5, foreground='white'), path_effects.Normal()]
+        )
@@ -0,0 +1,109 @@
+import cartopy.crs as ccrs
+import matplotlib.pyplot as plt
+import gfs_basemap
+import gfs_png
+
+# Reusable product figures: one per product/region, kept across forecast steps.
+#
+# The figure, map axes, basemap and any fixed overlays (counties, gridlines) are built
+# once; the renderer adds its colorbar, watermark and other fixed pieces on the first
+# step only.  Every later step removes the previous step's data (whatever was drawn on
+# the map since begin()), draws the new data and title, and saves with the bounding box
+# and layout measured on the first step, so savefig draws each frame once, not twice.
+# Colorbars that change between steps (data-dependent levels, optional layers) go in
+# frame.cax() axes; the bounding box is measured once for each set of them showing.
+# Frames live until release(), which gfs_render calls once a product's frames are done.
+#
+#   frame = gfs_frame.frame("precip12_usa", extent)
+#   fig, ax = frame.begin()
+#   plt.title(title_str)
+#   mesh = ax.contourf(...)
+#   if frame.first:
+#       cbar = plt.colorbar(mesh, ax=ax, ...)
+#   frame.save(png_path, pad_inches=0, palette=png_palette, transparent=True, facecolor='white')
+
+
+class Frame:
+    """A product figure whose map data is replaced every forecast step."""
+
+    def __init__(self, extent, features=gfs_basemap.STANDARD, figsize=(10, 7), dpi=600,
+                 overlay=None, **fig_kw):
+        self.fig = plt.figure(figsize=figsize, dpi=dpi, facecolor='white', **fig_kw)
+        self.ax = self.fig.add_subplot(projection=ccrs.PlateCarree(), facecolor='white')
+        self.extent = list(extent)
+        self.ax.set_extent(self.extent, crs=ccrs.PlateCarree())
+        gfs_basemap.draw(self.ax, self.extent, features)
+        if overlay is not None:
+            overlay(self.ax)
+        # Everything on the map now stays; whatever is added later is one step's data
+        self._static = set(self.ax.get_children())
+        self._caxes = {}
+        self._bboxes = {}
+        self.first = True
+        # The renderer's colorbar, for products that relabel it every step
+        self.cbar = None
+
+    def begin(self):
+        """Start a step: remove the last step's map data; returns (fig, ax), made current."""
+        for artist in self.ax.get_children():
+            if artist not in self._static:
+                try:
+                    artist.remove()
+                except ValueError:
+                    # Already removed with its parent (e.g. contour labels)
+                    pass
+        for cax in self._caxes.values():
+            cax.set_visible(False)
+        plt.figure(self.fig.number)
+        plt.sca(self.ax)
+        return self.fig, self.ax
+
+    def cax(self, rect):
+        """Cleared figure axes at rect for a colorbar that changes between steps.
+
+        Only shown on the steps that ask for it.
+        """
+        rect = tuple(rect)
+        if rect not in self._caxes:
+            self._caxes[rect] = self.fig.add_axes(rect)
+        cax = self._caxes[rect]
+        cax.clear()
+        cax.set_visible(True)
+        return cax
+
+    def save(self, path, pad_inches=0.1, palette=None, **kwargs):
+        """savefig(path, **kwargs) cropped to the tight bounding box measured once per layout.
+
+        With a palette (gfs_png.palette) the frame is written as an indexed PNG.
+        """
+        # A layout is the set of per-step colorbars showing
+        layout = tuple(rect for rect, cax in self._caxes.items() if cax.get_visible())
+        if layout not in self._bboxes:
+            # What savefig(bbox_inches='tight') would measure
+            self.fig.canvas.draw()
+            self._bboxes[layout] = self.fig.get_tightbbox(self.fig.canvas.get_renderer()).padded(pad_inches)
+            # Keep the first step's layout for the rest of the run
+            self.fig.set_layout_engine('none')
+        if palette is None:
+            self.fig.savefig(path, bbox_inches=self._bboxes[layout], **kwargs)
+        else:
+            gfs_png.save(self.fig, path, palette, self._bboxes[layout], **kwargs)
+        self.first = False
+
+
+_frames = {}
+
+
+def frame(name, extent, features=gfs_basemap.STANDARD, figsize=(10, 7), dpi=600, overlay=None, **fig_kw):
+    """The Frame of product/region name, built on first use."""
+    if name not in _frames:
+        _frames[name] = Frame(extent, features, figsize, dpi, overlay, **fig_kw)
+    return _frames[name]
+
+
+def release():
+    """Close every cached frame and drop the basemap rasters, once a product is done."""
+    for cached in _frames.values():
+        plt.close(cached.fig)
+    _frames.clear()
+    gfs_basemap.release()
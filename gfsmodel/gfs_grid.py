@@ -0,0 +1,88 @@
+from collections import namedtuple
+import numpy as np
+import gfs_ingest
+
+# Grid geometry shared by the renderers.
+#
+# One GridGeometry per decoded grid caches the -180..180 longitudes, the 2-D lon/lat
+# meshes and, per map extent, the row/column slices of the points inside it.  Renderers
+# crop each frame to a region with a view (data[rows, cols]) instead of meshing and
+# NaN-masking the full grid every frame.
+#
+#   usa = gfs_grid.geometry(lats, lons).region("usa")
+#   data2d = usa.crop(apcp_in)
+#   ax.contourf(usa.lon2d, usa.lat2d, data2d, ...)
+
+REGIONS = {
+    "usa": gfs_ingest.USA_EXTENT,
+    "northeast": gfs_ingest.NORTHEAST_EXTENT,
+}
+
+
+class Region(namedtuple("Region", "extent rows cols lats lons lon2d lat2d")):
+    """The grid points inside one extent; lats/lons are 1-D, lon2d/lat2d their meshes."""
+
+    def crop(self, data):
+        """View of the (..., lat, lon) data inside the region."""
+        return np.asarray(data)[..., self.rows, self.cols]
+
+
+def _span(mask):
+    # Slice over the True run of a 1-D mask (index array if it is not contiguous)
+    idx = np.flatnonzero(mask)
+    if len(idx) and idx[-1] - idx[0] + 1 == len(idx):
+        return slice(int(idx[0]), int(idx[-1]) + 1)
+    return idx
+
+
+class GridGeometry:
+    """Plotting coordinates of a regular lat/lon grid (1-D GRIB lats, 0..360 lons)."""
+
+    def __init__(self, lats, lons):
+        lats = np.asarray(lats)
+        lons = np.asarray(lons)
+        self.lats = lats if lats.ndim == 1 else lats[:, 0]
+        lons = lons if lons.ndim == 1 else lons[0, :]
+        self.lons = np.where(lons > 180, lons - 360, lons)
+        self._mesh = None
+        self._regions = {}
+
+    @property
+    def lon2d(self):
+        return self.mesh()[0]
+
+    @property
+    def lat2d(self):
+        return self.mesh()[1]
+
+    def mesh(self):
+        """(Lon2d, Lat2d) of the full grid."""
+        if self._mesh is None:
+            self._mesh = np.meshgrid(self.lons, self.lats)
+        return self._mesh
+
+    def region(self, extent):
+        """Region of a named extent ("usa", "northeast") or a [W, E, S, N] list."""
+        extent = tuple(REGIONS[extent] if isinstance(extent, str) else extent)
+        if extent not in self._regions:
+            west, east, south, north = extent
+            rows = _span((self.lats >= south) & (self.lats <= north))
+            cols = _span((self.lons >= west) & (self.lons <= east))
+            lats, lons = self.lats[rows], self.lons[cols]
+            lon2d, lat2d = np.meshgrid(lons, lats)
+            self._regions[extent] = Region(list(extent), rows, cols, lats, lons, lon2d, lat2d)
+        return self._regions[extent]
+
+
+_geometries = {}
+
+
+def geometry(lats, lons):
+    """The cached GridGeometry of the grid with these lats/lons."""
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    key = (lats.shape, float(lats.flat[0]), float(lats.flat[-1]),
+           lons.shape, float(lons.flat[0]), float(lons.flat[-1]))
+    if key not in _geometries:
+        _geometries[key] = GridGeometry(lats, lons)
+    return _geometries[key]
@@ -0,0 +1,98 @@
+import atexit
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+# Shared HTTP client for NOMADS traffic: one pooled keep-alive session, connect/read
+# timeouts, jittered exponential retry on 429/5xx and a per-run deadline.
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+MAX_RETRIES = 5
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 60.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Whole-cycle budget in seconds; once spent, no new requests or retries are started
+CYCLE_DEADLINE = float(os.environ.get("GFS_CYCLE_DEADLINE", "5400"))
+_deadline = time.monotonic() + CYCLE_DEADLINE
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+_lock = threading.Lock()
+stats = {"requests": 0, "retries": 0, "failures": 0, "bytes": 0, "seconds": 0.0}
+
+
+def _count(**values):
+    with _lock:
+        for key, value in values.items():
+            stats[key] += value
+
+
+def set_deadline(seconds):
+    global _deadline
+    _deadline = time.monotonic() + seconds
+
+
+def time_left():
+    return _deadline - time.monotonic()
+
+
+def _backoff(attempt, response=None):
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        delay = float(retry_after)
+    else:
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+        delay = random.uniform(0, delay)
+    return min(delay, max(0.0, time_left()))
+
+
+def get(url, label=None, headers=None, chunk_size=1024 * 1024):
+    """Return (status_code, body) for url, retrying transient failures; (None, None) on give-up."""
+    label = label or url
+    for attempt in range(MAX_RETRIES + 1):
+        if time_left() <= 0:
+            print(f"Cycle deadline reached, skipping {label}")
+            _count(failures=1)
+            return None, None
+        start = time.monotonic()
+        response = None
+        try:
+            response = _session.get(url, headers=headers, stream=True,
+                                    timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            if response.status_code not in RETRY_STATUS:
+                body = b"".join(response.iter_content(chunk_size=chunk_size))
+                _count(requests=1, bytes=len(body), seconds=time.monotonic() - start)
+                return response.status_code, body
+            error = f"Status Code: {response.status_code}"
+            response.close()
+        except requests.RequestException as e:
+            error = str(e)
+        _count(requests=1, seconds=time.monotonic() - start)
+        if attempt == MAX_RETRIES:
+            break
+        delay = _backoff(attempt, response)
+        print(f"Retrying {label} in {delay:.1f}s ({error})")
+        _count(retries=1)
+        time.sleep(delay)
+    print(f"Giving up on {label} ({error})")
+    _count(failures=1)
+    return None, None
+
+
+def log_stats():
+    if stats["requests"]:
+        avg = stats["seconds"] / stats["requests"]
+        print(f"NOMADS: {stats['requests']} requests, {stats['retries']} retries, "
+              f"{stats['failures']} failures, {stats['bytes'] / 1e6:.1f} MB, "
+              f"{avg:.2f}s average latency")
+
+
+atexit.register(log_stats)
@@ -0,0 +1,559 @@
+import os
+import re
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from filelock import FileLock
+import gfs_cube
+import gfs_decode
+import gfs_http
+
+# Shared per-cycle GRIB ingest for every gfsmodel product.
+#
+# Products declare what they read in PRODUCT_NEEDS.  The first product that asks for a
+# forecast step downloads the union of every product's (variable, level, subregion) needs
+# for that step per subregion (one filter_gfs_0p25.pl request for each set of variables
+# sharing their levels, so only declared pairs are sent), splits the response into one
+# file per (variable, level, subregion), and every later consumer reuses those files.
+#
+# The files form a persistent cache keyed by cycle/step/variable/level/subregion
+# (INGEST_DIR/gfs.<date>/<hour>/fNNN/<var>_<level>_<region>.grib2).  Reruns of a cached
+# cycle never touch the network; old cycles, then least recently used forecast hours and
+# finally the cubes and checkpoints of older cycles are evicted by prune_cycles.  gfs_decode keeps the decoded float32 arrays of each file next
+# to it, so they age out together with the GRIB data.
+#
+# Fields that products slice over forecast hours (CUBE_VARS) are also appended to their
+# per-cycle data cube (gfs_cube) under INGEST_DIR/gfs.<date>/<hour>/cube, so run totals
+# are built without decoding again.  Products that accumulate over the run checkpoint their state under
+# INGEST_DIR/gfs.<date>/<hour>/checkpoints (gfs_checkpoint).
+
+BASE_DIR = '/var/data'
+INGEST_DIR = os.path.join(BASE_DIR, "GFS", "ingest")
+
+base_url_0p25 = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl"
+
+# "filter" subsets on the server through filter_gfs_0p25.pl.  "idx" reads the .idx
+# inventory of the full pgrb2.0p25 file and pulls the needed messages with HTTP Range
+# requests; that skips the CGI queue but cannot crop, so every field is stored global.
+FETCH_MODE = os.environ.get("GFS_FETCH_MODE", "filter")
+base_url_prod = os.environ.get("GFS_PROD_URL", "https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod")
+# Ranges closer than this are fetched as one request; the extra messages are discarded
+RANGE_MERGE_GAP = 512 * 1024
+
+# Cache limits: cycles older than CACHE_CYCLES runs are dropped, and the whole cache is
+# kept under CACHE_BYTES by evicting least recently used forecast hours
+CACHE_CYCLES = int(os.environ.get("GFS_CACHE_CYCLES", "2"))
+CACHE_BYTES = int(float(os.environ.get("GFS_CACHE_GB", "20")) * 1024 ** 3)
+# Forecast-hour directories of a cycle; they are evicted before its cube/ and checkpoints/
+STEP_DIR_RE = re.compile(r"f\d{3}")
+
+# Variables kept in per-cycle cubes: only the accumulated fields products sum over the run
+CUBE_VARS = {"APCP", "WEASD"}
+
+# Forecast hours that are not on NOMADS yet are polled for until they appear (or the
+# gfs_http cycle deadline runs out) instead of being skipped.  Off by default, where runs
+# take a fully published cycle (current_cycle); gfs_watch turns it on for streaming runs.
+WAIT_FOR_PUBLISH = os.environ.get("GFS_WAIT_FOR_PUBLISH", "0") != "0"
+PUBLISH_POLL = int(os.environ.get("GFS_PUBLISH_POLL", "60"))
+# Last forecast hour of a run; a cycle is complete once it is published
+LAST_STEP = 384
+
+# How many forecast hours are downloaded at once (NOMADS throttles aggressive clients)
+DOWNLOAD_WORKERS = int(os.environ.get("GFS_DOWNLOAD_WORKERS", "4"))
+# Forecast hours queued per download worker ahead of the product consuming them
+PREFETCH_AHEAD = 2
+CHUNK_SIZE = 1024 * 1024
+
+# Subregions as filter_gfs_0p25.pl bounds (leftlon, rightlon, toplat, bottomlat); None = global
+GLOBAL = None
+CONUS = (220, 300, 55, 20)
+NORTHEAST = (280, 295, 47, 37)
+
+# Map extents the products render, as [west, east, south, north] in -180..180 longitudes
+USA_EXTENT = [-130, -65, 20, 54]
+NORTHEAST_EXTENT = [-82, -66, 38, 48]
+
+
+def subregion_for(*extents):
+    # Smallest subregion we already fetch that covers every extent, so products share requests
+    west = min(e[0] for e in extents) % 360
+    east = max(e[1] for e in extents) % 360
+    south = min(e[2] for e in extents)
+    north = max(e[3] for e in extents)
+    for subregion in (NORTHEAST, CONUS):
+        leftlon, rightlon, toplat, bottomlat = subregion
+        if leftlon <= west and east <= rightlon and bottomlat <= south and north <= toplat:
+            return subregion
+    return GLOBAL
+
+
+# Products that draw both the USA and the Northeast map
+USA_NE = subregion_for(USA_EXTENT, NORTHEAST_EXTENT)
+
+# What each product reads, grouped by the GRIB file the product opens.
+# Each entry is (NOMADS variable, NOMADS level, subregion).
+PRODUCT_NEEDS = {
+    "mslp_prate": {
+        "mslp": [("MSLET", "mean_sea_level", CONUS)],
+        "prate": [("PRATE", "surface", CONUS)],
+        "csnow": [("CSNOW", "surface", CONUS)],
+    },
+    "tmp_surface": {
+        "tmp": [("TMP", "2_m_above_ground", CONUS)],
+    },
+    "apcp": {
+        "apcp": [("APCP", "surface", USA_NE)],
+    },
+    "total_cloud_cover": {
+        "tcdc": [("TCDC", "entire_atmosphere", USA_NE)],
+    },
+    "snowdepth": {
+        "snod": [("SNOD", "surface", USA_NE)],
+    },
+    "totalsnowfall": {
+        "weasd": [("WEASD", "surface", USA_NE)],
+    },
+    "lftx_surface": {
+        "lftx": [("LFTX", "surface", CONUS)],
+        "mslp": [("MSLET", "mean_sea_level", CONUS)],
+    },
+    "dzdt_850": {
+        "dzdt": [("DZDT", "850_mb", CONUS)],
+        "hgt": [("HGT", "850_mb", CONUS)],
+        "prate": [("PRATE", "surface", CONUS)],
+    },
+    "gfs_850mb": {
+        "850": [("HGT", "850_mb", CONUS), ("RH", "850_mb", CONUS),
+                ("UGRD", "850_mb", CONUS), ("VGRD", "850_mb", CONUS)],
+        "mslp": [("MSLET", "mean_sea_level", CONUS)],
+    },
+    "vort850": {
+        "absv": [("ABSV", "850_mb", CONUS)],
+        "hgt": [("HGT", "850_mb", CONUS)],
+        "wind": [("UGRD", "850_mb", CONUS), ("VGRD", "850_mb", CONUS)],
+    },
+    "tmp850": {
+        "tmp850": [("TMP", "850_mb", CONUS), ("UGRD", "850_mb", CONUS), ("VGRD", "850_mb", CONUS)],
+    },
+    "wind_200": {
+        "wind": [("UGRD", "200_mb", CONUS), ("VGRD", "200_mb", CONUS)],
+        "hgt": [("HGT", "200_mb", CONUS)],
+    },
+    "thickness": {
+        "thickness": [("HGT", "1000_mb", CONUS), ("HGT", "500_mb", CONUS)],
+    },
+    "crain": {
+        "crain": [("CRAIN", "surface", CONUS)],
+        "csnow": [("CSNOW", "surface", CONUS)],
+        "cfrzr": [("CFRZR", "surface", CONUS)],
+        "cicep": [("CICEP", "surface", CONUS)],
+    },
+    "crain_surface": {
+        "crain_csnow": [("CRAIN", "surface", CONUS), ("CSNOW", "surface", CONUS)],
+    },
+    "sunsd_surface": {
+        "sunsd": [("SUNSD", "surface", CONUS)],
+    },
+    "gust_northeast": {
+        "gust": [("GUST", "surface", NORTHEAST)],
+    },
+}
+
+def grib_file_name(hour_str, step):
+    return f"gfs.t{hour_str}z.pgrb2.0p25.f{step:03d}"
+
+
+def region_tag(subregion):
+    if subregion is None:
+        return "global"
+    return "_".join(str(v) for v in subregion)
+
+
+def cycle_dir(date_str, hour_str):
+    return os.path.join(INGEST_DIR, f"gfs.{date_str}", hour_str)
+
+
+def step_dir(date_str, hour_str, step):
+    return os.path.join(cycle_dir(date_str, hour_str), f"f{step:03d}")
+
+
+def cube_dir(date_str, hour_str):
+    return os.path.join(cycle_dir(date_str, hour_str), "cube")
+
+
+def checkpoint_dir(date_str, hour_str):
+    return os.path.join(cycle_dir(date_str, hour_str), "checkpoints")
+
+
+def cube_name(need):
+    var, level, subregion = need
+    return f"{var}_{level}_{region_tag(fetch_region(subregion))}"
+
+
+def fetch_region(subregion):
+    # Byte-range downloads are always global
+    return None if FETCH_MODE == "idx" else subregion
+
+
+def need_path(date_str, hour_str, step, need):
+    var, level, subregion = need
+    tag = region_tag(fetch_region(subregion))
+    return os.path.join(step_dir(date_str, hour_str, step), f"{var}_{level}_{tag}.grib2")
+
+
+def step_needs():
+    # Union of every product's needs, grouped by subregion
+    groups = {}
+    for parts in PRODUCT_NEEDS.values():
+        for needs in parts.values():
+            for var, level, subregion in needs:
+                groups.setdefault(fetch_region(subregion), set()).add((var, level))
+    return groups
+
+
+def request_groups(var_levels):
+    # filter_gfs_0p25.pl returns every listed variable at every listed level, so variables
+    # are requested together only when they want the same levels; no unused pair is sent
+    by_levels = {}
+    for var in {v for v, _ in var_levels}:
+        levels = frozenset(lev for v, lev in var_levels if v == var)
+        by_levels.setdefault(levels, set()).add(var)
+    return [{(v, lev) for v in variables for lev in levels}
+            for levels, variables in sorted(by_levels.items(), key=lambda item: sorted(item[0]))]
+
+
+def filter_url(date_str, hour_str, step, var_levels, subregion):
+    variables = sorted({v for v, _ in var_levels})
+    levels = sorted({lev for _, lev in var_levels})
+    url = f"{base_url_0p25}?file={grib_file_name(hour_str, step)}"
+    url += "".join(f"&lev_{lev}=on" for lev in levels)
+    url += "".join(f"&var_{v}=on" for v in variables)
+    if subregion is not None:
+        leftlon, rightlon, toplat, bottomlat = subregion
+        url += f"&subregion=&leftlon={leftlon}&rightlon={rightlon}&toplat={toplat}&bottomlat={bottomlat}"
+    url += f"&dir=%2Fgfs.{date_str}%2F{hour_str}%2Fatmos"
+    return url
+
+
+def grib_file_url(date_str, hour_str, step):
+    return f"{base_url_prod}/gfs.{date_str}/{hour_str}/atmos/{grib_file_name(hour_str, step)}"
+
+
+# --- .idx inventories ---
+
+def parse_idx(text):
+    # "12:3456789:d=2024010100:MSLET:mean sea level:6 hour fcst:" -> (offset, var, level)
+    entries = []
+    for line in text.splitlines():
+        fields = line.split(":")
+        if len(fields) < 5 or not fields[1].isdigit():
+            continue
+        entries.append((int(fields[1]), fields[3], fields[4].replace(" ", "_")))
+    return entries
+
+
+def byte_ranges(entries, var_levels, gap=RANGE_MERGE_GAP):
+    # Inclusive [start, end] ranges covering the wanted messages; end None = to end of file
+    ranges = []
+    for i, (offset, var, level) in enumerate(entries):
+        if (var, level) not in var_levels:
+            continue
+        end = entries[i + 1][0] - 1 if i + 1 < len(entries) else None
+        if ranges and ranges[-1][1] is not None and offset - ranges[-1][1] - 1 <= gap:
+            ranges[-1][1] = end
+        else:
+            ranges.append([offset, end])
+    return ranges
+
+
+# --- GRIB2 message splitting ---
+
+def split_messages(data):
+    # Yield (variable, level, message bytes) for every GRIB2 message in data
+    for msg in gfs_decode.iter_messages([data]):
+        var, level = gfs_decode.identify(msg)
+        yield var, level, msg
+
+
+# --- Download ---
+
+def _filter_bytes(date_str, hour_str, step, var_levels, subregion, label):
+    chunks = []
+    for group in request_groups(var_levels):
+        url = filter_url(date_str, hour_str, step, group, subregion)
+        status, data = gfs_http.get(url, label=label, chunk_size=CHUNK_SIZE)
+        if status is None:
+            return None
+        if status != 200:
+            print(f"Failed to download {label} (Status Code: {status})")
+            return None
+        if not data.startswith(b"GRIB"):
+            # NOMADS answers 200 with an HTML page when the file is not published yet
+            print(f"Downloaded {label} but it is not GRIB data.")
+            return None
+        chunks.append(data)
+    return b"".join(chunks)
+
+
+def _range_bytes(date_str, hour_str, step, var_levels, label):
+    url = grib_file_url(date_str, hour_str, step)
+    status, idx = gfs_http.get(url + ".idx", label=label + ".idx")
+    if status != 200:
+        if status is not None:
+            print(f"Failed to download {label}.idx (Status Code: {status})")
+        return None
+    chunks = []
+    for start, end in byte_ranges(parse_idx(idx.decode("ascii", "replace")), var_levels):
+        byte_range = f"bytes={start}-{'' if end is None else end}"
+        status, body = gfs_http.get(url, label=f"{label} {byte_range}",
+                                    headers={"Range": byte_range}, chunk_size=CHUNK_SIZE)
+        if status not in (200, 206):
+            if status is not None:
+                print(f"Failed to download {label} {byte_range} (Status Code: {status})")
+            return None
+        if status == 200:
+            # Server ignored the Range header and sent the whole file
+            body = body[start:None if end is None else end + 1]
+        chunks.append(body)
+    return b"".join(chunks)
+
+
+def _download_region(date_str, hour_str, step, var_levels, subregion):
+    label = f"{grib_file_name(hour_str, step)} [{region_tag(subregion)}]"
+    if FETCH_MODE == "idx":
+        data = _range_bytes(date_str, hour_str, step, var_levels, label)
+    else:
+        data = _filter_bytes(date_str, hour_str, step, var_levels, subregion, label)
+    if data is None:
+        return False
+
+    messages = {}
+    for var, level, msg in split_messages(data):
+        if (var, level) in var_levels:
+            messages.setdefault((var, level), []).append(msg)
+    for (var, level), msgs in messages.items():
+        path = need_path(date_str, hour_str, step, (var, level, subregion))
+        tmp_path = path + ".part"
+        with open(tmp_path, "wb") as f:
+            for msg in msgs:
+                f.write(msg)
+        os.replace(tmp_path, path)
+
+    # Remember which needs this request covered, so absent files mean "not in the model output"
+    with open(_done_marker(date_str, hour_str, step, subregion), "w") as f:
+        f.write("\n".join(f"{v}:{lev}" for v, lev in sorted(var_levels)))
+    print(f"Downloaded {label} {len(messages)} fields, {len(data)} bytes")
+    return True
+
+
+def _done_marker(date_str, hour_str, step, subregion):
+    return os.path.join(step_dir(date_str, hour_str, step), f".done_{region_tag(subregion)}")
+
+
+def _covered(date_str, hour_str, step, subregion):
+    marker = _done_marker(date_str, hour_str, step, subregion)
+    if not os.path.exists(marker):
+        return set()
+    with open(marker) as f:
+        return {tuple(line.split(":", 1)) for line in f.read().splitlines() if line}
+
+
+# --- Cycle availability ---
+
+def is_published(date_str, hour_str, step):
+    # NOMADS writes the .idx after the GRIB file is complete
+    url = grib_file_url(date_str, hour_str, step) + ".idx"
+    status, _ = gfs_http.get(url, label=f"gfs.{date_str}/{hour_str} {grib_file_name(hour_str, step)}.idx")
+    return status == 200
+
+
+def wait_for_step(date_str, hour_str, step):
+    while not is_published(date_str, hour_str, step):
+        if not WAIT_FOR_PUBLISH or gfs_http.time_left() < PUBLISH_POLL:
+            print(f"{grib_file_name(hour_str, step)} is not published for gfs.{date_str}/{hour_str}")
+            return False
+        print(f"Waiting for {grib_file_name(hour_str, step)} of gfs.{date_str}/{hour_str} to be published")
+        time.sleep(PUBLISH_POLL)
+    return True
+
+
+def latest_cycle(max_age_hours=24, step=0):
+    # Newest cycle whose forecast hour step is on NOMADS; with step 0 that includes cycles
+    # whose later forecast hours are still coming
+    now = datetime.utcnow()
+    cycle = now.replace(hour=now.hour // 6 * 6, minute=0, second=0, microsecond=0)
+    while cycle >= now - timedelta(hours=max_age_hours):
+        date_str, hour_str = cycle.strftime("%Y%m%d"), cycle.strftime("%H")
+        if is_published(date_str, hour_str, step):
+            return date_str, hour_str
+        cycle -= timedelta(hours=6)
+    return None
+
+
+def current_cycle():
+    """(date_str, hour_str) of the cycle to process; GFS_CYCLE=YYYYMMDDHH pins one.
+
+    Streaming runs (WAIT_FOR_PUBLISH) take the newest cycle NOMADS has started on; other
+    runs take the newest one published through LAST_STEP, so they never replace a full set
+    of maps with a partial one.
+    """
+    pinned = os.environ.get("GFS_CYCLE")
+    if pinned:
+        return pinned[:8], pinned[8:10]
+    latest = latest_cycle() if WAIT_FOR_PUBLISH else latest_cycle(step=LAST_STEP)
+    if latest:
+        return latest
+    # NOMADS unreachable: fall back to the usual publication delay
+    current_utc_time = datetime.utcnow() - timedelta(hours=6)
+    return current_utc_time.strftime("%Y%m%d"), str(current_utc_time.hour // 6 * 6).zfill(2)
+
+
+def _missing(date_str, hour_str, step, needs):
+    # {subregion: (var, level) group} still to be requested for these needs
+    groups = step_needs()
+    for var, level, subregion in needs:
+        groups.setdefault(fetch_region(subregion), set()).add((var, level))
+    wanted_regions = {fetch_region(subregion) for _, _, subregion in needs}
+    return {subregion: groups[subregion] for subregion in wanted_regions
+            if not groups[subregion] <= _covered(date_str, hour_str, step, subregion)}
+
+
+def ensure_step(date_str, hour_str, step, needs):
+    # Make sure every need of this step has been requested; one download per subregion
+    sdir = step_dir(date_str, hour_str, step)
+    os.makedirs(sdir, exist_ok=True)
+    if not _missing(date_str, hour_str, step, needs):
+        return
+    # Wait for NOMADS without the lock, so other products can use what is already cached
+    if not wait_for_step(date_str, hour_str, step):
+        return
+    with FileLock(os.path.join(sdir, ".lock")):
+        # Another product may have fetched it while we waited
+        for subregion, group in _missing(date_str, hour_str, step, needs).items():
+            _download_region(date_str, hour_str, step, group, subregion)
+
+
+def fetch(date_str, hour_str, step, product, part):
+    """Return the GRIB file (or list of files) holding the fields `product` reads as `part`, or None."""
+    needs = PRODUCT_NEEDS[product][part]
+    ensure_step(date_str, hour_str, step, needs)
+    # Mark this forecast hour as recently used for LRU eviction
+    os.utime(step_dir(date_str, hour_str, step))
+    paths = [need_path(date_str, hour_str, step, need) for need in needs]
+    if not all(os.path.exists(p) for p in paths):
+        return None
+    for need, path in zip(needs, paths):
+        if need[0] in CUBE_VARS:
+            _append_cube(date_str, hour_str, step, need, path)
+    # Several fields: gfs_decode reads the per-field files directly, no combined copy
+    return paths[0] if len(paths) == 1 else paths
+
+
+def _append_cube(date_str, hour_str, step, need, path):
+    var, level, _ = need
+    try:
+        field = gfs_decode.load(path, var, level)
+        if field is not None:
+            gfs_cube.append(cube_dir(date_str, hour_str), cube_name(need), step, field)
+    except Exception as e:
+        print(f"Could not add {cube_name(need)} f{step:03d} to the cycle cube: {e}")
+
+
+def cube(date_str, hour_str, product, part):
+    """The per-cycle data cube of a single-field part, opened lazily, or None."""
+    needs = PRODUCT_NEEDS[product][part]
+    return gfs_cube.open_cube(cube_dir(date_str, hour_str), cube_name(needs[0]))
+
+
+def prefetch(steps, fetch_step, workers=None):
+    """Run fetch_step for many forecast hours at once; yield (step, result) in step order.
+
+    At most PREFETCH_AHEAD steps per worker are queued ahead of the consumer; steps not
+    started yet are cancelled when the consumer stops early (finished or failed).
+    """
+    workers = workers or DOWNLOAD_WORKERS
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = deque()
+    try:
+        for step in steps:
+            futures.append((step, pool.submit(fetch_step, step)))
+            if len(futures) >= workers * PREFETCH_AHEAD:
+                step, future = futures.popleft()
+                yield step, future.result()
+        while futures:
+            step, future = futures.popleft()
+            yield step, future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _cached_cycles():
+    # (cycle time, cycle dir) for every cycle in the cache
+    cycles = []
+    if not os.path.isdir(INGEST_DIR):
+        return cycles
+    for day in os.listdir(INGEST_DIR):
+        day_dir = os.path.join(INGEST_DIR, day)
+        if not day.startswith("gfs.") or not os.path.isdir(day_dir):
+            continue
+        for hour in os.listdir(day_dir):
+            try:
+                cycle_time = datetime.strptime(day[4:] + hour, "%Y%m%d%H")
+            except ValueError:
+                continue
+            cycles.append((cycle_time, os.path.join(day_dir, hour)))
+    return cycles
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                # Blocks actually used: cycle cubes are sparse until every hour is written
+                total += os.stat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def prune_cycles(date_str, hour_str):
+    # Drop cycles that have aged out, then evict least recently used forecast hours of
+    # older cycles, and after them the cubes and checkpoints of older cycles, until the
+    # cache fits in CACHE_BYTES.  The current cycle and newer ones (another product may be
+    # ingesting them) are never evicted.
+    current = datetime.strptime(date_str + hour_str, "%Y%m%d%H")
+    keep_after = current - timedelta(hours=6 * (CACHE_CYCLES - 1))
+    evictable = []
+    total = 0
+    for cycle_time, cdir in _cached_cycles():
+        if cycle_time < keep_after:
+            shutil.rmtree(cdir, ignore_errors=True)
+            print(f"Removed old ingest cycle {cycle_time:%Y%m%d%H}")
+            continue
+        for name in os.listdir(cdir):
+            sdir = os.path.join(cdir, name)
+            if os.path.isdir(sdir):
+                size = _dir_size(sdir)
+                total += size
+                if cycle_time < current:
+                    # Forecast hours go first, oldest use first
+                    tier = 0 if STEP_DIR_RE.fullmatch(name) else 1
+                    evictable.append((tier, os.path.getmtime(sdir), size, sdir))
+
+    for _, _, size, sdir in sorted(evictable):
+        if total <= CACHE_BYTES:
+            break
+        shutil.rmtree(sdir, ignore_errors=True)
+        total -= size
+        print(f"Evicted {sdir} from the ingest cache")
+
+    for cycle_time, cdir in _cached_cycles():
+        if not os.listdir(cdir):
+            os.rmdir(cdir)
+    for day in os.listdir(INGEST_DIR) if os.path.isdir(INGEST_DIR) else []:
+        day_dir = os.path.join(INGEST_DIR, day)
+        if os.path.isdir(day_dir) and not os.listdir(day_dir):
+            os.rmdir(day_dir)
@@ -0,0 +1,120 @@
+from collections import namedtuple
+import numpy as np
+
+# Finite-difference kinematics on the regular 0.25° lat/lon grid (850 mb diagnostics).
+#
+# Metric terms (grid spacing in metres per row, tan(lat)/R) are computed once per grid and
+# cached; derivatives are centred differences like np.gradient (one-sided at the edges)
+# done in float32 with out= buffers.  Every function takes a single (lat, lon) field or a
+# whole (step, lat, lon) stack, differencing only along the last two axes.
+#
+#   k = gfs_kinematics.metrics(lats, lons)
+#   zeta = gfs_kinematics.vorticity(u, v, k)
+#   adv = gfs_kinematics.advection(absv, u, v, k)
+
+EARTH_RADIUS = 6371000.0
+
+# inv_dx: 1/dx (m) per latitude row as (lat, 1); inv_dy: 1/dy (m, signed so y points
+# north); tan_lat_r: tan(lat)/R per row as (lat, 1)
+Metrics = namedtuple("Metrics", "inv_dx inv_dy tan_lat_r")
+
+_metrics = {}
+
+
+def metrics(lats, lons):
+    """Cached metric terms of the grid with 1-D lats/lons (degrees)."""
+    key = (len(lats), float(lats[0]), float(lats[-1]), len(lons), float(lons[0]), float(lons[-1]))
+    if key not in _metrics:
+        lat_rad = np.deg2rad(np.asarray(lats, dtype=np.float64))
+        dlat = (lat_rad[-1] - lat_rad[0]) / (len(lats) - 1)
+        dlon = np.deg2rad(float(lons[-1]) - float(lons[0])) / (len(lons) - 1)
+        dx = EARTH_RADIUS * np.cos(lat_rad) * dlon
+        _metrics[key] = Metrics((1.0 / dx).astype(np.float32)[:, np.newaxis],
+                                np.float32(1.0 / (EARTH_RADIUS * dlat)),
+                                (np.tan(lat_rad) / EARTH_RADIUS).astype(np.float32)[:, np.newaxis])
+    return _metrics[key]
+
+
+def _as_float32(f):
+    return np.asarray(f, dtype=np.float32)
+
+
+def _diff(f, axis, out):
+    # Centred index differences along axis (-1 or -2), one-sided at the two edges
+    def sl(a, b):
+        index = [slice(None)] * f.ndim
+        index[axis] = slice(a, b)
+        return tuple(index)
+    interior = out[sl(1, -1)]
+    np.subtract(f[sl(2, None)], f[sl(None, -2)], out=interior)
+    interior *= 0.5
+    np.subtract(f[sl(1, 2)], f[sl(0, 1)], out=out[sl(0, 1)])
+    np.subtract(f[sl(-1, None)], f[sl(-2, -1)], out=out[sl(-1, None)])
+    return out
+
+
+def ddx(f, k, out=None):
+    """Eastward derivative (per metre)."""
+    f = _as_float32(f)
+    out = _diff(f, -1, np.empty_like(f) if out is None else out)
+    out *= k.inv_dx
+    return out
+
+
+def ddy(f, k, out=None):
+    """Northward derivative (per metre)."""
+    f = _as_float32(f)
+    out = _diff(f, -2, np.empty_like(f) if out is None else out)
+    out *= k.inv_dy
+    return out
+
+
+def gradient(f, k):
+    """(df/dx, df/dy)."""
+    return ddx(f, k), ddy(f, k)
+
+
+def divergence(u, v, k):
+    """du/dx + dv/dy - v tan(lat)/R (s^-1)."""
+    u, v = _as_float32(u), _as_float32(v)
+    div = ddx(u, k)
+    work = ddy(v, k)
+    div += work
+    np.multiply(v, k.tan_lat_r, out=work)
+    div -= work
+    return div
+
+
+def vorticity(u, v, k):
+    """Relative vorticity dv/dx - du/dy + u tan(lat)/R (s^-1)."""
+    u, v = _as_float32(u), _as_float32(v)
+    zeta = ddx(v, k)
+    work = ddy(u, k)
+    zeta -= work
+    np.multiply(u, k.tan_lat_r, out=work)
+    zeta += work
+    return zeta
+
+
+def advection(f, u, v, k):
+    """-(u df/dx + v df/dy): positive where the wind carries higher values in."""
+    u, v = _as_float32(u), _as_float32(v)
+    adv = ddx(f, k)
+    adv *= u
+    work = ddy(f, k)
+    work *= v
+    adv += work
+    np.negative(adv, out=adv)
+    return adv
+
+
+def frontogenesis(t, u, v, k):
+    """Frontogenesis proxy -|grad T| * div (K/m * 1/s; positive = frontogenesis)."""
+    dtdx, dtdy = gradient(t, k)
+    # Missing gradients count as flat
+    np.nan_to_num(dtdx, copy=False)
+    np.nan_to_num(dtdy, copy=False)
+    grad_t = np.hypot(dtdx, dtdy, out=dtdx)
+    grad_t *= divergence(u, v, k)
+    np.negative(grad_t, out=grad_t)
+    return grad_t
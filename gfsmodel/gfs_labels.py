@@ -0,0 +1,121 @@
+from collections import namedtuple
+import numpy as np
+from matplotlib.artist import Artist
+from matplotlib.colors import to_rgba
+from matplotlib.font_manager import FontProperties
+from matplotlib.path import Path
+from matplotlib.textpath import TextPath, text_to_path
+from matplotlib.transforms import IdentityTransform
+
+# Grid-value label layer for the gfsmodel maps (the numbers printed every 2°, 1° or 0.5°).
+#
+# The nearest grid point of every label position is found once per (grid, extent,
+# spacing) and cached, a frame's values are pulled out with one fancy index and formatted
+# as arrays, and all labels are filled by one artist as a single compound path of cached
+# glyph outlines instead of one Text artist each.
+#
+#   grid = gfs_labels.label_grid(lats, lons, extent, 2)
+#   gfs_labels.draw(ax, grid, data2d, gfs_labels.hundredths, fontsize=4, transform=ccrs.PlateCarree())
+
+# lons/lats: label positions (1-D, lons in -180..180); iy/ix: their nearest grid rows/columns
+LabelGrid = namedtuple("LabelGrid", "lons lats iy ix")
+
+_grids = {}
+
+
+def _nearest(axis, targets):
+    # First nearest index like np.abs(axis - t).argmin(), for every target at once
+    return np.abs(axis[np.newaxis, :] - targets[:, np.newaxis]).argmin(axis=1)
+
+
+def label_grid(lats, lons, extent, spacing):
+    """Label positions every spacing degrees over extent [W, E, S, N] and their grid indices."""
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    key = (lats.shape, float(lats.flat[0]), float(lats.flat[-1]),
+           lons.shape, float(lons.flat[0]), float(lons.flat[-1]), tuple(extent), spacing)
+    if key not in _grids:
+        lat_axis = lats if lats.ndim == 1 else lats[:, 0]
+        lon_axis = lons if lons.ndim == 1 else lons[0, :]
+        lon_axis = np.where(lon_axis > 180, lon_axis - 360, lon_axis)
+        label_lats = np.arange(extent[2], extent[3] + 0.01, spacing)
+        label_lons = np.arange(extent[0], extent[1] + 0.01, spacing)
+        _grids[key] = LabelGrid(label_lons, label_lats,
+                                _nearest(lat_axis, label_lats), _nearest(lon_axis, label_lons))
+    return _grids[key]
+
+
+def values(grid, data2d):
+    """(lat, lon) array of data2d at every label position."""
+    return np.asarray(data2d)[np.ix_(grid.iy, grid.ix)]
+
+
+# --- Formatters: float array -> array of label strings ---
+
+def hundredths(vals):
+    # "0", ".xx" below 1, "x.xx" otherwise (precipitation and snow)
+    labels = np.char.mod("%.2f", vals)
+    small = vals < 1
+    labels[small] = np.char.mod(".%02d", np.rint(vals[small] * 100).astype(int))
+    labels[vals == 0] = "0"
+    return labels
+
+
+def tenths(vals):
+    return np.char.mod("%.1f", vals)
+
+
+def whole(vals):
+    return np.char.mod("%d", np.rint(vals).astype(int))
+
+
+def _label_path(label, prop, cache={}):
+    # Glyph outlines of label in points, centred like ha/va="center" text
+    key = (label, prop)
+    if key not in cache:
+        width, height, descent = text_to_path.get_text_width_height_descent(label, prop, ismath=False)
+        # Text lays every line out at least as tall as "lp"
+        _, lp_height, lp_descent = text_to_path.get_text_width_height_descent("lp", prop, ismath=False)
+        height, descent = max(height, lp_height), max(descent, lp_descent)
+        path = TextPath((0, 0), label, prop=prop)
+        cache[key] = Path(path.vertices - (width / 2, height / 2 - descent), path.codes)
+    return cache[key]
+
+
+class LabelLayer(Artist):
+    """Centred text labels filled as one compound path in a single draw call."""
+
+    def __init__(self, xs, ys, labels, fontsize, color="black", fontweight="bold"):
+        super().__init__()
+        self._xs = np.asarray(xs, dtype=float)
+        self._ys = np.asarray(ys, dtype=float)
+        self._labels = list(labels)
+        self._prop = FontProperties(size=fontsize, weight=fontweight)
+        self._color = color
+
+    def draw(self, renderer):
+        if not self.get_visible() or not self._labels:
+            return
+        points = self.get_transform().transform(np.column_stack([self._xs, self._ys]))
+        scale = renderer.points_to_pixels(1.0)
+        paths = [_label_path(label, self._prop) for label in self._labels]
+        vertices = np.concatenate([p.vertices * scale + xy for p, xy in zip(paths, points)])
+        codes = np.concatenate([p.codes for p in paths])
+        gc = renderer.new_gc()
+        gc.set_linewidth(0)
+        gc.set_alpha(self.get_alpha())
+        renderer.draw_path(gc, Path(vertices, codes), IdentityTransform(), to_rgba(self._color))
+        gc.restore()
+        self.stale = False
+
+
+def draw(ax, grid, data2d, fmt, fontsize, color="black", zorder=10, transform=None):
+    """Label every non-NaN grid position of data2d on ax with fmt(values); returns the layer."""
+    vals = values(grid, data2d)
+    keep = ~np.isnan(vals)
+    label_lons, label_lats = np.meshgrid(grid.lons, grid.lats)
+    layer = LabelLayer(label_lons[keep], label_lats[keep], fmt(vals[keep]), fontsize, color=color)
+    layer.set_zorder(zorder)
+    layer.set_transform(transform if transform is not None else ax.transData)
+    ax.add_artist(layer)
+    return layer
@@ -0,0 +1,100 @@
+from collections import namedtuple
+import io
+import numpy as np
+from matplotlib.colors import Colormap, ListedColormap, to_rgba_array
+from PIL import Image
+import gfs_basemap
+
+# Palette-native PNG output for the product frames.
+#
+# The renderers used to save an RGBA PNG and then reopen every file to quantize it with an
+# adaptive (median cut) palette and save it again.  Instead a frame is rendered to raw
+# RGBA in memory, mapped once onto a fixed palette and written straight as an indexed
+# PNG.  The palette holds the product's fill colours (also blended at their alpha over the
+# basemap's land, ocean and lake colours), the basemap colours, a grey ramp for text,
+# lines and antialiased edges, and a coarse RGB cube that catches everything else; it
+# is the same for every frame, so colours never shift between forecast hours.
+#
+#   png_palette = gfs_png.palette(gfs_png.Fill(precip_colors), gfs_png.Fill(prate_cmap, 0.7))
+#   frame.save(png_path, pad_inches=0, palette=png_palette, dpi=600, facecolor='white')
+
+# Colours sampled from a continuous colormap
+CMAP_SAMPLES = 32
+
+# Steps of the grey ramp
+GREYS = 24
+
+# Channel levels of the RGB cube
+CUBE_LEVELS = (0, 64, 128, 191, 255)
+
+# Colours in a palette; the 256th PNG entry is left for transparent pixels
+MAX_COLORS = 255
+
+# One filled layer: its colours (a list, an RGBA array or a Colormap) and alpha
+Fill = namedtuple("Fill", "colors alpha", defaults=(None,))
+
+
+def _rgb(colors):
+    # (n, 3) float RGB of the opaque entries of a colour list, RGBA array or Colormap
+    if isinstance(colors, ListedColormap):
+        colors = colors.colors
+    elif isinstance(colors, Colormap):
+        colors = colors(np.linspace(0, 1, CMAP_SAMPLES))
+    if isinstance(colors, np.ndarray) and colors.dtype == np.uint8:
+        colors = colors / 255.0
+    rgba = to_rgba_array(colors)
+    return rgba[rgba[:, 3] > 0, :3]
+
+
+def _basemap_colors():
+    colors = []
+    for _, kwargs in gfs_basemap.STANDARD:
+        colors += [kwargs[k] for k in ("facecolor", "edgecolor") if k in kwargs]
+    return _rgb(["white", "black"] + colors)
+
+
+def palette(*fills):
+    """(n, 3) uint8 fixed palette of a product drawing these Fills (at most MAX_COLORS)."""
+    backgrounds = _rgb([kwargs["facecolor"] for _, kwargs in gfs_basemap.STANDARD
+                        if kwargs.get("facecolor") not in (None, "none")])
+    parts = []
+    for fill in fills:
+        rgb = _rgb(fill.colors)
+        parts.append(rgb)
+        if fill.alpha is not None:
+            for bg in backgrounds:
+                parts.append(fill.alpha * rgb + (1 - fill.alpha) * bg)
+    parts.append(_basemap_colors())
+    parts.append(np.repeat(np.linspace(0, 1, GREYS)[:, np.newaxis], 3, axis=1))
+    cube = np.array(CUBE_LEVELS) / 255.0
+    parts.append(np.stack(np.meshgrid(cube, cube, cube, indexing="ij"), axis=-1).reshape(-1, 3))
+    colors = np.rint(np.concatenate(parts) * 255).astype(np.uint8)
+    # First occurrence of each colour, in order; the cube's tail goes if there are too many
+    _, first = np.unique(colors, axis=0, return_index=True)
+    return colors[np.sort(first)][:MAX_COLORS]
+
+
+def save(fig, path, pal, bbox_inches, dpi=None, transparent=False, **kwargs):
+    """savefig(path) of fig cropped to bbox_inches (a Bbox) as an indexed PNG of palette pal."""
+    dpi = fig.dpi if dpi in (None, "figure") else dpi
+    buf = io.BytesIO()
+    fig.savefig(buf, format="rgba", bbox_inches=bbox_inches, dpi=dpi, transparent=transparent, **kwargs)
+    # Agg's canvas for the cropped figure, sized as matplotlib sizes it
+    size = (int(bbox_inches.width * dpi), int(bbox_inches.height * dpi))
+    if len(buf.getbuffer()) != size[0] * size[1] * 4:
+        raise ValueError(f"Unexpected raw frame size for {path}")
+    rgba = Image.frombuffer("RGBA", size, buf.getbuffer(), "raw", "RGBA", 0, 1)
+    pal_image = Image.new("P", (1, 1))
+    pal_image.putpalette(pal.ravel().tolist())
+    image = rgba.convert("RGB").quantize(palette=pal_image, dither=Image.Dither.NONE)
+    save_kw = {}
+    if transparent:
+        alpha = np.asarray(rgba.getchannel("A"))
+        if not alpha.all():
+            # Fully transparent pixels get the spare palette entry
+            index = np.array(image)
+            index[alpha == 0] = len(pal)
+            image = Image.fromarray(index, "P")
+            image.putpalette(pal.ravel().tolist() + [0, 0, 0])
+            save_kw["transparency"] = len(pal)
+    image.save(path, optimize=True, **save_kw)
@@ -0,0 +1,164 @@
+from collections import namedtuple
+import copy
+import numpy as np
+import cartopy.crs as ccrs
+import matplotlib
+from matplotlib.colors import BoundaryNorm, ListedColormap, Normalize
+from matplotlib.image import AxesImage
+from matplotlib.transforms import IdentityTransform
+
+# Direct raster renderer for filled fields (an alternative to ax.contourf).
+#
+# contourf traces band polygons, cartopy projects them and Agg fills them at 600 dpi for
+# every frame.  Here the map's pixels are filled directly when the frame is drawn: the
+# grid is bilinearly interpolated to the pixel centres through lookup tables built once
+# per (grid, map, pixel size), np.digitize turns the values into band indices over the
+# product's breaks (grid cells whose corners share a band are filled without either),
+# and one palette lookup writes the RGBA pixels, which Agg composites between the cached
+# basemap layers (gfs_basemap) without resampling.  Bands follow contourf: (z1, z2] with
+# the lowest band closed, extend= colours outside the levels, NaN and masked points left
+# empty, and the image colorbars like the ContourSet it replaces.
+#
+#   mesh = gfs_raster.contourf(ax, region, data2d, levels=precip_breaks, cmap=precip_cmap,
+#                              norm=precip_norm, extend='max', raster=RASTER)
+#   plt.colorbar(mesh, ax=ax, ...)
+
+# Grid position of the pixel centres along one axis: the grid index before (i0), the
+# weights of it and the next point (w0, w1), and whether the centre is on the grid
+PixelAxis = namedtuple("PixelAxis", "i0 w0 w1 inside")
+
+_luts = {}
+
+
+def _axis(grid, coords):
+    step = (grid[-1] - grid[0]) / (len(grid) - 1)
+    frac = (coords - grid[0]) / step
+    i0 = np.clip(np.floor(frac), 0, len(grid) - 2).astype(np.intp)
+    w1 = (frac - i0).astype(np.float32)
+    inside = (frac >= -1e-6) & (frac <= len(grid) - 1 + 1e-6)
+    return PixelAxis(i0, 1 - w1, w1, inside)
+
+
+def lookup(region, projection, extent, width, height):
+    """(rows, cols) PixelAxis tables of a width x height raster over extent, bottom row first.
+
+    extent is (x0, x1, y0, y1) in projection coordinates; the projection must be
+    cylindrical (x follows longitude only, y latitude only), as every product map is.
+    """
+    lats = np.asarray(region.lats, dtype=np.float64)
+    lons = np.asarray(region.lons, dtype=np.float64)
+    key = (len(lats), float(lats[0]), float(lats[-1]), len(lons), float(lons[0]), float(lons[-1]),
+           projection.proj4_init, tuple(float(v) for v in extent), width, height)
+    if key not in _luts:
+        x0, x1, y0, y1 = extent
+        xs = x0 + (np.arange(width) + 0.5) * (x1 - x0) / width
+        ys = y0 + (np.arange(height) + 0.5) * (y1 - y0) / height
+        geodetic = ccrs.PlateCarree()
+        px_lons = geodetic.transform_points(projection, xs, np.full(width, (y0 + y1) / 2))[:, 0]
+        px_lats = geodetic.transform_points(projection, np.full(height, (x0 + x1) / 2), ys)[:, 1]
+        _luts[key] = (_axis(lats, px_lats), _axis(lons, px_lons))
+    return _luts[key]
+
+
+def palette(levels, cmap=None, norm=None, extend='neither'):
+    """RGBA uint8 colours of the band indices: under, the bands, over, then empty (NaN).
+
+    The colours are the ones contourf gives the same levels, cmap, norm and extend.
+    """
+    levels = np.asarray(levels, dtype=np.float64)
+    cmap = matplotlib.colormaps.get_cmap(cmap)
+    norm = Normalize() if norm is None else copy.copy(norm)
+    norm.autoscale_None(levels)
+    if extend != 'neither':
+        norm.clip = False
+    # contourf colours a band by its midpoint; an extended band reaches +-1e250
+    bounds = np.concatenate(([-1e250], levels, [1e250]))
+    colors = cmap(norm(0.5 * (bounds[:-1] + bounds[1:])))
+    if extend not in ('min', 'both'):
+        colors[0] = 0
+    if extend not in ('max', 'both'):
+        colors[-1] = 0
+    colors = np.vstack([colors, [0, 0, 0, 0]])
+    return np.ascontiguousarray(np.rint(colors * 255).astype(np.uint8))
+
+
+def render(region, data, levels, pal, projection, extent, width, height):
+    """RGBA uint8 (height, width, 4) pixels of data (region's grid) over extent, bottom row first."""
+    rows, cols = lookup(region, projection, extent, width, height)
+    data = np.ma.filled(np.ma.asarray(data, dtype=np.float32), np.nan)
+    # (z1, z2] bands with the lowest one closed; above the last level is "over" and NaN
+    # sorts past the +inf bin into the empty entry
+    bins = np.append(np.asarray(levels, dtype=np.float32), np.float32(np.inf))
+    bins[0] = np.nextafter(bins[0], np.float32(-np.inf))
+    grid = np.digitize(data, bins, right=True).astype(np.uint8)
+    # A grid cell whose four corners share a band is that band all over (bilinear values
+    # stay between the corners'); only pixels of mixed cells are interpolated
+    corner = grid[:-1, :-1]
+    same = (corner == grid[1:, :-1]) & (corner == grid[:-1, 1:]) & (corner == grid[1:, 1:])
+    across = data[:, cols.i0] * cols.w0 + data[:, cols.i0 + 1] * cols.w1
+    index = np.empty((height, width), dtype=np.uint8)
+    # Pixel rows come in runs between the same two grid rows
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(rows.i0)) + 1, [height]))
+    for r0, r1 in zip(starts[:-1], starts[1:]):
+        i = rows.i0[r0]
+        index[r0:r1] = corner[i, cols.i0]
+        mixed = np.flatnonzero(~same[i, cols.i0])
+        if mixed.size:
+            values = across[i, mixed] * rows.w0[r0:r1, np.newaxis]
+            values += across[i + 1, mixed] * rows.w1[r0:r1, np.newaxis]
+            index[r0:r1, mixed] = np.digitize(values, bins, right=True)
+    index[:, ~cols.inside] = len(pal) - 1
+    index[~rows.inside] = len(pal) - 1
+    # One 4-byte lookup per pixel
+    return pal.view(np.uint32).ravel()[index].view(np.uint8).reshape(height, width, 4)
+
+
+class RasterImage(AxesImage):
+    """Filled bands of a region's field, rendered at the axes' pixel size when drawn."""
+
+    def __init__(self, ax, region, data, levels, pal, **kwargs):
+        super().__init__(ax, extent=ax.get_extent(), **kwargs)
+        self.set_data(data)
+        self._region = region
+        self._levels = levels
+        self._palette = pal
+        alpha = self.get_alpha()
+        if alpha is not None:
+            # Agg takes the pixels as they are, so the fill's alpha goes in the palette
+            self._palette = pal.copy()
+            self._palette[:, 3] = np.rint(pal[:, 3] * alpha)
+        self._pixels = None
+
+    def make_image(self, renderer, magnification=1.0, unsampled=False):
+        l, b, r, t = (self.axes.bbox.extents * magnification + 0.5).astype(int)
+        (x0, y0), (x1, y1) = self.axes.transData.inverted().transform([(l, b), (r, t)])
+        key = (l, b, r, t, x0, x1, y0, y1)
+        # The tight-bbox pass and the final draw of one savefig render once
+        if self._pixels is None or self._pixels[0] != key:
+            rgba = render(self._region, self.get_array(), self._levels, self._palette,
+                          self.axes.projection, (x0, x1, y0, y1), r - l, t - b)
+            self._pixels = (key, rgba)
+        return self._pixels[1], l, b, IdentityTransform()
+
+
+def contourf(ax, region, data, levels, cmap=None, norm=None, extend='neither', alpha=None,
+             zorder=1, raster=True):
+    """Filled bands of data (cropped to region) on a cylindrical GeoAxes, like ax.contourf.
+
+    raster=False draws them with matplotlib contourf instead.  The raster image's cmap and
+    norm are the bands', so plt.colorbar(mesh, ...) draws the contourf colorbar.
+    """
+    if not raster:
+        return ax.contourf(region.lon2d, region.lat2d, data, levels=levels, cmap=cmap, norm=norm,
+                           extend=extend, alpha=alpha, zorder=zorder, transform=ccrs.PlateCarree())
+    pal = palette(levels, cmap, norm, extend)
+    # For colorbars: one colour per band, extensions as under/over
+    band_cmap = ListedColormap(pal[1:-2] / 255.0)
+    band_cmap.set_under(pal[0] / 255.0)
+    band_cmap.set_over(pal[-2] / 255.0)
+    band_cmap.colorbar_extend = extend
+    band_norm = BoundaryNorm(np.asarray(levels, dtype=np.float64), len(levels) - 1)
+    image = RasterImage(ax, region, data, levels, pal, cmap=band_cmap, norm=band_norm,
+                        alpha=alpha, zorder=zorder)
+    ax.add_image(image)
+    return image
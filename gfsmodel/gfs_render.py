@@ -0,0 +1,158 @@
+import contextlib
+import gc
+import io
+import multiprocessing
+import os
+import pickle
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import psutil
+import gfs_frame
+
+# Process-pool rendering of forecast steps for the gfsmodel products.
+#
+# A product's main loop keeps downloading, decoding and accumulating in order, and hands
+# each frame (a step, or one region of a step) to a Renderer, which draws it in one of a
+# pool of worker processes.  The workers are forked from the product script when the
+# Renderer starts, so they begin with its imports, colormaps and palettes, and each keeps
+# its own gfs_frame figures (and basemap rasters) warm from one frame to the next.  The
+# arguments of a frame are copied when it is submitted, so the caller may go on to reuse
+# or update its buffers.  Frames finish in any order, but their printed output comes
+# back in the order they were submitted, and then() calls (checkpoints) wait for every
+# frame before them.  If any frame failed, the product exits non-zero once the rest are done.
+#
+#   with gfs_render.Renderer(frames=2) as render:
+#       for step, grib_file in gfs_ingest.prefetch(forecast_steps, ...):
+#           if grib_file:
+#               render.submit(generate_clean_png, grib_file, step)
+
+# Memory a worker needs besides its frames: the interpreter and libraries, the step's
+# fields and the raw RGBA copy of a canvas for the PNG
+WORKER_BYTES = int(float(os.environ.get("GFS_RENDER_WORKER_MB", "512")) * 1024 ** 2)
+
+# Memory each cached frame keeps in a worker: its 600 dpi canvas and its decoded basemap
+# rasters (under and over the data), about 100 MB each at 10x7 inches
+FRAME_BYTES = int(float(os.environ.get("GFS_RENDER_FRAME_MB", "320")) * 1024 ** 2)
+
+# Fixed number of render workers (0: as many as the cores and free memory allow; 1:
+# render in the product's own process, one frame after the other)
+RENDER_WORKERS = int(os.environ.get("GFS_RENDER_WORKERS", "0"))
+
+# Products rendering on this machine at the same time (gfs_watch runs several); each
+# takes its share of the cores and free memory
+RENDER_SHARE = max(1, int(os.environ.get("GFS_RENDER_SHARE", "1")))
+
+# Frames waiting per worker before submit waits for the oldest one
+QUEUE_DEPTH = 2
+
+
+def worker_count(frames=1):
+    """Render workers: a core each, within the product's share of cores and memory for its frames."""
+    if RENDER_WORKERS > 0:
+        return RENDER_WORKERS
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    free = psutil.virtual_memory().available // RENDER_SHARE
+    return max(1, min(cores // RENDER_SHARE, free // (WORKER_BYTES + frames * FRAME_BYTES)))
+
+
+def _render(payload):
+    # One frame in a worker: (whether it rendered, its printed output); a failed frame
+    # is reported like the products report theirs and the run goes on
+    fn, args, kwargs = pickle.loads(payload)
+    log = io.StringIO()
+    ok = True
+    with contextlib.redirect_stdout(log):
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            print(f"Error in {fn.__name__}: {e}")
+            print(traceback.format_exc(), end="")
+            ok = False
+    gc.collect()
+    return ok, log.getvalue()
+
+
+class Renderer:
+    """A pool of render workers; submit(fn, *args) draws fn(*args) in one of them.
+
+    frames is how many gfs_frame figures the product draws (e.g. one per region); every
+    worker ends up holding all of them.
+    """
+
+    def __init__(self, workers=None, frames=1):
+        self.workers = workers or worker_count(frames)
+        self._pool = None
+        # (future, None) for a frame, (None, payload) for a then() call, in submit order
+        self._pending = deque()
+        self._failed = False
+        if self.workers > 1:
+            # Fork every worker now, while the product is idle and single threaded; a
+            # spawned worker would rerun the whole product script
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("fork"))
+            self._pool.submit(os.getpid).result()
+        print(f"Rendering with {self.workers} worker{'s' if self.workers > 1 else ''}")
+
+    def submit(self, fn, *args, **kwargs):
+        """Render fn(*args, **kwargs) in a worker; fn must be a module-level function."""
+        payload = pickle.dumps((fn, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        if self._pool is None:
+            self._finish(_render(payload))
+            return
+        while len(self._pending) >= self.workers * QUEUE_DEPTH:
+            self._collect()
+        self._pending.append((self._pool.submit(_render, payload), None))
+
+    def then(self, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) here once every frame submitted so far has rendered.
+
+        Skipped if a frame of the run failed (e.g. a checkpoint that would skip it on resume).
+        """
+        payload = pickle.dumps((fn, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        self._pending.append((None, payload))
+        if self._pool is None:
+            self._collect()
+
+    def _collect(self):
+        future, payload = self._pending.popleft()
+        if future is not None:
+            self._finish(future.result())
+        elif not self._failed:
+            fn, args, kwargs = pickle.loads(payload)
+            fn(*args, **kwargs)
+
+    def _finish(self, outcome):
+        ok, log = outcome
+        print(log, end="", flush=True)
+        self._failed = self._failed or not ok
+
+    def close(self):
+        """Wait for every submitted frame, stop the workers and release the frames.
+
+        Exits with status 1 if any frame failed, so gfs_watch and cron see the failure.
+        """
+        while self._pending:
+            self._collect()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        # Workers free theirs as they exit; frames drawn in this process go now
+        gfs_frame.release()
+        if self._failed:
+            print("Some frames failed to render")
+            raise SystemExit(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+        return False
@@ -0,0 +1,62 @@
+import os
+import re
+import sys
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the NOMADS prod tree, for trying the .idx/Range fetch mode offline.
+# Serve a directory laid out like gfs.<date>/<hour>/atmos/gfs.tHHz.pgrb2.0p25.fNNN(.idx):
+#
+#   python gfs_replay.py /path/to/saved/prod 8000
+#   GFS_FETCH_MODE=idx GFS_PROD_URL=http://127.0.0.1:8000 python mslp_prate.py
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    # SimpleHTTPRequestHandler ignores Range; answer single ranges with 206 like NOMADS does
+
+    def send_head(self):
+        self.range_left = None
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        if start >= size or start > end:
+            self.send_error(416, "Requested Range Not Satisfiable")
+            return None
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.range_left = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        left = self.range_left
+        if left is None:
+            return super().copyfile(source, outputfile)
+        while left > 0:
+            chunk = source.read(min(left, 1024 * 1024))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            left -= len(chunk)
+
+
+def serve(directory, port=8000):
+    handler = partial(RangeRequestHandler, directory=directory)
+    with ThreadingHTTPServer(("127.0.0.1", port), handler) as server:
+        print(f"Replaying {directory} on http://127.0.0.1:{port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python gfs_replay.py <directory> [port]")
+        sys.exit(1)
+    serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
@@ -0,0 +1,67 @@
+import numpy as np
+import scipy.ndimage as ndimage
+from scipy.signal import fftconvolve
+
+# Gaussian smoothing for the gfsmodel maps (frontogenesis, PVA, heights, jet speeds).
+#
+# Repeated passes are folded into one kernel (n passes of sigma equal one pass of
+# sigma*sqrt(n) away from the edges), small kernels run as separable 1-D filters and
+# large ones as one FFT convolution, and NaN-aware smoothing filters the values and their
+# weights together in one batched call before a single normalising divide.  Inputs may be one (lat, lon)
+# field or a (step, lat, lon) stack; only the last two axes are smoothed, never time.
+#
+#   frontogen = gfs_smooth.gaussian(frontogen, 3, passes=2, nan_aware=True)
+
+# The FFT beats the separable filter above this sigma (grid points), on frames of at
+# least FFT_MIN_POINTS points (on the cropped CONUS grid the separable filter always wins)
+FFT_SIGMA = 8.0
+FFT_MIN_POINTS = 500_000
+
+# Kernel radius in sigmas, as scipy.ndimage.gaussian_filter
+TRUNCATE = 4.0
+
+
+def effective_sigma(sigma, passes=1):
+    """Sigma of the single Gaussian equal to passes repeated passes of sigma."""
+    return float(sigma) * np.sqrt(max(1, passes))
+
+
+def _kernel(sigma):
+    radius = int(TRUNCATE * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    k = np.exp(-0.5 * (x / sigma) ** 2)
+    return (k / k.sum()).astype(np.float32), radius
+
+
+def _filter(data, sigma):
+    # Smooth the last two axes of a float32 array with edge ("nearest") boundaries
+    if sigma <= 0:
+        return data.copy()
+    if sigma <= FFT_SIGMA or data.shape[-2] * data.shape[-1] < FFT_MIN_POINTS:
+        return ndimage.gaussian_filter(data, sigma=[0] * (data.ndim - 2) + [sigma, sigma],
+                                       mode="nearest", truncate=TRUNCATE, output=np.float32)
+    k, radius = _kernel(sigma)
+    pad = [(0, 0)] * (data.ndim - 2) + [(radius, radius), (radius, radius)]
+    kernel = np.outer(k, k).reshape((1,) * (data.ndim - 2) + (len(k), len(k)))
+    out = fftconvolve(np.pad(data, pad, mode="edge"), kernel, mode="valid", axes=(-2, -1))
+    return out.astype(np.float32, copy=False)
+
+
+def gaussian(data, sigma, passes=1, nan_aware=False):
+    """data smoothed with Gaussian sigma (grid points) applied passes times, as float32.
+
+    With nan_aware, NaNs neither spread nor count: each point is the weighted mean of the
+    valid points around it, and stays NaN only where no valid point is in reach.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    sigma = effective_sigma(sigma, passes)
+    if not nan_aware:
+        return _filter(data, sigma)
+    valid = np.isfinite(data)
+    # Values and weights smoothed in one batched call
+    both = _filter(np.stack([np.where(valid, data, np.float32(0)), valid.astype(np.float32)]), sigma)
+    num, den = both[0], both[1]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        np.divide(num, den, out=num)
+    num[den <= 0] = np.nan
+    return num
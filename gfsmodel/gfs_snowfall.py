@@ -0,0 +1,87 @@
+import os
+from collections import namedtuple
+import numpy as np
+import gfs_arrays
+import gfs_cube
+
+# Snowfall engine for the total snowfall products.
+#
+# Liquid-equivalent snowfall is accumulated once per cycle from the WEASD cube (positive
+# increments of snow water on the ground) and every snow ratio is drawn from that one
+# field: a ratio only rescales the colour breaks (snow inches / ratio), never the data.
+#
+#   snow = gfs_snowfall.new(gfs_ingest.cube(date_str, hour_str, "totalsnowfall", "weasd"))
+#   gfs_snowfall.extend(snow, weasd_cube, step)
+#   liquid_in = snow.totals[step]
+
+# Snow ratio -> extra title line of its product
+RATIOS = {
+    3: "Above 32°F: Heavy slushy snow",
+    5: "Wet/Heavy Snow (At 32°F)",
+    8: "Medium/light Snow (At 29°F)",
+    10: "Temp 27°F: Light powder",
+    12: "Medium Powder (At 25°F)",
+    15: "Medium Powder (At 21°F)",
+    20: "Very Fluffy / Dry Powder (At 17°F)",
+}
+
+# Snow water above this (inches of liquid, 120" at 10:1) is bad data, not snowpack
+MAX_LIQUID_IN = 12.0
+
+KGM2_TO_IN = 0.0393701
+
+# totals maps forecast hour -> float32 liquid-equivalent snowfall since the start of the run
+Snowfall = namedtuple("Snowfall", "totals lats lons")
+
+
+def ratios():
+    """The built-in ratios plus any extra ones in GFS_SNOW_RATIOS (e.g. "7,25")."""
+    extra = {}
+    for item in os.environ.get("GFS_SNOW_RATIOS", "").split(","):
+        try:
+            ratio = float(item)
+        except ValueError:
+            continue
+        if ratio > 0:
+            extra[int(ratio) if ratio.is_integer() else ratio] = ""
+    return {**RATIOS, **{r: t for r, t in extra.items() if r not in RATIOS}}
+
+
+def ratio_name(ratio):
+    # 10 -> "10to1", the product's directory and PNG prefix suffix
+    return f"{ratio:g}to1"
+
+
+def liquid_in(weasd_kgm2, out=None):
+    liquid = gfs_arrays.scale(weasd_kgm2, KGM2_TO_IN, out=out)
+    return gfs_arrays.mask_outside(liquid, 0, MAX_LIQUID_IN)
+
+
+def new(cube):
+    return Snowfall({}, cube.lats, cube.lons)
+
+
+def extend(snow, cube, step):
+    """Add forecast hour step (steps go in increasing order); False if its WEASD is missing."""
+    if step in snow.totals:
+        return True
+    weasd = gfs_cube.step_values(cube, step)
+    if weasd is None:
+        return False
+    current = liquid_in(weasd)
+    prev_steps = [s for s in snow.totals if s < step]
+    if not prev_steps:
+        snow.totals[step] = current
+        return True
+    prev = max(prev_steps)
+    # Only snow water gained since the last hour counts; melt and missing points add nothing
+    previous = liquid_in(gfs_cube.step_values(cube, prev), out=gfs_arrays.work("snowfall_prev", current.shape))
+    total = gfs_arrays.positive_increment(current, previous, out=current)
+    total += gfs_arrays.fill_nan(gfs_arrays.scale(snow.totals[prev], 1, out=previous))
+    snow.totals[step] = total
+    return True
+
+
+def levels(breaks, ratio):
+    """Snow-inch colour breaks as liquid inches for ratio, so one liquid field serves every ratio."""
+    return np.asarray(breaks, dtype=np.float64) / ratio
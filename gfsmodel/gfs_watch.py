@@ -0,0 +1,101 @@
+import os
+import sys
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+import gfs_http
+import gfs_ingest
+
+# Watches NOMADS for new GFS cycles and starts every product as soon as f000 of a new
+# cycle is published.  The products are pinned to that cycle (GFS_CYCLE) and stream
+# through the forecast hours as NOAA publishes them, so first frames land minutes after
+# the data does.
+#
+#   python gfs_watch.py          # run forever
+#   python gfs_watch.py --once   # process the newest cycle if it is new, then exit
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = os.path.join(gfs_ingest.INGEST_DIR, "last_cycle")
+
+# Most-viewed products first; they get the first render slots
+PRODUCT_SCRIPTS = [
+    "mslp_prate.py",
+    "tmp_surface_clean.py",
+    "6hourmaxprecip.py",
+    "12hour_precip.py",
+    "24hour_precip.py",
+    "total_precip.py",
+    "total_cloud_cover.py",
+    "snowdepth.py",
+    "totalsnowfall.py",
+    "thickness_1000_500.py",
+    "wind_200.py",
+    "sunsd_surface_clean.py",
+    "gfs_850mb_plot.py",
+    "vort850_surface_clean.py",
+    "dzdt_850.py",
+    "lftx_surface.py",
+    "Fronto_gensis_850.py",
+    "gfs_gust_northeast.py",
+    "crain_plot.py",
+    "crain_surface_clean.py",
+]
+
+# Products running at once while a cycle streams in
+WATCH_JOBS = int(os.environ.get("GFS_WATCH_JOBS", "4"))
+# Time a streaming product may spend waiting for the rest of its cycle
+STREAM_DEADLINE = os.environ.get("GFS_STREAM_DEADLINE", "14400")
+
+
+def read_last_cycle():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            return f.read().strip()
+    return None
+
+
+def write_last_cycle(cycle):
+    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    with open(STATE_FILE, "w") as f:
+        f.write(cycle)
+
+
+def run_product(script, cycle):
+    env = os.environ.copy()
+    env["GFS_CYCLE"] = cycle
+    env.setdefault("GFS_CYCLE_DEADLINE", STREAM_DEADLINE)
+    # Stream through the cycle: wait for forecast hours NOAA has not published yet
+    env.setdefault("GFS_WAIT_FOR_PUBLISH", "1")
+    # The products running at once split the render cores and memory (gfs_render)
+    env.setdefault("GFS_RENDER_SHARE", str(WATCH_JOBS))
+    start = time.time()
+    result = subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, script)], cwd=SCRIPT_DIR, env=env)
+    status = "finished" if result.returncode == 0 else f"failed (exit {result.returncode})"
+    print(f"{script} {status} for {cycle} in {time.time() - start:.0f}s")
+
+
+def run_cycle(cycle):
+    print(f"New GFS cycle {cycle}: starting {len(PRODUCT_SCRIPTS)} products")
+    with ThreadPoolExecutor(max_workers=WATCH_JOBS) as pool:
+        for script in PRODUCT_SCRIPTS:
+            pool.submit(run_product, script, cycle)
+
+
+def watch(once=False):
+    while True:
+        # The watcher runs indefinitely; give every poll a fresh request budget
+        gfs_http.set_deadline(gfs_http.CYCLE_DEADLINE)
+        latest = gfs_ingest.latest_cycle()
+        if latest:
+            cycle = "".join(latest)
+            if cycle != read_last_cycle():
+                write_last_cycle(cycle)
+                run_cycle(cycle)
+                continue
+        if once:
+            return
+        time.sleep(gfs_ingest.PUBLISH_POLL)
+
+
+if __name__ == "__main__":
+    watch(once="--once" in sys.argv)
@@ -1,21 +1,23 @@
 import os
-import requests
 from datetime import datetime, timedelta
-import xarray as xr
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap, BoundaryNorm
 import numpy as np
 import cartopy.crs as ccrs
-import matplotlib.patheffects as path_effects
-import scipy.ndimage as ndimage
 import scipy.interpolate as interp  # <-- add this import
-import time
-import gc
 from filelock import FileLock
 import cartopy
 import importlib
+import gfs_arrays
+import gfs_decode
+import gfs_extrema
+import gfs_frame
+import gfs_grid
+import gfs_ingest
+import gfs_png
+import gfs_render
 
 # Ensure a stable cartopy data directory and create it
 cartopy.config['data_dir'] = '/opt/render/project/src/cartopy_data'
@@ -31,9 +33,8 @@ with lock:
 
 BASE_DIR = '/var/data'
 
-# --- Clean up old files in grib_files, pngs, and combined_mslp_prate directories ---
+# --- Clean up old files in pngs and combined_mslp_prate directories ---
 for folder in [
-    os.path.join(BASE_DIR, "GFS", "static", "PRATEGFS", "grib_files"),
     os.path.join(BASE_DIR, "GFS", "static", "pngs"),
     os.path.join(BASE_DIR, "GFS", "static", "PRATEGFS")
 ]:
@@ -46,25 +47,15 @@ for folder in [
 # Directories
 output_dir = os.path.join(BASE_DIR, "GFS")
 combined_dir = os.path.join(output_dir, "static", "PRATEGFS")
-grib_dir = os.path.join(combined_dir, "grib_files")
 png_dir = combined_dir
-os.makedirs(grib_dir, exist_ok=True)
 os.makedirs(png_dir, exist_ok=True)
 
 # Output directory for combined PNGs
 # combined_dir = os.path.join(BASE_DIR, "GFS", "static", "combined_mslp_prate")
 # os.makedirs(combined_dir, exist_ok=True)
 
-# GFS 0.25-degree URL and variables
-base_url_0p25 = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl"
-variable_mslp = "MSLET"
-variable_prate = "PRATE"
-variable_csnow = "CSNOW"
-
-# Current UTC time minus 6 hours (nearest available GFS cycle)
-current_utc_time = datetime.utcnow() - timedelta(hours=6)
-date_str = current_utc_time.strftime("%Y%m%d")
-hour_str = str(current_utc_time.hour // 6 * 6).zfill(2)  # nearest 6-hour slot
+# Newest GFS cycle on NOMADS (GFS_CYCLE=YYYYMMDDHH pins one)
+date_str, hour_str = gfs_ingest.current_cycle()
 
 # Levels and colormaps
 mslp_levels = np.arange(960, 1050+2, 2)
@@ -106,125 +97,69 @@ snow_colors = [
 ]
 snow_cmap = LinearSegmentedColormap.from_list("snow_cbar", snow_colors, N=len(snow_colors))
 snow_norm = BoundaryNorm(snow_levels, snow_cmap.N)
+png_palette = gfs_png.palette(gfs_png.Fill(prate_colors, 0.7), gfs_png.Fill(snow_colors, 0.85))
 
 # Forecast steps
 forecast_steps = [0] + list(range(6, 385, 6))
 
-
-# Download functions
-def download_grib(url, file_path):
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-        print(f"Downloaded {os.path.basename(file_path)}")
-        return file_path
-    else:
-        print(f"Failed to download {os.path.basename(file_path)} (Status Code: {response.status_code})")
-        return None
-
+# Download functions (GRIBs come from the shared per-cycle ingest)
 def get_mslp_grib(step):
-    if step == 0:
-        file_name = f"gfs.t{hour_str}z.pgrb2.0p25.f000"
-    else:
-        file_name = f"gfs.t{hour_str}z.pgrb2.0p25.f{step:03d}"
-    file_path = os.path.join(grib_dir, f"mslp_{file_name}")
-    url = (
-        f"{base_url_0p25}?file={file_name}"
-        f"&lev_mean_sea_level=on&var_{variable_mslp}=on"
-        f"&subregion=&leftlon=220&rightlon=300&toplat=55&bottomlat=20"
-        f"&dir=%2Fgfs.{date_str}%2F{hour_str}%2Fatmos"
-    )
-    return download_grib(url, file_path)
+    return gfs_ingest.fetch(date_str, hour_str, step, "mslp_prate", "mslp")
 
 def get_prate_grib(step):
-    if step == 0:
-        file_name = f"gfs.t{hour_str}z.pgrb2.0p25.f000"
-    else:
-        file_name = f"gfs.t{hour_str}z.pgrb2.0p25.f{step:03d}"
-    file_path = os.path.join(grib_dir, f"prate_{file_name}")
-    url = (
-        f"{base_url_0p25}?file={file_name}"
-        f"&lev_surface=on&var_{variable_prate}=on"
-        f"&subregion=&leftlon=220&rightlon=300&toplat=55&bottomlat=20"
-        f"&dir=%2Fgfs.{date_str}%2F{hour_str}%2Fatmos"
-    )
-    return download_grib(url, file_path)
+    return gfs_ingest.fetch(date_str, hour_str, step, "mslp_prate", "prate")
 
 def get_csnow_grib(step):
-    if step == 0:
-        file_name = f"gfs.t{hour_str}z.pgrb2.0p25.f000"
-    else:
-        file_name = f"gfs.t{hour_str}z.pgrb2.0p25.f{step:03d}"
-    file_path = os.path.join(grib_dir, f"csnow_{file_name}")
-    url = (
-        f"{base_url_0p25}?file={file_name}"
-        f"&lev_surface=on&var_{variable_csnow}=on"
-        f"&subregion=&leftlon=220&rightlon=300&toplat=55&bottomlat=20"
-        f"&dir=%2Fgfs.{date_str}%2F{hour_str}%2Fatmos"
-    )
-    return download_grib(url, file_path)
+    return gfs_ingest.fetch(date_str, hour_str, step, "mslp_prate", "csnow")
 
-# Plotting function
-def plot_combined(mslp_path, prate_path, step, csnow_path=None):
+def load_step(step, mslp_path, prate_path, csnow_path=None):
+    # Decode and convert once per forecast hour; both regions render from this bundle
+    if not (csnow_path and os.path.exists(csnow_path)):
+        csnow_path = None
     try:
-        ds_mslp = xr.open_dataset(mslp_path, engine="cfgrib")
-        ds_prate = xr.open_dataset(prate_path, engine="cfgrib", filter_by_keys={"stepType": "instant"})
-        ds_csnow = None
-        if csnow_path and os.path.exists(csnow_path):
-            try:
-                ds_csnow = xr.open_dataset(csnow_path, engine="cfgrib", filter_by_keys={"stepType": "instant"})
-            except Exception as e:
-                print(f"Error opening CSNOW dataset: {e}")
-                ds_csnow = None
+        bundle = gfs_decode.load_bundle(step, {
+            "mslp": (mslp_path, "MSLET", None, lambda v: gfs_arrays.scale(v.squeeze(), 0.01)),  # Pa to hPa
+            "prate": (prate_path, "PRATE", "instant", lambda v: gfs_arrays.scale(v.squeeze(), 3600)),  # mm/s to mm/hr
+            "csnow": (csnow_path, "CSNOW", "instant", lambda v: v.squeeze()),
+        })
     except Exception as e:
         print(f"Error opening dataset: {e}")
         return None
+    if bundle.fields["mslp"] is None or bundle.fields["prate"] is None:
+        print(f"MSLET/PRATE missing for step {step}")
+        return None
 
-    mslp = ds_mslp['mslet'].values / 100.0  # Pa to hPa
-    prate = ds_prate['prate'].values * 3600  # mm/s to mm/hr
+    # --- Snow mask and snow rate ---
+    csnow = bundle.fields.pop("csnow")
+    bundle.fields["snow_mask"] = None
+    bundle.fields["snow_rate"] = None
+    if csnow is not None:
+        snow_mask = (csnow > 0)
+        bundle.fields["snow_mask"] = snow_mask
+        bundle.fields["snow_rate"] = np.where(snow_mask, bundle.fields["prate"], np.nan)
+    return bundle
 
-    lats = ds_mslp['latitude'].values
-    lons = ds_mslp['longitude'].values
-    lons_plot = np.where(lons > 180, lons - 360, lons)
-    if lats.ndim == 1 and lons.ndim == 1:
-        Lon2d, Lat2d = np.meshgrid(lons_plot, lats)
-        mslp2d = mslp.squeeze()
-        prate2d = prate.squeeze()
-    else:
-        Lon2d, Lat2d = lons_plot, lats
-        mslp2d = mslp.squeeze()
-        prate2d = prate.squeeze()
+# Plotting function
+def plot_combined(bundle):
+    step = bundle.step
+    mslp2d = bundle.fields["mslp"]
+    prate2d = bundle.fields["prate"]
+    snow_mask = bundle.fields["snow_mask"]
+    snow_rate2d = bundle.fields["snow_rate"]
 
-    data2d = mslp2d  # <-- Move this line here, before snow mask logic
+    lats = bundle.lats
+    lons = bundle.lons
+    Lon2d, Lat2d = gfs_grid.geometry(lats, lons).mesh()
 
-    # --- Snow mask and snow rate ---
-    snow_mask = None
-    snow_rate2d = None
-    if ds_csnow is not None and "csnow" in ds_csnow:
-        csnow = ds_csnow['csnow'].values * 3600  # mm/s to mm/hr
-        if csnow.shape == prate2d.shape:
-            snow_mask = (csnow > 0)
-            snow_rate2d = np.where(snow_mask, prate2d, np.nan)
-        else:
-            try:
-                csnow2d = csnow.squeeze()
-                snow_mask = (csnow2d > 0)
-                snow_rate2d = np.where(snow_mask, prate2d, np.nan)
-            except Exception:
-                snow_mask = None
-                snow_rate2d = None
+    data2d = mslp2d
 
     # Remove PRATE masking so it fills all areas
     prate2d_base = prate2d
 
-    # --- Begin custom basemap integration ---
-    fig = plt.figure(figsize=(10, 7), dpi=600, facecolor='white')
-    ax = plt.axes(projection=ccrs.PlateCarree(), facecolor='white')
     extent = [-130, -65, 20, 54]
     margin = 1.0  # degrees margin to avoid plotting on the very edge
+    frame = gfs_frame.frame("mslp_prate_usa", extent)
+    fig, ax = frame.begin()
 
     # --- Title block ---
     # Map GFS run hour to local base time for f000
@@ -248,21 +183,6 @@ def plot_combined(mslp_path, prate_path, step, csnow_path=None):
     # Add title above plot
     plt.title(title_str, fontsize=12, fontweight='bold', y=1.03)
 
-    def in_extent(lon, lat):
-        return (extent[0] + margin <= lon <= extent[1] - margin) and (extent[2] + margin <= lat <= extent[3] - margin)
-
-    ax.set_extent(extent, crs=ccrs.PlateCarree())
-
-    # Base map
-    ax.add_feature(cfeature.LAND, facecolor='lightgray')
-    ax.add_feature(cfeature.OCEAN, facecolor='white')
-    ax.add_feature(cfeature.COASTLINE, linewidth=0.7)
-    ax.add_feature(cfeature.BORDERS, linewidth=0.5)
-    ax.add_feature(cfeature.STATES, linewidth=0.3)
-    ax.add_feature(cfeature.RIVERS, linewidth=0.4, edgecolor='blue')
-    ax.add_feature(cfeature.LAKES, facecolor='lightblue', edgecolor='blue', linewidth=0.3)
-    # --- End custom basemap integration ---
-
     # Plot PRATE everywhere as the base layer
     mesh = ax.contourf(
         Lon2d, Lat2d, prate2d_base,
@@ -290,9 +210,9 @@ def plot_combined(mslp_path, prate_path, step, csnow_path=None):
         )
 
     # --- Place both colorbars higher below the map ---
-    # Increase the bottom value to move colorbars up
-    cax_snow = fig.add_axes([0.15, 0.12, 0.32, 0.02])  # left half, higher below axes
-    cax_prate = fig.add_axes([0.53, 0.12, 0.32, 0.02]) # right half, higher below axes
+    # Increase the bottom value to move colorbars up; the snow colorbar follows the
+    # snow layer, so it is redrawn every step
+    cax_snow = frame.cax([0.15, 0.12, 0.32, 0.02])  # left half, higher below axes
 
     if snow_rate2d is not None:
         cbar_snow = plt.colorbar(
@@ -304,17 +224,20 @@ def plot_combined(mslp_path, prate_path, step, csnow_path=None):
         cbar_snow.ax.set_facecolor('white')
         cbar_snow.outline.set_edgecolor('black')
 
-    cbar = plt.colorbar(
-        mesh, cax=cax_prate, orientation='horizontal',
-        ticks=prate_levels, boundaries=prate_levels
-    )
-    # Format tick labels: show as integer if >= 1, else keep decimal
-    prate_tick_labels = [f"{int(v)}" if v >= 1 else f"{v:g}" for v in prate_levels]
-    cbar.ax.set_xticklabels(prate_tick_labels)
-    cbar.set_label("Precipitation Rate (mm/hr)", fontsize=8)
-    cbar.ax.tick_params(labelsize=7)
-    cbar.ax.set_facecolor('white')
-    cbar.outline.set_edgecolor('black')
+    if frame.first:
+        cax_prate = fig.add_axes([0.53, 0.12, 0.32, 0.02]) # right half, higher below axes
+        cbar = plt.colorbar(
+            mesh, cax=cax_prate, orientation='horizontal',
+            ticks=prate_levels, boundaries=prate_levels
+        )
+        # Format tick labels: show as integer if >= 1, else keep decimal
+        prate_tick_labels = [f"{int(v)}" if v >= 1 else f"{v:g}" for v in prate_levels]
+        cbar.ax.set_xticklabels(prate_tick_labels)
+        cbar.set_label("Precipitation Rate (mm/hr)", fontsize=8)
+        cbar.ax.tick_params(labelsize=7)
+        cbar.ax.set_facecolor('white')
+        cbar.outline.set_edgecolor('black')
+        ax.set_axis_off()
 
     # --- MSLP plotting ---
     cs = ax.contour(
@@ -327,164 +250,15 @@ def plot_combined(mslp_path, prate_path, step, csnow_path=None):
     ax.clabel(cs, fmt='%d', fontsize=4, colors='black', inline=True)
 
     # --- Highs and Lows detection ---
-    # Only search for extrema within the plotted region
-    mask = (
-        (Lon2d >= extent[0]) & (Lon2d <= extent[1]) &
-        (Lat2d >= extent[2]) & (Lat2d <= extent[3])
-    )
-    data_masked = np.where(mask, data2d, np.nan)
-
-    # Find local maxima (Highs) >= 1020 hPa
-    max_filt = ndimage.maximum_filter(data_masked, size=25, mode='constant', cval=np.nan)
-    highs = (data_masked == max_filt) & ~np.isnan(data_masked) & (data_masked >= 1020)
-    high_y, high_x = np.where(highs)
-    highs_plotted = 0
-    max_highs = 4
-    min_high_distance = 60  # minimum grid points between plotted highs
-    plotted_high_points = []
-    for y, x in zip(high_y, high_x):
-        if highs_plotted >= max_highs:
-            break
-        lon, lat = Lon2d[y, x], Lat2d[y, x]
-        if not in_extent(lon, lat):
-            continue
-        # Check if this high is too close to any already plotted high
-        too_close = False
-        for py, px in plotted_high_points:
-            if np.hypot(y - py, x - px) < min_high_distance:
-                too_close = True
-                break
-        if too_close:
-            continue
-        plotted_high_points.append((y, x))
-        ax.text(
-            lon, lat, "H",
-            color='blue', fontsize=16, fontweight='bold',
-            ha='center', va='center', transform=ccrs.PlateCarree(),
-            zorder=3, path_effects=[path_effects.Stroke(linewidth=1, foreground='white'), path_effects.Normal()]
-        )
-        ax.text(
-            lon, lat-0.7, f"{data2d[y, x]:.0f}",
-            color='blue', fontsize=5, fontweight='bold',
-            ha='center', va='top', transform=ccrs.PlateCarree(),
-            zorder=3, path_effects=[path_effects.Stroke(linewidth=0.5, foreground='white'), path_effects.Normal()]
-        )
-        highs_plotted += 1
-
-    # Find local minima (Lows) <= 1006 hPa (lowered threshold for hurricanes)
-    min_filt = ndimage.minimum_filter(data_masked, size=25, mode='constant', cval=np.nan)
-    lows = (data_masked == min_filt) & ~np.isnan(data_masked) & (data_masked <= 1006)
-    low_y, low_x = np.where(lows)
-    lows_plotted = 0
-    max_lows = 4
-    min_low_distance = 60  # increased minimum grid points between plotted lows
-    plotted_low_points = []
-
-    for y, x in zip(low_y, low_x):
-        if lows_plotted >= max_lows:
-            break
-        if (y, x) in plotted_high_points:
-            continue  # Skip if already plotted as a High
-        lon, lat = Lon2d[y, x], Lat2d[y, x]
-        if not in_extent(lon, lat):
-            continue
-        # Check if this low is too close to any already plotted low
-        too_close = False
-        for py, px in plotted_low_points:
-            if np.hypot(y - py, x - px) < min_low_distance:
-                too_close = True
-                break
-        if too_close:
-            continue
-
-        ax.text(
-            lon, lat, "L",
-            color='red', fontsize=16, fontweight='bold',
-            ha='center', va='center', transform=ccrs.PlateCarree(),
-            zorder=3, path_effects=[path_effects.Stroke(linewidth=1, foreground='white'), path_effects.Normal()]
-        )
-        ax.text(
-            lon, lat-0.7, f"{data2d[y, x]:.0f}",
-            color='red', fontsize=5, fontweight='bold',
-            ha='center', va='top', transform=ccrs.PlateCarree(),
-            zorder=3, path_effects=[path_effects.Stroke(linewidth=0.5, foreground='white'), path_effects.Normal()]
-        )
-        plotted_low_points.append((y, x))
-        lows_plotted += 1
-
-    # Always plot the absolute minimum pressure as "L" if not already plotted and not too close to existing lows
-    flat_data = data2d.flatten()
-    min_idx = np.nanargmin(flat_data)
-    min_y_full, min_x_full = np.unravel_index(min_idx, data2d.shape)
-
-    if in_extent(Lon2d[min_y_full, min_x_full], Lat2d[min_y_full, min_x_full]):
-        window = 2
-        y0, x0 = min_y_full, min_x_full
-        y1, y2 = max(0, y0 - window), min(data2d.shape[0], y0 + window + 1)
-        x1, x2 = max(0, x0 - window), min(data2d.shape[1], x0 + window + 1)
-        local_patch = data2d[y1:y2, x1:x2]
-        grad_y, grad_x = np.gradient(local_patch)
-        grad_mag = np.sqrt(grad_y**2 + grad_x**2)
-        max_grad = np.nanmax(grad_mag)
-        close_contour_threshold = 2.0  # hPa/grid, tune as needed
-
-        already_plotted = any(np.hypot(min_y_full - py, min_x_full - px) < min_low_distance for py, px in plotted_low_points)
-        if (not already_plotted) or (max_grad > close_contour_threshold and not already_plotted):
-            if not already_plotted:
-                ax.text(
-                    Lon2d[min_y_full, min_x_full], Lat2d[min_y_full, min_x_full], "L",
-                    color='red', fontsize=16, fontweight='bold',
-                    ha='center', va='center', transform=ccrs.PlateCarree(),
-                    zorder=3, path_effects=[path_effects.Stroke(linewidth=1, foreground='white'), path_effects.Normal()]
-                )
-                ax.text(
-                    Lon2d[min_y_full, min_x_full], Lat2d[min_y_full, min_x_full]-0.7, f"{data2d[min_y_full, min_x_full]:.0f}",
-                    color='red', fontsize=5, fontweight='bold',
-                    ha='center', va='top', transform=ccrs.PlateCarree(),
-                    zorder=3, path_effects=[path_effects.Stroke(linewidth=0.5, foreground='white'), path_effects.Normal()]
-                )
-                plotted_low_points.append((min_y_full, min_x_full))
-
-    # Always plot an L at the location of the tightest pressure gradient (if extreme and not too close to existing lows)
-    grad_y_full, grad_x_full = np.gradient(data2d)
-    grad_mag_full = np.sqrt(grad_y_full**2 + grad_x_full**2)
-    max_grad_idx = np.nanargmax(grad_mag_full)
-    grad_y, grad_x = np.unravel_index(max_grad_idx, grad_mag_full.shape)
-    max_grad_value = grad_mag_full[grad_y, grad_x]
-    tight_gradient_threshold = 3.0  # hPa/grid, adjust as needed
-
-    window = 2
-    y1, y2 = max(0, grad_y - window), min(data2d.shape[0], grad_y + window + 1)
-    x1, x2 = max(0, grad_x - window), min(data2d.shape[1], grad_x + window + 1)
-    local_patch = data2d[y1:y2, x1:x2]
-    if np.any(~np.isnan(local_patch)):
-        local_min_idx = np.nanargmin(local_patch)
-        local_min_y, local_min_x = np.unravel_index(local_min_idx, local_patch.shape)
-        abs_min_y = y1 + local_min_y
-        abs_min_x = x1 + local_min_x
-
-        if (extent[0] <= Lon2d[abs_min_y, abs_min_x] <= extent[1] and
-            extent[2] <= Lat2d[abs_min_y, abs_min_x] <= extent[3]):
-            already_plotted = any(np.hypot(abs_min_y - py, abs_min_x - px) < min_low_distance for py, px in plotted_low_points)
-            if (max_grad_value > tight_gradient_threshold) and not already_plotted:
-                ax.text(
-                    Lon2d[abs_min_y, abs_min_x], Lat2d[abs_min_y, abs_min_x], "L",
-                    color='red', fontsize=16, fontweight='bold',
-                    ha='center', va='center', transform=ccrs.PlateCarree(),
-                    zorder=3, path_effects=[path_effects.Stroke(linewidth=1, foreground='white'), path_effects.Normal()]
-                )
-                ax.text(
-                    Lon2d[abs_min_y, abs_min_x], Lat2d[abs_min_y, abs_min_x]-0.7, f"{data2d[abs_min_y, abs_min_x]:.0f}",
-                    color='red', fontsize=5, fontweight='bold',
-                    ha='center', va='top', transform=ccrs.PlateCarree(),
-                    zorder=3, path_effects=[path_effects.Stroke(linewidth=0.5, foreground='white'), path_effects.Normal()]
-                )
-                plotted_low_points.append((abs_min_y, abs_min_x))
-
-    ax.set_axis_off()
+    # Only search for extrema within the plotted region; the deepest low is always marked
+    highs = gfs_extrema.find_centers(data2d, Lon2d, Lat2d, extent, "H", threshold=1020, margin=margin)
+    # Lows <= 1006 hPa (lowered threshold for hurricanes)
+    lows = gfs_extrema.find_centers(data2d, Lon2d, Lat2d, extent, "L", threshold=1006, margin=margin,
+                                    always_extreme=True)
+    gfs_extrema.draw_centers(ax, highs + lows, transform=ccrs.PlateCarree())
+
     png_path = os.path.join(combined_dir, f"usa_gfs_{step:03d}.png")
-    plt.savefig(png_path, bbox_inches='tight', pad_inches=0, transparent=False, dpi=600, facecolor='white')
-    plt.close(fig)
+    frame.save(png_path, pad_inches=0, palette=png_palette, transparent=False, dpi=600, facecolor='white')
     print(f"Generated combined PNG: {png_path}")
     return png_path
 
@@ -492,63 +266,7 @@ def plot_combined(mslp_path, prate_path, step, csnow_path=None):
 northeast_dir = os.path.join(BASE_DIR, "GFS", "static", "northeast_pngs")
 os.makedirs(northeast_dir, exist_ok=True)
 
-def plot_northeast(mslp_path, prate_path, step, csnow_path=None):
-    try:
-        ds_mslp = xr.open_dataset(mslp_path, engine="cfgrib")
-        ds_prate = xr.open_dataset(prate_path, engine="cfgrib", filter_by_keys={"stepType": "instant"})
-        ds_csnow = None
-        if csnow_path and os.path.exists(csnow_path):
-            try:
-                ds_csnow = xr.open_dataset(csnow_path, engine="cfgrib", filter_by_keys={"stepType": "instant"})
-            except Exception as e:
-                print(f"Error opening CSNOW dataset: {e}")
-                ds_csnow = None
-    except Exception as e:
-        print(f"Error opening dataset: {e}")
-        return None
-
-    mslp = ds_mslp['mslet'].values / 100.0  # Pa to hPa
-    prate = ds_prate['prate'].values * 3600  # mm/s to mm/hr
-
-    lats = ds_mslp['latitude'].values
-    lons = ds_mslp['longitude'].values
-    lons_plot = np.where(lons > 180, lons - 360, lons)
-    if lats.ndim == 1 and lons.ndim == 1:
-        Lon2d, Lat2d = np.meshgrid(lons_plot, lats)
-        mslp2d = mslp.squeeze()
-        prate2d = prate.squeeze()
-    else:
-        Lon2d, Lat2d = lons_plot, lats
-        mslp2d = mslp.squeeze()
-        prate2d = prate.squeeze()
-
-    data2d = mslp2d
-
-    # --- Snow mask and snow rate ---
-    snow_mask = None
-    snow_rate2d = None
-    if ds_csnow is not None and "csnow" in ds_csnow:
-        csnow = ds_csnow['csnow'].values * 3600
-        if csnow.shape == prate2d.shape:
-            snow_mask = (csnow > 0)
-            snow_rate2d = np.where(snow_mask, prate2d, np.nan)
-        else:
-            try:
-                csnow2d = csnow.squeeze()
-                snow_mask = (csnow2d > 0)
-                snow_rate2d = np.where(snow_mask, prate2d, np.nan)
-            except Exception:
-                snow_mask = None
-                snow_rate2d = None
-
-    prate2d_base = prate2d
-
-    # --- Begin custom basemap integration ---
-    fig = plt.figure(figsize=(10, 7), dpi=600, facecolor='white')
-    ax = plt.axes(projection=ccrs.PlateCarree(), facecolor='white')
-    extent = [-82, -66, 38, 48]  # Northeast US
-    margin = 1.0  # match USA margin
-
+def add_northeast_overlays(ax):
     # --- Add counties ---
     # load local GeoJSON (only plot NE states)
     county_json = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "cb_2018_us_county_20m.json"))
@@ -592,6 +310,26 @@ def plot_northeast(mslp_path, prate_path, step, csnow_path=None):
     except Exception as e:
         print(f"Could not load primary roads shapefile: {e}")
 
+def plot_northeast(bundle):
+    step = bundle.step
+    mslp2d = bundle.fields["mslp"]
+    prate2d = bundle.fields["prate"]
+    snow_mask = bundle.fields["snow_mask"]
+    snow_rate2d = bundle.fields["snow_rate"]
+
+    lats = bundle.lats
+    lons = bundle.lons
+    Lon2d, Lat2d = gfs_grid.geometry(lats, lons).mesh()
+
+    data2d = mslp2d
+
+    prate2d_base = prate2d
+
+    extent = [-82, -66, 38, 48]  # Northeast US
+    margin = 1.0  # match USA margin
+    frame = gfs_frame.frame("mslp_prate_northeast", extent, overlay=add_northeast_overlays)
+    fig, ax = frame.begin()
+
     # --- Title block (match USA style) ---
     run_hour_map = {
         "00": 20,
@@ -611,20 +349,6 @@ def plot_northeast(mslp_path, prate_path, step, csnow_path=None):
     )
     plt.title(title_str, fontsize=12, fontweight='bold', y=1.03)
 
-    def in_extent(lon, lat):
-        return (extent[0] + margin <= lon <= extent[1] - margin) and (extent[2] + margin <= lat <= extent[3] - margin)
-
-    ax.set_extent(extent, crs=ccrs.PlateCarree())
-
-    # Basemap features (same as USA)
-    ax.add_feature(cfeature.LAND, facecolor='lightgray')
-    ax.add_feature(cfeature.OCEAN, facecolor='white')
-    ax.add_feature(cfeature.COASTLINE, linewidth=0.7)
-    ax.add_feature(cfeature.BORDERS, linewidth=0.5)
-    ax.add_feature(cfeature.STATES, linewidth=0.3)
-    ax.add_feature(cfeature.RIVERS, linewidth=0.4, edgecolor='blue')
-    ax.add_feature(cfeature.LAKES, facecolor='lightblue', edgecolor='blue', linewidth=0.3)
-
     mesh = ax.contourf(
         Lon2d, Lat2d, prate2d_base,
         levels=prate_levels,
@@ -650,8 +374,7 @@ def plot_northeast(mslp_path, prate_path, step, csnow_path=None):
         )
 
     # Place colorbars at the same height as USA PNGs
-    cax_snow = fig.add_axes([0.15, 0.12, 0.32, 0.02])
-    cax_prate = fig.add_axes([0.53, 0.12, 0.32, 0.02])
+    cax_snow = frame.cax([0.15, 0.12, 0.32, 0.02])
 
     if snow_rate2d is not None:
         cbar_snow = plt.colorbar(
@@ -663,16 +386,19 @@ def plot_northeast(mslp_path, prate_path, step, csnow_path=None):
         cbar_snow.ax.set_facecolor('white')
         cbar_snow.outline.set_edgecolor('black')
 
-    cbar = plt.colorbar(
-        mesh, cax=cax_prate, orientation='horizontal',
-        ticks=prate_levels, boundaries=prate_levels
-    )
-    prate_tick_labels = [f"{int(v)}" if v >= 1 else f"{v:g}" for v in prate_levels]
-    cbar.ax.set_xticklabels(prate_tick_labels)
-    cbar.set_label("Precipitation Rate (mm/hr)", fontsize=8)
-    cbar.ax.tick_params(labelsize=7)
-    cbar.ax.set_facecolor('white')
-    cbar.outline.set_edgecolor('black')
+    if frame.first:
+        cax_prate = fig.add_axes([0.53, 0.12, 0.32, 0.02])
+        cbar = plt.colorbar(
+            mesh, cax=cax_prate, orientation='horizontal',
+            ticks=prate_levels, boundaries=prate_levels
+        )
+        prate_tick_labels = [f"{int(v)}" if v >= 1 else f"{v:g}" for v in prate_levels]
+        cbar.ax.set_xticklabels(prate_tick_labels)
+        cbar.set_label("Precipitation Rate (mm/hr)", fontsize=8)
+        cbar.ax.tick_params(labelsize=7)
+        cbar.ax.set_facecolor('white')
+        cbar.outline.set_edgecolor('black')
+        ax.set_axis_off()
 
     # --- MSLP plotting (same as USA) ---
     cs = ax.contour(
@@ -685,137 +411,26 @@ def plot_northeast(mslp_path, prate_path, step, csnow_path=None):
     ax.clabel(cs, fmt='%d', fontsize=4, colors='black', inline=True)
 
     # --- Highs and Lows detection (same logic as USA, but for NE extent) ---
-    mask = (
-        (Lon2d >= extent[0]) & (Lon2d <= extent[1]) &
-        (Lat2d >= extent[2]) & (Lat2d <= extent[3])
-    )
-    data_masked = np.where(mask, data2d, np.nan)
-
-    max_filt = ndimage.maximum_filter(data_masked, size=25, mode='constant', cval=np.nan)
-    highs = (data_masked == max_filt) & ~np.isnan(data_masked) & (data_masked >= 1020)
-    high_y, high_x = np.where(highs)
-    highs_plotted = 0
-    max_highs = 4
-    min_high_distance = 60
-    plotted_high_points = []
-    for y, x in zip(high_y, high_x):
-        if highs_plotted >= max_highs:
-            break
-        lon, lat = Lon2d[y, x], Lat2d[y, x]
-        if not in_extent(lon, lat):
-            continue
-        too_close = False
-        for py, px in plotted_high_points:
-            if np.hypot(y - py, x - px) < min_high_distance:
-                too_close = True
-                break
-        if too_close:
-            continue
-        plotted_high_points.append((y, x))
-        ax.text(
-            lon, lat, "H",
-            color='blue', fontsize=16, fontweight='bold',
-            ha='center', va='center', transform=ccrs.PlateCarree(),
-            zorder=3, path_effects=[path_effects.Stroke(linewidth=1, foreground='white'), path_effects.Normal()]
-        )
-        ax.text(
-            lon, lat-0.7, f"{data2d[y, x]:.0f}",
-            color='blue', fontsize=5, fontweight='bold',
-            ha='center', va='top', transform=ccrs.PlateCarree(),
-            zorder=3, path_effects=[path_effects.Stroke(linewidth=0.5, foreground='white'), path_effects.Normal()]
-        )
-        highs_plotted += 1
-
-    min_filt = ndimage.minimum_filter(data_masked, size=25, mode='constant', cval=np.nan)
-    lows = (data_masked == min_filt) & ~np.isnan(data_masked) & (data_masked <= 1006)
-    low_y, low_x = np.where(lows)
-    lows_plotted = 0
-    max_lows = 4
-    min_low_distance = 60
-    plotted_low_points = []
-
-    for y, x in zip(low_y, low_x):
-        if lows_plotted >= max_lows:
-            break
-        if (y, x) in plotted_high_points:
-            continue
-        lon, lat = Lon2d[y, x], Lat2d[y, x]
-        if not in_extent(lon, lat):
-            continue
-        too_close = False
-        for py, px in plotted_low_points:
-            if np.hypot(y - py, x - px) < min_low_distance:
-                too_close = True
-                break
-        if too_close:
-            continue
-
-        ax.text(
-            lon, lat, "L",
-            color='red', fontsize=16, fontweight='bold',
-            ha='center', va='center', transform=ccrs.PlateCarree(),
-            zorder=3, path_effects=[path_effects.Stroke(linewidth=1, foreground='white'), path_effects.Normal()]
-        )
-        ax.text(
-            lon, lat-0.7, f"{data2d[y, x]:.0f}",
-            color='red', fontsize=5, fontweight='bold',
-            ha='center', va='top', transform=ccrs.PlateCarree(),
-            zorder=3, path_effects=[path_effects.Stroke(linewidth=0.5, foreground='white'), path_effects.Normal()]
-        )
-        plotted_low_points.append((y, x))
-        lows_plotted += 1
+    highs = gfs_extrema.find_centers(data2d, Lon2d, Lat2d, extent, "H", threshold=1020, margin=margin)
+    lows = gfs_extrema.find_centers(data2d, Lon2d, Lat2d, extent, "L", threshold=1006, margin=margin)
+    gfs_extrema.draw_centers(ax, highs + lows, transform=ccrs.PlateCarree())
 
-    ax.set_axis_off()
     png_path = os.path.join(northeast_dir, f"northeast_gfs_{step:03d}.png")
-    plt.savefig(png_path, bbox_inches='tight', pad_inches=0, transparent=False, dpi=600, facecolor='white')
-    plt.close(fig)
+    frame.save(png_path, pad_inches=0, palette=png_palette, transparent=False, dpi=600, facecolor='white')
     print(f"Generated Northeast PNG: {png_path}")
     return png_path
 
 # Main process
-for step in forecast_steps:
-    mslp_grib = get_mslp_grib(step)
-    prate_grib = get_prate_grib(step)
-    csnow_grib = get_csnow_grib(step)
-    if mslp_grib and prate_grib:
-        plot_combined(mslp_grib, prate_grib, step, csnow_grib)
-        plot_northeast(mslp_grib, prate_grib, step, csnow_grib)
-        gc.collect()
-        time.sleep(1)
-
-        print("All combined PNG creation tasks complete!")
-        time.sleep(1)
-
-# --- Delete all GRIB files in grib_dir after PNGs are made ---
-for f in os.listdir(grib_dir):
-    file_path = os.path.join(grib_dir, f)
-    if os.path.isfile(file_path):
-        os.remove(file_path)
-        print("All GRIB files deleted from grib_dir.")
-        gc.collect()
-        time.sleep(0)
-        print("All combined PNG creation tasks complete!")
-
-# --- Optimize all PNGs in the output directories ---
-from PIL import Image
-
-def optimize_png(filepath):
-    try:
-        with Image.open(filepath) as img:
-            img = img.convert('P', palette=Image.ADAPTIVE, colors=256)
-            img.save(filepath, optimize=True)
-            print(f"Optimized PNG: {filepath}")
-    except Exception as e:
-        print(f"Failed to optimize {filepath}: {e}")
-
-# Optimize USA PNGs
-for f in os.listdir(combined_dir):
-    if f.lower().endswith('.png'):
-        optimize_png(os.path.join(combined_dir, f))
-
-# Optimize Northeast PNGs
-for f in os.listdir(northeast_dir):
-    if f.lower().endswith('.png'):
-        optimize_png(os.path.join(northeast_dir, f))
-
-print("All PNGs optimized.")
+with gfs_render.Renderer(frames=2) as render:
+    for step, (mslp_grib, prate_grib, csnow_grib) in gfs_ingest.prefetch(forecast_steps,
+            lambda s: (get_mslp_grib(s), get_prate_grib(s), get_csnow_grib(s))):
+        if mslp_grib and prate_grib:
+            bundle = load_step(step, mslp_grib, prate_grib, csnow_grib)
+            if bundle is not None:
+                render.submit(plot_combined, bundle)
+                render.submit(plot_northeast, bundle)
+
+            print("All combined PNG creation tasks complete!")
+
+# --- Prune old cycles from the shared GRIB cache ---
+gfs_ingest.prune_cycles(date_str, hour_str)
@@ -2,19 +2,21 @@ import importlib
 import os
 import cartopy
 from filelock import FileLock
-import requests
 from datetime import datetime, timedelta
-import xarray as xr
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
-import numpy as np
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
-import time
-import gc
-from PIL import Image
+import gfs_decode
+import gfs_frame
+import gfs_grid
+import gfs_ingest
+import gfs_labels
+import gfs_png
+import gfs_raster
+import gfs_render
 
 # Ensure a stable cartopy data directory and create it
 cartopy.config['data_dir'] = '/opt/render/project/src/cartopy_data'
@@ -30,9 +32,11 @@ with lock:
 
 BASE_DIR = '/var/data'
 
-# --- Clean up old files in grib_files, pngs, and sunsd_surface directories ---
+# Filled fields as gfs_raster images (False: matplotlib contourf)
+RASTER = True
+
+# --- Clean up old files in pngs and sunsd_surface directories ---
 for folder in [
-    os.path.join(BASE_DIR, "GFS", "static", "sunsd_surface", "grib_files"),
     os.path.join(BASE_DIR, "GFS", "static", "pngs"),
     os.path.join(BASE_DIR, "GFS", "static", "sunsd_surface")
 ]:
@@ -45,17 +49,11 @@ for folder in [
 # Directories
 output_dir = os.path.join(BASE_DIR, "GFS")
 sunsd_surface_dir = os.path.join(output_dir, "static", "sunsd_surface")
-grib_dir = os.path.join(sunsd_surface_dir, "grib_files")
 png_dir = sunsd_surface_dir
-os.makedirs(grib_dir, exist_ok=True)
 os.makedirs(png_dir, exist_ok=True)
 
-# GFS NOMADS URL and variable
-base_url = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl"
-variable_sunsd = "SUNSD"
-current_utc_time = datetime.utcnow() - timedelta(hours=6)
-date_str = current_utc_time.strftime("%Y%m%d")
-hour_str = str(current_utc_time.hour // 6 * 6).zfill(2)
+# Newest GFS cycle on NOMADS (GFS_CYCLE=YYYYMMDDHH pins one)
+date_str, hour_str = gfs_ingest.current_cycle()
 
 # Custom colormap and levels for sunshine duration (hours)
 sunsd_levels = [0, 0.5, 1, 2, 3, 4, 5, 6]
@@ -66,45 +64,18 @@ custom_cmap = LinearSegmentedColormap.from_list(
     ],
     N=256
 )
+png_palette = gfs_png.palette(gfs_png.Fill(gfs_raster.palette(sunsd_levels, custom_cmap, extend='max')))
 
 def download_file(hour_str, step):
-    file_name = f"gfs.t{hour_str}z.pgrb2.0p25.f{step:03d}"
-    file_path = os.path.join(grib_dir, file_name)
-    url_sunsd = (
-        f"{base_url}?file={file_name}"
-        f"&lev_surface=on&var_{variable_sunsd}=on"
-        f"&subregion=&leftlon=220&rightlon=300&toplat=55&bottomlat=20"
-        f"&dir=%2Fgfs.{date_str}%2F{hour_str}%2Fatmos"
-    )
-    response = requests.get(url_sunsd, stream=True)
-    if response.status_code == 200:
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-        print(f"Downloaded {file_name}")
-        return file_path
-    else:
-        print(f"Failed to download {file_name} (Status Code: {response.status_code})")
-        return None
+    return gfs_ingest.fetch(date_str, hour_str, step, "sunsd_surface", "sunsd")
 
 def generate_clean_png(file_path, step):
-    ds = xr.open_dataset(file_path, engine="cfgrib")
-    data = ds['SUNSD'].values / 3600.0  # seconds to hours
+    field = gfs_decode.load(file_path, "SUNSD")
+    data = field.values / 3600.0  # seconds to hours
 
-    fig = plt.figure(figsize=(10, 7), dpi=600, facecolor='white')
-    ax = plt.axes(projection=ccrs.PlateCarree(), facecolor='white')
     extent = [-130, -65, 20, 54]
-    ax.set_extent(extent, crs=ccrs.PlateCarree())
-
-    # --- Add map features ---
-    ax.add_feature(cfeature.LAND, facecolor='lightgray')
-    ax.add_feature(cfeature.OCEAN, facecolor='white')
-    ax.add_feature(cfeature.COASTLINE, linewidth=0.7)
-    ax.add_feature(cfeature.BORDERS, linewidth=0.5)
-    ax.add_feature(cfeature.STATES, linewidth=0.3)
-    ax.add_feature(cfeature.RIVERS, linewidth=0.4, edgecolor='blue')
-    ax.add_feature(cfeature.LAKES, facecolor='lightblue', edgecolor='blue', linewidth=0.3)
+    frame = gfs_frame.frame("sunsd_usa", extent)
+    fig, ax = frame.begin()
 
     # --- Title block ---
     run_hour_map = {
@@ -126,35 +97,21 @@ def generate_clean_png(file_path, step):
     plt.title(title_str, fontsize=12, fontweight='bold', y=1.03)
 
     # --- Plot sunshine duration ---
-    if 'latitude' in ds and 'longitude' in ds:
-        lats = ds['latitude'].values
-        lons = ds['longitude'].values
-        lons_plot = np.where(lons > 180, lons - 360, lons)
-        if lats.ndim == 1 and lons.ndim == 1:
-            Lon2d, Lat2d = np.meshgrid(lons_plot, lats)
-            data2d = data.squeeze()
-        else:
-            Lon2d, Lat2d = lons_plot, lats
-            data2d = data.squeeze()
-        mesh = ax.contourf(
-            Lon2d, Lat2d, data2d,
+    if field.lats is not None and field.lons is not None:
+        lats = field.lats
+        lons = field.lons
+        region = gfs_grid.geometry(lats, lons).region(extent)
+        data2d = region.crop(data.squeeze())
+        mesh = gfs_raster.contourf(
+            ax, region, data2d,
             levels=sunsd_levels,
             cmap=custom_cmap,
             extend='max',
-            transform=ccrs.PlateCarree()
+            raster=RASTER
         )
         # Optional: overlay numbers for sunshine duration
-        for lat in range(int(extent[2]), int(extent[3]) + 1):
-            for lon in range(int(extent[0]), int(extent[1]) + 1):
-                iy = np.abs(lats - lat).argmin() if lats.ndim == 1 else np.abs(lats[:,0] - lat).argmin()
-                ix = np.abs(lons_plot - lon).argmin() if lons_plot.ndim == 1 else np.abs(lons_plot[0,:] - lon).argmin()
-                sun_hr = data2d[iy, ix]
-                ax.text(
-                    lon, lat, f"{sun_hr:.1f}",
-                    color='black', fontsize=4, fontweight='bold',
-                    ha='center', va='center', transform=ccrs.PlateCarree(),
-                    zorder=10
-                )
+        label_grid = gfs_labels.label_grid(region.lats, region.lons, extent, 1)
+        gfs_labels.draw(ax, label_grid, data2d, gfs_labels.tenths, fontsize=4, transform=ccrs.PlateCarree())
     else:
         leaflet_extent = extent
         mesh = ax.imshow(
@@ -167,29 +124,30 @@ def generate_clean_png(file_path, step):
             transform=ccrs.PlateCarree()
         )
 
-    # --- Add colorbar below plot ---
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0.01)
-    cbar = plt.colorbar(
-        mesh, ax=ax, orientation='horizontal',
-        pad=0.01, aspect=25, shrink=0.65, fraction=0.035,
-        anchor=(0.5, 0.0), location='bottom'
-    )
-    cbar.set_label("Sunshine Duration (hours)", fontsize=8)
-    cbar.ax.tick_params(labelsize=7)
-    cbar.ax.set_facecolor('white')
-    cbar.outline.set_edgecolor('black')
-
-    # Add ADKWX.com to bottom right
-    fig.text(
-        0.99, 0.01, "adkwx.com",
-        fontsize=10, color="black", ha="right", va="bottom",
-        alpha=0.7, fontweight="bold"
-    )
+    if frame.first:
+        # --- Add colorbar below plot ---
+        plt.subplots_adjust(left=0, right=1, top=1, bottom=0.01)
+        cbar = plt.colorbar(
+            mesh, ax=ax, orientation='horizontal',
+            pad=0.01, aspect=25, shrink=0.65, fraction=0.035,
+            anchor=(0.5, 0.0), location='bottom'
+        )
+        cbar.set_label("Sunshine Duration (hours)", fontsize=8)
+        cbar.ax.tick_params(labelsize=7)
+        cbar.ax.set_facecolor('white')
+        cbar.outline.set_edgecolor('black')
+
+        # Add ADKWX.com to bottom right
+        fig.text(
+            0.99, 0.01, "adkwx.com",
+            fontsize=10, color="black", ha="right", va="bottom",
+            alpha=0.7, fontweight="bold"
+        )
+
+        ax.set_axis_off()
 
-    ax.set_axis_off()
     png_path = os.path.join(png_dir, f"sunsd_{step:03d}.png")
-    plt.savefig(png_path, bbox_inches='tight', pad_inches=0, transparent=False, dpi=600, facecolor='white')
-    plt.close(fig)
+    frame.save(png_path, pad_inches=0, palette=png_palette, transparent=False, dpi=600, facecolor='white')
     print(f"Generated clean PNG: {png_path}")
     return png_path
 
@@ -197,34 +155,12 @@ def generate_clean_png(file_path, step):
 forecast_steps = list(range(6, 385, 6))
 if 264 not in forecast_steps:
     forecast_steps.append(264)
-for step in forecast_steps:
-    grib_file = download_file(hour_str, step)
-    if grib_file:
-        generate_clean_png(grib_file, step)
-        gc.collect()
-        time.sleep(1)
+with gfs_render.Renderer() as render:
+    for step, grib_file in gfs_ingest.prefetch(forecast_steps, lambda s: download_file(hour_str, s)):
+        if grib_file:
+            render.submit(generate_clean_png, grib_file, step)
 
 print("All GRIB file download and PNG creation tasks complete!")
 
-# --- Delete all GRIB files in grib_dir after PNGs are made ---
-for f in os.listdir(grib_dir):
-    file_path = os.path.join(grib_dir, f)
-    if os.path.isfile(file_path):
-        os.remove(file_path)
-print("All GRIB files deleted from grib_dir.")
-
-# --- Optimize all PNGs in the output directory ---
-def optimize_png(filepath):
-    try:
-        with Image.open(filepath) as img:
-            img = img.convert('P', palette=Image.ADAPTIVE, colors=256)
-            img.save(filepath, optimize=True)
-            print(f"Optimized PNG: {filepath}")
-    except Exception as e:
-        print(f"Failed to optimize {filepath}: {e}")
-
-for f in os.listdir(png_dir):
-    if f.lower().endswith('.png'):
-        optimize_png(os.path.join(png_dir, f))
-
-print("All PNGs optimized.")
+# --- Prune old cycles from the shared GRIB cache ---
+gfs_ingest.prune_cycles(date_str, hour_str)
@@ -1,18 +1,22 @@
 import os
-import requests
 from datetime import datetime, timedelta
-import xarray as xr
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
-import numpy as np
 import cartopy.crs as ccrs
 from filelock import FileLock
 import cartopy
 import importlib
-import gc
-import time
+import gfs_arrays
+import gfs_decode
+import gfs_frame
+import gfs_grid
+import gfs_ingest
+import gfs_labels
+import gfs_png
+import gfs_raster
+import gfs_render
 
 # Ensure a stable cartopy data directory and create it
 cartopy.config['data_dir'] = '/opt/render/project/src/cartopy_data'
@@ -28,9 +32,11 @@ with lock:
 
 BASE_DIR = '/var/data'
 
-# --- Clean up old files in grib_files, pngs, and tmp_surface directories ---
+# Filled fields as gfs_raster images (False: matplotlib contourf)
+RASTER = True
+
+# --- Clean up old files in pngs and tmp_surface directories ---
 for folder in [
-    os.path.join(BASE_DIR, "GFS", "static", "tmp_surface", "grib_files"),
     os.path.join(BASE_DIR, "GFS", "static", "pngs"),
     os.path.join(BASE_DIR, "GFS", "static", "tmp_surface")
 ]:
@@ -43,17 +49,11 @@ for folder in [
 # Directories
 output_dir = os.path.join(BASE_DIR, "GFS")
 tmp_surface_dir = os.path.join(output_dir, "static", "tmp_surface")
-grib_dir = os.path.join(tmp_surface_dir, "grib_files")
 png_dir = tmp_surface_dir
-os.makedirs(grib_dir, exist_ok=True)
 os.makedirs(png_dir, exist_ok=True)
 
-# GFS NOMADS URL and variable
-base_url = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl"
-variable_tmp = "TMP"
-current_utc_time = datetime.utcnow() - timedelta(hours=6)
-date_str = current_utc_time.strftime("%Y%m%d")
-hour_str = str(current_utc_time.hour // 6 * 6).zfill(2)
+# Newest GFS cycle on NOMADS (GFS_CYCLE=YYYYMMDDHH pins one)
+date_str, hour_str = gfs_ingest.current_cycle()
 
 # Custom colormap and levels for temperature (°F)
 temp_levels = [-20, 0, 10, 20, 32, 40, 50, 60, 70, 80, 90, 100]
@@ -65,45 +65,26 @@ custom_cmap = LinearSegmentedColormap.from_list(
     ],
     N=256
 )
+png_palette = gfs_png.palette(gfs_png.Fill(gfs_raster.palette(temp_levels, custom_cmap, extend='both')))
 
 def download_file(hour_str, step):
-    file_name = f"gfs.t{hour_str}z.pgrb2.0p25.f{step:03d}"
-    file_path = os.path.join(grib_dir, file_name)
-    url_tmp = (
-        f"{base_url}?file={file_name}"
-        f"&lev_2_m_above_ground=on&var_{variable_tmp}=on"
-        f"&subregion=&leftlon=220&rightlon=300&toplat=55&bottomlat=20"
-        f"&dir=%2Fgfs.{date_str}%2F{hour_str}%2Fatmos"
-    )
-    response = requests.get(url_tmp, stream=True)
-    if response.status_code == 200:
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-        print(f"Downloaded {file_name}")
-        return file_path
-    else:
-        print(f"Failed to download {file_name} (Status Code: {response.status_code})")
-        return None
+    return gfs_ingest.fetch(date_str, hour_str, step, "tmp_surface", "tmp")
 
-def generate_clean_png(file_path, step):
-    ds = xr.open_dataset(file_path, engine="cfgrib")
-    data = ds['t2m'].values - 273.15  # Kelvin to Celsius
+def load_step(file_path, step):
+    # Decode and convert once; every region renders from the same arrays
+    return gfs_decode.load_bundle(step, {
+        "tmp_f": (file_path, "TMP", None, lambda k: gfs_arrays.scale(k, 9 / 5, -459.67)),  # Kelvin to Fahrenheit
+    })
+
+def generate_clean_png(bundle):
+    step = bundle.step
+    data = bundle.fields["tmp_f"]
 
-    fig = plt.figure(figsize=(10, 7), dpi=600, facecolor='white')
-    ax = plt.axes(projection=ccrs.PlateCarree(), facecolor='white')
     extent = [-130, -65, 20, 54]
-    ax.set_extent(extent, crs=ccrs.PlateCarree())
 
     # --- Add map features as in mslp_prate.py ---
-    ax.add_feature(cfeature.LAND, facecolor='lightgray')
-    ax.add_feature(cfeature.OCEAN, facecolor='white')
-    ax.add_feature(cfeature.COASTLINE, linewidth=0.7)
-    ax.add_feature(cfeature.BORDERS, linewidth=0.5)
-    ax.add_feature(cfeature.STATES, linewidth=0.3)
-    ax.add_feature(cfeature.RIVERS, linewidth=0.4, edgecolor='blue')
-    ax.add_feature(cfeature.LAKES, facecolor='lightblue', edgecolor='blue', linewidth=0.3)
+    frame = gfs_frame.frame("tmp_surface_usa", extent)
+    fig, ax = frame.begin()
     # --- End map features ---
 
     # --- Title block (same logic as mslp_prate.py) ---
@@ -126,44 +107,27 @@ def generate_clean_png(file_path, step):
     plt.title(title_str, fontsize=12, fontweight='bold', y=1.03)
 
     # --- Plot temperature ---
-    if 'latitude' in ds and 'longitude' in ds:
-        lats = ds['latitude'].values
-        lons = ds['longitude'].values
-        lons_plot = np.where(lons > 180, lons - 360, lons)
-        if lats.ndim == 1 and lons.ndim == 1:
-            Lon2d, Lat2d = np.meshgrid(lons_plot, lats)
-            data2d = data.squeeze()
-        else:
-            Lon2d, Lat2d = lons_plot, lats
-            data2d = data.squeeze()
-        mesh = ax.contourf(
-            Lon2d, Lat2d, data2d * 9/5 + 32,
+    if bundle.lats is not None and bundle.lons is not None:
+        lats = bundle.lats
+        lons = bundle.lons
+        region = gfs_grid.geometry(lats, lons).region(extent)
+        data2d = region.crop(data.squeeze())
+        mesh = gfs_raster.contourf(
+            ax, region, data2d,
             levels=temp_levels,
             cmap=custom_cmap,
             extend='both',
-            transform=ccrs.PlateCarree()
+            raster=RASTER
         )
 
         # --- Add 1-degree grid with temperature numbers ---
         # Only plot for integer lat/lon within extent
-        for lat in range(int(extent[2]), int(extent[3]) + 1):
-            for lon in range(int(extent[0]), int(extent[1]) + 1):
-                # Find nearest grid point
-                iy = np.abs(lats - lat).argmin() if lats.ndim == 1 else np.abs(lats[:,0] - lat).argmin()
-                ix = np.abs(lons_plot - lon).argmin() if lons_plot.ndim == 1 else np.abs(lons_plot[0,:] - lon).argmin()
-                temp_c = data2d[iy, ix]
-                temp_f = temp_c * 9/5 + 32
-                ax.text(
-                    lon, lat, f"{int(round(temp_f))}",
-                    color='black', fontsize=4, fontweight='bold',
-                    ha='center', va='center', transform=ccrs.PlateCarree(),
-                    zorder=10
-                    # removed bbox for transparent background
-                )
+        label_grid = gfs_labels.label_grid(region.lats, region.lons, extent, 1)
+        gfs_labels.draw(ax, label_grid, data2d, gfs_labels.whole, fontsize=4, transform=ccrs.PlateCarree())
     else:
         leaflet_extent = extent
         mesh = ax.imshow(
-            data.squeeze() * 9/5 + 32,
+            data.squeeze(),
             cmap=custom_cmap,
             extent=leaflet_extent,
             origin='lower',
@@ -173,29 +137,30 @@ def generate_clean_png(file_path, step):
         )
         # No grid overlay for imshow fallback
 
-    # --- Add colorbar below plot, styled like mslp_prate.py ---
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0.01)
-    cbar = plt.colorbar(
-        mesh, ax=ax, orientation='horizontal',
-        pad=0.01, aspect=25, shrink=0.65, fraction=0.035,
-        anchor=(0.5, 0.0), location='bottom'
-    )
-    cbar.set_label("2m Temperature (°F)", fontsize=8)
-    cbar.ax.tick_params(labelsize=7)
-    cbar.ax.set_facecolor('white')
-    cbar.outline.set_edgecolor('black')
-
-    # Add ADKWX.com to bottom right
-    fig.text(
-        0.99, 0.01, "",
-        fontsize=10, color="black", ha="right", va="bottom",
-        alpha=0.7, fontweight="bold"
-    )
+    if frame.first:
+        # --- Add colorbar below plot, styled like mslp_prate.py ---
+        plt.subplots_adjust(left=0, right=1, top=1, bottom=0.01)
+        cbar = plt.colorbar(
+            mesh, ax=ax, orientation='horizontal',
+            pad=0.01, aspect=25, shrink=0.65, fraction=0.035,
+            anchor=(0.5, 0.0), location='bottom'
+        )
+        cbar.set_label("2m Temperature (°F)", fontsize=8)
+        cbar.ax.tick_params(labelsize=7)
+        cbar.ax.set_facecolor('white')
+        cbar.outline.set_edgecolor('black')
+
+        # Add ADKWX.com to bottom right
+        fig.text(
+            0.99, 0.01, "",
+            fontsize=10, color="black", ha="right", va="bottom",
+            alpha=0.7, fontweight="bold"
+        )
+
+        ax.set_axis_off()
 
-    ax.set_axis_off()
     png_path = os.path.join(png_dir, f"2mtemp_{step:03d}.png")
-    plt.savefig(png_path, bbox_inches='tight', pad_inches=0, transparent=False, dpi=600, facecolor='white')
-    plt.close(fig)
+    frame.save(png_path, pad_inches=0, palette=png_palette, transparent=False, dpi=600, facecolor='white')
     print(f"Generated clean PNG: {png_path}")
     return png_path
 
@@ -203,15 +168,7 @@ def generate_clean_png(file_path, step):
 northeast_tmp_dir = os.path.join(BASE_DIR, "GFS", "static", "northeast_tmp_pngs")
 os.makedirs(northeast_tmp_dir, exist_ok=True)
 
-def generate_northeast_tmp_png(file_path, step):
-    ds = xr.open_dataset(file_path, engine="cfgrib")
-    data = ds['t2m'].values - 273.15  # Kelvin to Celsius
-
-    fig = plt.figure(figsize=(10, 7), dpi=600, facecolor='white')
-    ax = plt.axes(projection=ccrs.PlateCarree(), facecolor='white')
-    extent = [-82, -66, 38, 48]  # Northeast US
-    ax.set_extent(extent, crs=ccrs.PlateCarree())
-
+def add_northeast_overlays(ax):
     # --- Add counties ---
     county_shp = "https://www2.census.gov/geo/tiger/GENZ2018/shp/cb_2018_us_county_20m.zip"
     try:
@@ -228,14 +185,13 @@ def generate_northeast_tmp_png(file_path, step):
     except Exception as e:
         print(f"Could not load primary roads shapefile: {e}")
 
-    # Basemap features
-    ax.add_feature(cfeature.LAND, facecolor='lightgray')
-    ax.add_feature(cfeature.OCEAN, facecolor='white')
-    ax.add_feature(cfeature.COASTLINE, linewidth=0.7)
-    ax.add_feature(cfeature.BORDERS, linewidth=0.5)
-    ax.add_feature(cfeature.STATES, linewidth=0.3)
-    ax.add_feature(cfeature.RIVERS, linewidth=0.4, edgecolor='blue')
-    ax.add_feature(cfeature.LAKES, facecolor='lightblue', edgecolor='blue', linewidth=0.3)
+def generate_northeast_tmp_png(bundle):
+    step = bundle.step
+    data = bundle.fields["tmp_f"]
+
+    extent = [-82, -66, 38, 48]  # Northeast US
+    frame = gfs_frame.frame("tmp_surface_northeast", extent, overlay=add_northeast_overlays)
+    fig, ax = frame.begin()
 
     # Title block (same logic as USA)
     run_hour_map = {
@@ -257,41 +213,26 @@ def generate_northeast_tmp_png(file_path, step):
     plt.title(title_str, fontsize=12, fontweight='bold', y=1.03)
 
     # Plot temperature
-    if 'latitude' in ds and 'longitude' in ds:
-        lats = ds['latitude'].values
-        lons = ds['longitude'].values
-        lons_plot = np.where(lons > 180, lons - 360, lons)
-        if lats.ndim == 1 and lons.ndim == 1:
-            Lon2d, Lat2d = np.meshgrid(lons_plot, lats)
-            data2d = data.squeeze()
-        else:
-            Lon2d, Lat2d = lons_plot, lats
-            data2d = data.squeeze()
-        mesh = ax.contourf(
-            Lon2d, Lat2d, data2d * 9/5 + 32,
+    if bundle.lats is not None and bundle.lons is not None:
+        lats = bundle.lats
+        lons = bundle.lons
+        region = gfs_grid.geometry(lats, lons).region(extent)
+        data2d = region.crop(data.squeeze())
+        mesh = gfs_raster.contourf(
+            ax, region, data2d,
             levels=temp_levels,
             cmap=custom_cmap,
             extend='both',
-            transform=ccrs.PlateCarree()
+            raster=RASTER
         )
 
         # Add 0.5-degree grid with temperature numbers
-        for lat in np.arange(extent[2], extent[3]+0.01, 0.5):
-            for lon in np.arange(extent[0], extent[1]+0.01, 0.5):
-                iy = np.abs(lats - lat).argmin() if lats.ndim == 1 else np.abs(lats[:,0] - lat).argmin()
-                ix = np.abs(lons_plot - lon).argmin() if lons_plot.ndim == 1 else np.abs(lons_plot[0,:] - lon).argmin()
-                temp_c = data2d[iy, ix]
-                temp_f = temp_c * 9/5 + 32
-                ax.text(
-                    lon, lat, f"{int(round(temp_f))}",
-                    color='black', fontsize=6, fontweight='bold',
-                    ha='center', va='center', transform=ccrs.PlateCarree(),
-                    zorder=10
-                )
+        label_grid = gfs_labels.label_grid(region.lats, region.lons, extent, 0.5)
+        gfs_labels.draw(ax, label_grid, data2d, gfs_labels.whole, fontsize=6, transform=ccrs.PlateCarree())
     else:
         leaflet_extent = extent
         mesh = ax.imshow(
-            data.squeeze() * 9/5 + 32,
+            data.squeeze(),
             cmap=custom_cmap,
             extent=leaflet_extent,
             origin='lower',
@@ -300,29 +241,30 @@ def generate_northeast_tmp_png(file_path, step):
             transform=ccrs.PlateCarree()
         )
 
-    # Colorbar
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0.01)
-    cbar = plt.colorbar(
-        mesh, ax=ax, orientation='horizontal',
-        pad=0.01, aspect=25, shrink=0.65, fraction=0.035,
-        anchor=(0.5, 0.0), location='bottom'
-    )
-    cbar.set_label("2m Temperature (°F)", fontsize=8)
-    cbar.ax.tick_params(labelsize=7)
-    cbar.ax.set_facecolor('white')
-    cbar.outline.set_edgecolor('black')
-
-    # Add ADKWX.com to bottom right
-    fig.text(
-        0.99, 0.01, "",
-        fontsize=10, color="black", ha="right", va="bottom",
-        alpha=0.7, fontweight="bold"
-    )
+    if frame.first:
+        # Colorbar
+        plt.subplots_adjust(left=0, right=1, top=1, bottom=0.01)
+        cbar = plt.colorbar(
+            mesh, ax=ax, orientation='horizontal',
+            pad=0.01, aspect=25, shrink=0.65, fraction=0.035,
+            anchor=(0.5, 0.0), location='bottom'
+        )
+        cbar.set_label("2m Temperature (°F)", fontsize=8)
+        cbar.ax.tick_params(labelsize=7)
+        cbar.ax.set_facecolor('white')
+        cbar.outline.set_edgecolor('black')
+
+        # Add ADKWX.com to bottom right
+        fig.text(
+            0.99, 0.01, "",
+            fontsize=10, color="black", ha="right", va="bottom",
+            alpha=0.7, fontweight="bold"
+        )
+
+        ax.set_axis_off()
 
-    ax.set_axis_off()
     png_path = os.path.join(northeast_tmp_dir, f"northeast_tmp_{step:03d}.png")
-    plt.savefig(png_path, bbox_inches='tight', pad_inches=0, transparent=False, dpi=600, facecolor='white')
-    plt.close(fig)
+    frame.save(png_path, pad_inches=0, palette=png_palette, transparent=False, dpi=600, facecolor='white')
     print(f"Generated Northeast TMP PNG: {png_path}")
     return png_path
 
@@ -330,29 +272,14 @@ def generate_northeast_tmp_png(file_path, step):
 forecast_steps = list(range(6, 385, 6))
 if 264 not in forecast_steps:
     forecast_steps.append(264)
-for step in forecast_steps:
-    grib_file = download_file(hour_str, step)
-    if grib_file:
-        generate_clean_png(grib_file, step)
-        generate_northeast_tmp_png(grib_file, step)
-        gc.collect()
-        time.sleep(1)
+with gfs_render.Renderer(frames=2) as render:
+    for step, grib_file in gfs_ingest.prefetch(forecast_steps, lambda s: download_file(hour_str, s)):
+        if grib_file:
+            bundle = load_step(grib_file, step)
+            render.submit(generate_clean_png, bundle)
+            render.submit(generate_northeast_tmp_png, bundle)
 
 print("All GRIB file download and PNG creation tasks complete!")
 
-# --- Delete all GRIB files in grib_dir after PNGs are made ---
-for f in os.listdir(grib_dir):
-    file_path = os.path.join(grib_dir, f)
-    if os.path.isfile(file_path):
-        os.remove(file_path)
-print("All GRIB files deleted from grib_dir.")
-
-# --- Optimize all PNGs in the output directories ---
-for f in os.listdir(png_dir):
-    if f.lower().endswith('.png'):
-        optimize_png(os.path.join(png_dir, f))
-for f in os.listdir(northeast_tmp_dir):
-    if f.lower().endswith('.png'):
-        optimize_png(os.path.join(northeast_tmp_dir, f))
-
-print("All PNGs optimized.")
+# --- Prune old cycles from the shared GRIB cache ---
+gfs_ingest.prune_cycles(date_str, hour_str)
@@ -0,0 +1,200 @@
+import importlib
+import os
+import cartopy
+from filelock import FileLock
+from datetime import datetime, timedelta
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import ListedColormap, BoundaryNorm
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+import gfs_checkpoint
+import gfs_frame
+import gfs_grid
+import gfs_ingest
+import gfs_labels
+import gfs_png
+import gfs_raster
+import gfs_render
+import gfs_snowfall
+
+# Ensure a stable cartopy data directory and create it
+cartopy.config['data_dir'] = '/opt/render/project/src/cartopy_data'
+os.makedirs(cartopy.config['data_dir'], exist_ok=True)
+
+# Use a file lock so only one process downloads Cartopy data at a time.
+# Other processes wait until the lock is released.
+lock = FileLock(os.path.join(cartopy.config['data_dir'], 'cartopy.lock11'))
+with lock:
+    # import modules while holding the lock so only one process fetches data files
+    shpreader = importlib.import_module('cartopy.io.shapereader')
+    cfeature = importlib.import_module('cartopy.feature')
+
+BASE_DIR = '/var/data'
+
+# Filled fields as gfs_raster images (False: matplotlib contourf)
+RASTER = True
+
+# Every snow-ratio product (totalsnowfall_10to1, totalsnowfall_3to1, ...) is drawn from one
+# liquid-equivalent snowfall accumulation
+snow_ratios = gfs_snowfall.ratios()
+
+# Directories
+output_dir = os.path.join(BASE_DIR, "GFS")
+png_dirs = {
+    ratio: os.path.join(output_dir, "static", f"totalsnowfall_{gfs_snowfall.ratio_name(ratio)}")
+    for ratio in snow_ratios
+}
+
+# Newest GFS cycle on NOMADS (GFS_CYCLE=YYYYMMDDHH pins one)
+date_str, hour_str = gfs_ingest.current_cycle()
+
+# A restarted run of this cycle carries on after its last completed step and keeps its PNGs
+checkpoint_dir = gfs_ingest.checkpoint_dir(date_str, hour_str)
+resume_step, resume_liquid_in = gfs_checkpoint.load(checkpoint_dir, "totalsnowfall")
+
+# --- Clean up old files in pngs and totalsnowfall directories ---
+if resume_step is None:
+    for folder in [os.path.join(BASE_DIR, "GFS", "static", "pngs")] + list(png_dirs.values()):
+        if os.path.exists(folder):
+            for f in os.listdir(folder):
+                file_path = os.path.join(folder, f)
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+
+for png_dir in png_dirs.values():
+    os.makedirs(png_dir, exist_ok=True)
+
+# Snowfall colormap and levels (inches of snow; gfs_snowfall.levels scales them per ratio)
+snow_breaks = [
+    0, 0.1, 1, 2, 3, 4, 5, 6, 7, 8, 10, 12, 16, 20, 24, 36, 48, 56
+]
+snow_colors = [
+    "#ffffff", "#0d1a4a", "#1565c0", "#42a5f5", "#90caf9", "#e3f2fd",
+    "#b39ddb", "#7e57c2", "#512da8", "#c2185b", "#f06292", "#81c784",
+    "#388e3c", "#1b5e20", "#bdbdbd", "#757575", "#212121", "#000000"
+]
+snow_cmap = ListedColormap(snow_colors)
+# Every ratio shares one frame; its colorbar is in snow inches, so only the label changes
+snow_scale = ScalarMappable(norm=BoundaryNorm(snow_breaks, len(snow_colors)), cmap=snow_cmap)
+png_palette = gfs_png.palette(gfs_png.Fill(snow_colors))
+
+extent_left, extent_right, extent_bottom, extent_top = -130, -65, 20, 54
+
+def download_file(hour_str, step):
+    return gfs_ingest.fetch(date_str, hour_str, step, "totalsnowfall", "weasd")
+
+def prepare_grid(liquid_in, lats, lons):
+    # Cropped grid and 2-degree label points: the same for every ratio
+    region = gfs_grid.geometry(lats, lons).region([extent_left, extent_right, extent_bottom, extent_top])
+    data2d = region.crop(liquid_in.squeeze())
+    label_grid = gfs_labels.label_grid(region.lats, region.lons, region.extent, 2)
+    return region, data2d, label_grid
+
+def generate_clean_png(grid, step, ratio, heading):
+    region, data2d, label_grid = grid
+    ratio_label = f"{ratio:g}:1"
+    levels = gfs_snowfall.levels(snow_breaks, ratio)
+    snow_norm = BoundaryNorm(levels, len(snow_colors))
+
+    frame = gfs_frame.frame("totalsnowfall_usa", [extent_left, extent_right, extent_bottom, extent_top])
+    fig, ax = frame.begin()
+
+    # --- Title block ---
+    run_hour_map = {
+        "00": 20,
+        "06": 2,
+        "12": 8,
+        "18": 14
+    }
+    base_hour = run_hour_map.get(hour_str, 8)
+    base_time = datetime.strptime(date_str + f"{base_hour:02d}", "%Y%m%d%H")
+    valid_time = base_time + timedelta(hours=step)
+    hour_str_fmt = valid_time.strftime('%I%p').lstrip('0').lower()
+    day_of_week = valid_time.strftime('%A')
+    run_str = f"{hour_str}z"
+    # Add extra title line above main title
+    plt.title(
+        (f"{heading}\n" if heading else "") +
+        f"Total Snowfall (inches, {ratio_label} ratio)\n"
+        f"GFS Model {valid_time.strftime('%y%m%d')} {hour_str_fmt}  {day_of_week}  Forecast Hour: {step}  Run: {run_str}",
+        fontsize=12, fontweight='bold', y=1.07
+    )
+
+    # --- Plot total snowfall (liquid inches against the ratio's liquid breaks) ---
+    mesh = gfs_raster.contourf(
+        ax, region, data2d,
+        levels=levels,
+        cmap=snow_cmap,
+        norm=snow_norm,
+        extend='max',
+        raster=RASTER
+    )
+
+    # --- Add 2-degree grid with snowfall numbers ---
+    gfs_labels.draw(ax, label_grid, data2d * ratio, gfs_labels.hundredths, fontsize=4, transform=ccrs.PlateCarree())
+
+    if frame.first:
+        # --- Add colorbar below plot ---
+        plt.subplots_adjust(left=0, right=1, top=1, bottom=0.08)
+        cbar = plt.colorbar(
+            snow_scale, ax=ax, orientation='horizontal',
+            pad=0.08, aspect=35, shrink=0.85, fraction=0.08,
+            anchor=(0.5, 0.0), location='bottom', extend='max',
+            ticks=snow_breaks, boundaries=snow_breaks
+        )
+        cbar.set_ticklabels([f"{b:g}" for b in snow_breaks])
+        cbar.ax.tick_params(labelsize=10)
+        cbar.ax.set_facecolor('white')
+        cbar.outline.set_edgecolor('black')
+        for label in cbar.ax.get_xticklabels():
+            label.set_rotation(45)
+            label.set_ha('right')
+
+        fig.text(
+            0.99, 0.01, "adkwx.com",
+            fontsize=10, color="black", ha="right", va="bottom",
+            alpha=0.7, fontweight="bold"
+        )
+
+        ax.set_axis_off()
+        frame.cbar = cbar
+    frame.cbar.set_label(f"Total Snowfall (inches, {ratio_label} ratio)", fontsize=12)
+
+    png_path = os.path.join(png_dirs[ratio], f"totalsnowfall_{gfs_snowfall.ratio_name(ratio)}_{step:03d}.png")
+    frame.save(png_path, pad_inches=0, palette=png_palette, transparent=True, dpi=600, facecolor='white')
+    print(f"Generated clean PNG: {png_path}")
+    return png_path
+
+# Main process: Download, accumulate snowfall once, and plot every ratio
+forecast_steps = list(range(0, 385, 6))
+if 264 not in forecast_steps:
+    forecast_steps.append(264)
+
+if resume_step is not None:
+    print(f"Resuming total snowfall after forecast hour {resume_step}")
+    forecast_steps = [s for s in forecast_steps if s > resume_step]
+
+snow = None
+
+with gfs_render.Renderer() as render:
+    for step, grib_file in gfs_ingest.prefetch(forecast_steps, lambda s: download_file(hour_str, s)):
+        # Fetching appended this hour's WEASD to the cycle cube; extend the liquid-equivalent total
+        weasd_cube = gfs_ingest.cube(date_str, hour_str, "totalsnowfall", "weasd")
+        if grib_file and weasd_cube is not None:
+            if snow is None:
+                snow = gfs_snowfall.new(weasd_cube)
+                if resume_step is not None:
+                    snow.totals[resume_step] = resume_liquid_in
+            if gfs_snowfall.extend(snow, weasd_cube, step):
+                grid = prepare_grid(snow.totals[step], snow.lats, snow.lons)
+                for ratio, heading in snow_ratios.items():
+                    render.submit(generate_clean_png, grid, step, ratio, heading)
+                render.then(gfs_checkpoint.save, checkpoint_dir, "totalsnowfall", step, snow.totals[step])
+
+print("All GRIB file download and PNG creation tasks complete!")
+
+# --- Prune old cycles from the shared GRIB cache ---
+gfs_ingest.prune_cycles(date_str, hour_str)